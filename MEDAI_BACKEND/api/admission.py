@@ -0,0 +1,202 @@
+import math
+import time
+import threading
+from functools import wraps
+from django.conf import settings
+from rest_framework import status
+from rest_framework.response import Response
+from .metrics import ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_WAIT_SECONDS, ADMISSION_REJECTED
+from .jobs import job_backlog
+
+# Admission control for the endpoints that end up on the models (see AI_ADMISSION_*
+# in settings). At most `limit` requests per web process run at once, up to
+# `queue_size` more wait for a slot, and the rest are turned away right away with
+# 429, or with 503 after waiting `timeout` seconds. Retry-After tells the client
+# how long the current work should take, from the observed service times.
+# Uploads only queue a ConsultationJob, so they are also turned away (503) while
+# the queued jobs would take the AI workers more than
+# AI_ADMISSION_MAX_JOB_BACKLOG_SECONDS to run.
+
+SERVICE_TIME_SMOOTHING = 0.2 # Weight of the newest sample in the moving average
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status_code, reason, retry_after):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Concurrency limit with a bounded FIFO wait queue for one endpoint."""
+    def __init__(self, name, limit, queue_size, timeout, initial_service_seconds, backlog=None):
+        self.name = name
+        self.backlog = backlog # Callable returning the downstream work (see jobs.job_backlog)
+        self.limit = max(1, limit)
+        self.queue_size = max(0, queue_size)
+        self.timeout = timeout
+        self.service_seconds = initial_service_seconds
+        self.active = 0
+        self._waiting = [] # Tickets in arrival order
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Blocks until a slot is free. Raises AdmissionRejected when the queue is full,
+        the wait times out or the downstream backlog is too long.
+        """
+        self._check_backlog()
+        with self._cond:
+            if self.active < self.limit and not self._waiting:
+                self.active += 1
+                self._update_gauges()
+                return
+            if len(self._waiting) >= self.queue_size:
+                self._reject(status.HTTP_429_TOO_MANY_REQUESTS, 'queue_full')
+
+            ticket = object()
+            self._waiting.append(ticket)
+            self._update_gauges()
+            t0 = time.monotonic()
+            deadline = t0 + self.timeout
+            try:
+                # FIFO: only the oldest waiter takes a freed slot
+                while self.active >= self.limit or self._waiting[0] is not ticket:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, 'timeout')
+                    self._cond.wait(remaining)
+            finally:
+                self._waiting.remove(ticket)
+                self._cond.notify_all()
+            self.active += 1
+            self._update_gauges()
+            ADMISSION_WAIT_SECONDS.observe(time.monotonic() - t0, endpoint=self.name)
+
+    def release(self, service_seconds=None):
+        with self._cond:
+            self.active -= 1
+            if service_seconds is not None:
+                self.service_seconds += SERVICE_TIME_SMOOTHING * (service_seconds - self.service_seconds)
+            self._update_gauges()
+            self._cond.notify_all()
+
+    def retry_after(self):
+        """Seconds until the work running and queued now should be done."""
+        backlog = self.active + len(self._waiting)
+        return max(1, math.ceil(self.service_seconds * backlog / self.limit))
+
+    def status(self):
+        with self._cond:
+            info = {
+                'active': self.active,
+                'queued': len(self._waiting),
+                'limit': self.limit,
+                'queue_size': self.queue_size,
+                'service_seconds': round(self.service_seconds, 2),
+            }
+        if self.backlog is not None:
+            info['backlog'] = self.backlog()
+        return info
+
+    def _check_backlog(self):
+        if self.backlog is None:
+            return
+        drain_seconds = self.backlog()['drain_seconds']
+        excess = drain_seconds - settings.AI_ADMISSION_MAX_JOB_BACKLOG_SECONDS
+        if excess > 0:
+            # Come back once the workers have worked the backlog down under the limit
+            self._reject(status.HTTP_503_SERVICE_UNAVAILABLE, 'backlog', retry_after=math.ceil(excess))
+
+    def _reject(self, status_code, reason, retry_after=None):
+        ADMISSION_REJECTED.inc(endpoint=self.name, reason=reason)
+        retry_after = retry_after or self.retry_after()
+        print(f"[{time.strftime('%H:%M:%S')}] 🚦 {self.name} request rejected ({reason}), retry after {retry_after}s")
+        raise AdmissionRejected(status_code, reason, retry_after)
+
+    def _update_gauges(self):
+        ADMISSION_ACTIVE.set(self.active, endpoint=self.name)
+        ADMISSION_QUEUED.set(len(self._waiting), endpoint=self.name)
+
+
+CONTROLLERS = {
+    'upload': AdmissionController(
+        'upload', settings.AI_ADMISSION_UPLOAD_CONCURRENCY, settings.AI_ADMISSION_UPLOAD_QUEUE,
+        settings.AI_ADMISSION_QUEUE_TIMEOUT, initial_service_seconds=2.0, backlog=job_backlog,
+    ),
+    'triage': AdmissionController(
+        'triage', settings.AI_ADMISSION_TRIAGE_CONCURRENCY, settings.AI_ADMISSION_TRIAGE_QUEUE,
+        settings.AI_ADMISSION_QUEUE_TIMEOUT, initial_service_seconds=10.0,
+    ),
+}
+
+
+def admission_status():
+    return {name: controller.status() for name, controller in CONTROLLERS.items()}
+
+
+def rejection_response(e):
+    response = Response(
+        {"error": "The server is busy, please retry later.", "reason": e.reason, "retry_after": e.retry_after},
+        status=e.status_code,
+    )
+    response['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def admitted(name):
+    """Decorator for APIView methods: runs the request once the endpoint's controller admits it."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            if not settings.AI_ADMISSION_ENABLED:
+                return method(self, request, *args, **kwargs)
+            controller = CONTROLLERS[name]
+            try:
+                controller.acquire()
+            except AdmissionRejected as e:
+                return rejection_response(e)
+            t0 = time.perf_counter()
+            try:
+                return method(self, request, *args, **kwargs)
+            finally:
+                controller.release(time.perf_counter() - t0)
+        return wrapper
+    return decorator
+
+
+class AdmittedStream:
+    """
+    Streaming response body that holds an admission slot until it is exhausted or
+    closed (Django closes it even if the client disconnects before reading).
+    `on_abandon` runs when it is closed before the body started: closing a
+    generator that never ran skips its `finally` blocks.
+    """
+    def __init__(self, name, iterator, on_abandon=None):
+        self.controller = CONTROLLERS[name] if settings.AI_ADMISSION_ENABLED else None
+        if self.controller:
+            self.controller.acquire() # May raise AdmissionRejected
+        self.iterator = iterator
+        self.on_abandon = on_abandon
+        self.started = time.perf_counter()
+        self._iterating = False
+        self._released = False
+
+    def __iter__(self):
+        self._iterating = True
+        try:
+            yield from self.iterator
+        finally:
+            self.close()
+
+    def close(self):
+        if self._released:
+            return
+        self._released = True
+        if hasattr(self.iterator, 'close'):
+            self.iterator.close()
+        if not self._iterating and self.on_abandon:
+            self.on_abandon()
+        if self.controller:
+            self.controller.release(time.perf_counter() - self.started)
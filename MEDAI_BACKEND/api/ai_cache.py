@@ -0,0 +1,94 @@
+import hashlib
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F, Sum
+from django.utils import timezone
+from .models import AIResultCache
+from .metrics import AI_CACHE_REQUESTS
+
+
+def file_sha256(file_or_path):
+    """Hashes a file by content. Accepts a path or a Django FieldFile."""
+    digest = hashlib.sha256()
+    path = file_or_path.path if hasattr(file_or_path, 'path') else file_or_path
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def cache_get(kind, content_hash, version):
+    """Returns the cached result or None, and refreshes the entry's LRU timestamp."""
+    entries = AIResultCache.objects.filter(kind=kind, content_hash=content_hash, version=version)
+    result = entries.values_list('result', flat=True).first()
+    if result is not None:
+        entries.update(hits=F('hits') + 1, last_used_at=timezone.now())
+    AI_CACHE_REQUESTS.inc(kind=kind, result='hit' if result is not None else 'miss')
+    return result
+
+
+def cache_put(kind, content_hash, version, result):
+    try:
+        AIResultCache.objects.update_or_create(
+            kind=kind, content_hash=content_hash, version=version,
+            defaults={'result': result, 'last_used_at': timezone.now()}
+        )
+    except IntegrityError:
+        # Another worker stored the same entry concurrently
+        pass
+    evict(kind)
+
+
+def evict(kind, max_entries=None):
+    """Keeps at most `max_entries` entries of a kind, dropping the least recently used."""
+    max_entries = max_entries or settings.AI_RESULT_CACHE_MAX_ENTRIES
+    stale_ids = AIResultCache.objects.filter(kind=kind).order_by('-last_used_at').values_list('id', flat=True)[max_entries:]
+    stale_ids = list(stale_ids)
+    if stale_ids:
+        AIResultCache.objects.filter(id__in=stale_ids).delete()
+    return len(stale_ids)
+
+
+def invalidate(kind=None, keep_version=None):
+    """Deletes cache entries, optionally only one kind and/or only versions other than `keep_version`."""
+    entries = AIResultCache.objects.all()
+    if kind:
+        entries = entries.filter(kind=kind)
+    if keep_version:
+        entries = entries.exclude(version=keep_version)
+    deleted, _ = entries.delete()
+    return deleted
+
+
+def current_version(kind):
+    """Version string that entries of `kind` produced by the running configuration carry."""
+    # Imported here to avoid a circular import (ai_processors uses this module)
+    from .ai_processors import MedGemma15Processor, MedASRProcessor
+    if kind == 'FINDINGS':
+        return MedGemma15Processor().findings_cache_version()
+    if kind == 'TRANSCRIPT':
+        return MedASRProcessor().cache_version()
+    if kind == 'SYMPTOMS':
+        return MedGemma15Processor().symptoms_cache_version()
+    raise ValueError(f"Unknown AI cache kind: {kind}")
+
+
+def cache_stats():
+    """Per-kind entry counts and hit/miss counters (of every process, see metrics.py), for monitoring."""
+    requests = AI_CACHE_REQUESTS.merged()
+    stats = {}
+    for kind, _ in AIResultCache.KIND_CHOICES:
+        entries = AIResultCache.objects.filter(kind=kind)
+        hits, misses = requests.get((kind, 'hit'), 0), requests.get((kind, 'miss'), 0)
+        stats[kind] = {
+            'entries': entries.count(),
+            'stored_hits': entries.aggregate(total=Sum('hits'))['total'] or 0,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': round(hits / (hits + misses), 3) if hits + misses else None,
+        }
+    return stats
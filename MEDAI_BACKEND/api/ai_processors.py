@@ -1,6 +1,8 @@
 import os
-import re
 import time
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 import torch
 try:
     import librosa
@@ -9,8 +11,27 @@ except ImportError:
 import warnings
 import logging
 from PIL import Image
-from transformers import pipeline, BitsAndBytesConfig, AutoProcessor
+from django.db import connections
+from transformers import pipeline, BitsAndBytesConfig, AutoProcessor, TextIteratorStreamer
 from transformers import logging as transformers_logging
+from .inference_scheduler import BatchingScheduler, bind_priority
+from .kv_cache import TriageKVCache, split_batch_cache
+from .stopping import stopping_criteria_for, PromptLengthProbe
+from .metrics import observe_stage, timed_stage, observe_generation
+from .profiling import profile_section, current_profile_id
+from .model_registry import model_registry
+from .cpu_backend import inference_backend, cpu_backend_config, configure_threads, load_dtype, optimize_for_cpu, describe
+from .simulated_backend import load_simulated
+from .model_artifacts import artifact_variant, find_artifact
+from .inference_client import inference_server_address, RemoteInferenceClient, RemoteMedGemma, RemoteMedASR
+from .postprocess import (
+    clean_ai_output, clean_integrated_report, extract_medical_sections,
+    deduplicate_sentences, normalize_transcript, StreamingOutputCleaner
+)
+from .triage_history import TriageHistoryManager, approximate_tokens
+from .findings import apply_findings, apply_diagnosis, save_pathologies
+from .ai_cache import file_sha256, text_sha256, cache_get, cache_put
+from .media_ingest import ASR_SAMPLE_RATE, MediaValidationError, load_pcm, prepare_model_image
 
 # Silence verbose AI warnings and logs
 warnings.filterwarnings("ignore", category=UserWarning)
@@ -18,65 +39,444 @@ warnings.filterwarnings("ignore", category=FutureWarning)
 transformers_logging.set_verbosity_error()
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+MEDGEMMA_MODEL_ID = "google/medgemma-1.5-4b-it"
+
+# Bump FINDINGS_PROMPT_VERSION whenever FINDINGS_PROMPT or the image given to the model changes: cached findings are keyed by it.
+FINDINGS_PROMPT_VERSION = "2" # 2: findings come from the 896px *_model.png
+# Same for the symptom extraction prompt and the ASR text normalization
+SYMPTOMS_PROMPT_VERSION = "1"
+MEDASR_MODEL_ID = "google/medasr"
+TRANSCRIPT_NORMALIZATION_VERSION = "1"
+# Optional Hub revision pins (branch, tag or commit); local artifacts must match them
+MEDGEMMA_REVISION = os.environ.get("AI_MEDGEMMA_REVISION") or None
+MEDASR_REVISION = os.environ.get("AI_MEDASR_REVISION") or None
+
+FINDINGS_PROMPT = (
+    "Describe this medical image. \n"
+    "You must strictly follow this output format:\n"
+    "1. Provide your detailed anatomical observations starting with [OBSERVATIONS].\n"
+    "2. You MUST include a section titled exactly '[IRREGULARITIES]' followed by a explanation of the irregularities in the image.\n"
+    "3. At the very end of your response, you MUST include a section titled exactly '[PATHOLOGIES]' followed by a comma-separated list of the top 1 to 3 possible diseases or conditions.\n"
+    "Example:\n"
+    "[OBSERVATIONS] The image is a lateral view of a human left femur\n"
+    "[IRREGULARITIES] The lesion exhibits irregular borders and uneven coloration\n"
+    "[PATHOLOGIES] Pneumonia, Lung Mass, Tuberculosis\n"
+    "Note: Provide the response in English."
+)
+
+TRIAGE_SYSTEM_PROMPT = """You are an automated clinical triage assistant. Your role is to act as a structured intermediary between the patient and the human doctor.
+Your goal is to ask precise questions to narrow down symptoms and generate a short differential pre-diagnosis that will later be reviewed by the doctor.
+
+STRICT OPERATING RULES:
+1. EVALUATION: You will receive the patient's symptoms, objective image irregularities, and a list of 'Suggested Pathologies' from a radiologist AI. Your primary task is to ask targeted questions to differentiate, rule in, or rule out these specific pathologies.
+2. FORMAT RESTRICTION: Every question MUST be strictly multiple-choice, with a maximum of 5 options (letters A, B, C, D, E).
+3. THE LAST OPTION: The last letter of your options MUST ALWAYS be: "None of the above".
+4. QUESTION LIMIT: You must never exceed a maximum of 7 questions throughout the triage.
+5. ACTION TAGS:
+   - To ask, use EXACTLY: [ASK]
+   - To give the result, use EXACTLY: [DIAGNOSIS]
+
+STRICT FORMAT FOR ASKING:
+[ASK] [Write your clinical question here]?
+A) [Specific option 1]
+B) [Specific option 2]
+C) [Specific option 3]
+D) [Specific option 4]
+E) None of the above
+
+STRICT FORMAT FOR THE PRE-DIAGNOSIS:
+[DIAGNOSIS]
+* Ranked Pre-diagnosis: 
+  1. [Most Probable Illness] - [Brief reason why it's the top match based on symptoms/imaging]
+  2. [Less Probable Illness] - [Brief reason why it's less likely]
+  3. [Least Probable Illness] - [Brief reason why it's the least likely or what symptom is missing]
+  (Note: Adjust numbering based on the number of suspected conditions provided by the radiologist).
+* Clinical summary (Symptoms + Imaging): [Brief summary cross-referencing what the patient said and what the imaging showed]
+* Suggested urgency level: [Low / Medium / High]
+* Note: This is an AI-generated pre-diagnosis that requires mandatory validation by a human doctor.
+"""
+TRIAGE_ACK = "Understood. I am ready to evaluate the patient."
+# Placeholder for the previous answer when matching a prompt against the cached turn
+_ANSWER_STAND_IN = "\ue000previous answer\ue000"
+
+def medgemma_quantization_config():
+    # 4-bit quantization for VRAM efficiency
+    return BitsAndBytesConfig(
+        load_in_4bit=True,
+        bnb_4bit_quant_type="nf4",
+        bnb_4bit_compute_dtype=torch.bfloat16,
+        bnb_4bit_use_double_quant=True
+    )
+
+def _model_source(model_id, variant, revision, building_artifact):
+    """pipeline() kwargs for a valid local artifact (see build_model_artifacts), else for the Hub."""
+    artifact = None if building_artifact else find_artifact(model_id, variant, revision)
+    if artifact:
+        return artifact, {"model": artifact}
+    return None, {"model": model_id, "revision": revision, "token": os.environ.get("HF_TOKEN")}
+
+def load_medgemma_pipeline(revision=None, building_artifact=False):
+    """
+    Loads MedGemma, preferring the local pre-quantized artifact. With
+    building_artifact=True it loads from the Hub and skips the load-time CPU
+    optimizations, so the result can be saved as an artifact.
+    """
+    if inference_backend() == 'simulated':
+        return load_simulated("medgemma")
+
+    artifact, source = _model_source(MEDGEMMA_MODEL_ID, artifact_variant("nf4"), revision or MEDGEMMA_REVISION, building_artifact)
+    if not artifact and not source["token"]:
+        raise ValueError("HF_TOKEN environment variable not set. Please set it for Hugging Face access.")
+
+    if inference_backend() == 'cpu':
+        # bitsandbytes 4-bit needs CUDA: use the CPU backend (int8 dynamic / fp32 / bf16)
+        config = cpu_backend_config()
+        configure_threads(config['threads'])
+        print(f"Loading MedGemma 1.5 model on CPU ({config}){' from ' + artifact if artifact else ''}...")
+        pipe = pipeline(
+            "image-text-to-text",
+            dtype=load_dtype(config),
+            device="cpu",
+            **source
+        )
+        if not building_artifact:
+            optimize_for_cpu(pipe.model, config)
+        print(f"MedGemma 1.5 loaded ({describe(config)}).")
+        return pipe
+
+    model_kwargs = {"low_cpu_mem_usage": True}
+    if not artifact:
+        # An artifact is already quantized: its config.json carries the quantization config
+        model_kwargs["quantization_config"] = medgemma_quantization_config()
+
+    print(f"Loading MedGemma 1.5 model{' from ' + artifact if artifact else ''}...")
+    pipe = pipeline(
+        "image-text-to-text",
+        model_kwargs=model_kwargs,
+        device_map="auto",
+        **source
+    )
+    print(f"MedGemma 1.5 loaded.")
+    return pipe
+
+def load_medasr_pipeline(revision=None, building_artifact=False):
+    if inference_backend() == 'simulated':
+        return load_simulated("medasr")
+
+    artifact, source = _model_source(MEDASR_MODEL_ID, artifact_variant("fp32"), revision or MEDASR_REVISION, building_artifact)
+
+    if inference_backend() == 'cpu':
+        config = cpu_backend_config()
+        configure_threads(config['threads'])
+        print(f"Loading MedASR model on CPU{' from ' + artifact if artifact else ''}...")
+        pipe = pipeline(
+            "automatic-speech-recognition",
+            dtype=load_dtype(config),
+            device=-1,
+            **source
+        )
+        if not building_artifact:
+            optimize_for_cpu(pipe.model, config)
+        print(f"MedASR loaded ({describe(config)}).")
+        return pipe
+
+    print(f"Loading MedASR model{' from ' + artifact if artifact else ''}...")
+    pipe = pipeline(
+        "automatic-speech-recognition",
+        device=0,
+        **source
+    )
+    print("MedASR loaded.")
+    return pipe
+
+def _cache_model_id(model_id, revision, gpu_variant):
+    """
+    Model part of the AI result cache keys: model, Hub revision, backend and weights
+    variant, so outputs of another model build (or mock/simulated ones) never mix.
+    """
+    if os.environ.get("MOCK_AI") == "True":
+        return "MOCK"
+    backend = inference_backend()
+    if backend == 'simulated':
+        return "SIMULATED"
+    if backend == 'cpu':
+        config = cpu_backend_config()
+        variant = config['quantize'] if config['quantize'] not in ('none', '') else config['dtype']
+    else:
+        variant = gpu_variant
+    return f"{model_id}@{revision or 'main'}|{backend}-{variant}"
+
 class MedGemma15Processor:
     """
     Singleton processor for MedGemma 1.5.
     Handles image analysis and integrated clinical reporting.
     """
     _instance = None
-    _pipe = None
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+    _history_manager = None
+    _generation_stats = threading.local()
+    kv_cache = TriageKVCache()
 
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(MedGemma15Processor, cls).__new__(cls)
         return cls._instance
 
-    def _get_pipeline(self):
-        if os.environ.get("MOCK_AI") == "True":
-            return "MOCK_MODE"
-            
-        if self._pipe is None:
-            hf_token = os.environ.get("HF_TOKEN")
-            if not hf_token:
-                raise ValueError("HF_TOKEN environment variable not set. Please set it for Hugging Face access.")
-
-            # 4-bit quantization for VRAM efficiency
-            bnb_config = BitsAndBytesConfig(
-                load_in_4bit=True,
-                bnb_4bit_quant_type="nf4",
-                bnb_4bit_compute_dtype=torch.bfloat16,
-                bnb_4bit_use_double_quant=True
+    def _get_scheduler(self):
+        with self._scheduler_lock:
+            if MedGemma15Processor._scheduler is None:
+                MedGemma15Processor._scheduler = BatchingScheduler(self._run_batch)
+        return MedGemma15Processor._scheduler
+
+    def _triage_view(self, history):
+        """Token-budgeted view of the triage history sent to the model (the stored history stays complete)."""
+        if MedGemma15Processor._history_manager is None:
+            pipe = self._get_pipeline()
+            if pipe == "MOCK_MODE":
+                count_tokens = approximate_tokens
+            else:
+                tokenizer = pipe.processor.tokenizer
+                count_tokens = lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+            MedGemma15Processor._history_manager = TriageHistoryManager(count_tokens)
+        manager = MedGemma15Processor._history_manager
+        view = manager.view(history)
+        if view is not history:
+            print(f"Triage history compacted: {len(history)} -> {len(view)} messages, {manager.history_tokens(view)} tokens.")
+        return view
+
+    def _run_batch(self, requests):
+        """Runs a micro-batch from the scheduler. Returns one raw text per request."""
+        # Keep the model resident (no idle/budget unloading) while it generates
+        profile_ids = [r.profile_id for r in requests if r.profile_id]
+        # Generation runs on the scheduler thread: profile it under the caller's session id
+        profiling = profile_section("generation", profile_id=profile_ids[0], trace_torch=True) if profile_ids else nullcontext()
+        with model_registry.use("medgemma"), profiling:
+            t0 = time.perf_counter()
+            texts = self._run_batch_on_model(requests)
+            seconds = time.perf_counter() - t0
+            tokenizer = self._get_pipeline().processor.tokenizer
+        for request, text in zip(requests, texts):
+            if request.generated_tokens is None:
+                request.generated_tokens = len(tokenizer(text, add_special_tokens=False)["input_ids"])
+        # Rows decode side by side, one token per step: each row is charged the
+        # part of the batch time it was still generating
+        longest = max(r.generated_tokens for r in requests)
+        for request in requests:
+            row_seconds = seconds * request.generated_tokens / longest if longest else seconds
+            # Read by the caller once the future resolves (see last_generation_stats)
+            request.future.generation_stats = observe_generation(
+                request.operation, request.prompt_tokens, request.generated_tokens, row_seconds)
+        return texts
+
+    def last_generation_stats(self):
+        """Token counts/throughput of this thread's last generation call, or None."""
+        return getattr(self._generation_stats, 'last', None)
+
+    def _run_batch_on_model(self, requests):
+        pipe = self._get_pipeline()
+        if getattr(pipe, 'simulated', False):
+            return pipe.generate(requests)
+        # Triage turns keep their study's attention cache between turns. A turn that
+        # continues a cache runs alone (see GenerationRequest.batch_key) and only encodes
+        # its new tokens; turns without one run together and store each row's cache.
+        # A streamer belongs to one conversation (see GenerationRequest.batch_key)
+        assert len(requests) == 1 or not any(r.streamer for r in requests), "streaming requests must run alone"
+        if len(requests) == 1 and requests[0].cache_key is not None:
+            request = requests[0]
+            try:
+                return [self._generate_with_cache(request)]
+            except Exception as e:
+                self.kv_cache.discard(request.cache_key)
+                if request.streamer is not None and not request.streamer.next_tokens_are_prompt:
+                    # Generation already wrote to the stream: re-running it would send the answer twice
+                    raise
+                # Transparent fallback: re-encode the whole conversation
+                print(f"KV cache path failed ({e}), falling back to full re-encoding.")
+                return self._run_pipeline(requests)
+        texts = {}
+        keyed = [r for r in requests if r.cache_key is not None]
+        others = [r for r in requests if r.cache_key is None]
+        if keyed:
+            for request, text in zip(keyed, self._generate_batch_with_cache(keyed)):
+                texts[id(request)] = text
+        if others:
+            for request, text in zip(others, self._run_pipeline(others)):
+                texts[id(request)] = text
+        return [texts[id(request)] for request in requests]
+
+    def _run_pipeline(self, requests):
+        """Runs several conversations through the pipeline in a single call."""
+        pipe = self._get_pipeline()
+        first = requests[0]
+        generate_kwargs = {}
+        if first.streamer:
+            # Only ever set on a batch of one
+            generate_kwargs["streamer"] = first.streamer
+        probe = PromptLengthProbe(pad_token_id=1)
+        generate_kwargs["stopping_criteria"] = stopping_criteria_for(pipe.processor.tokenizer, first.stop_format, probe)
+        with torch.inference_mode():
+            outputs = pipe(
+                text=[r.messages for r in requests],
+                batch_size=len(requests),
+                max_new_tokens=first.max_tokens,
+                do_sample=False,
+                pad_token_id=1,
+                repetition_penalty=1.15,
+                generate_kwargs=generate_kwargs
+            )
+        for request, prompt_tokens in zip(requests, probe.prompt_lengths or []):
+            request.prompt_tokens = prompt_tokens
+        # A single conversation may come back unwrapped
+        if outputs and isinstance(outputs[0], dict):
+            outputs = [outputs]
+        return [out[0]["generated_text"][-1]["content"].strip() for out in outputs]
+
+    def _generate_with_cache(self, request):
+        """
+        Generates a triage turn reusing the attention cache of the previous turn,
+        so only the tokens added since then (last answer + new user message) are encoded.
+        """
+        pipe = self._get_pipeline()
+        model, processor = pipe.model, pipe.processor
+        input_ids, prompt_text = self._triage_prompt(request)
+        input_ids = input_ids.to(model.device)
+
+        if len(request.messages) > 2:
+            # System prompt + acknowledgement are identical for every study
+            self._ensure_prefix_cache(request.messages[:2])
+        past_key_values, n_cached = self.kv_cache.lookup(request.cache_key, input_ids)
+
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=input_ids[None],
+                attention_mask=torch.ones_like(input_ids[None]),
+                past_key_values=past_key_values,
+                max_new_tokens=request.max_tokens,
+                do_sample=False,
+                pad_token_id=1,
+                repetition_penalty=1.15,
+                return_dict_in_generate=True,
+                streamer=request.streamer,
+                stopping_criteria=stopping_criteria_for(processor.tokenizer, request.stop_format)
             )
 
-            print("Loading MedGemma 1.5 model...")
-            self._pipe = pipeline(
-                "image-text-to-text",
-                model="google/medgemma-1.5-4b-it",
-                model_kwargs={
-                    "quantization_config": bnb_config,
-                    "low_cpu_mem_usage": True
-                },
-                device_map="auto",
-                token=hf_token
+        sequence = output.sequences[0]
+        request.prompt_tokens = len(input_ids)
+        request.generated_tokens = len(sequence) - len(input_ids)
+        # The cache covers every id but the last generated one
+        self.kv_cache.put(request.cache_key, sequence, output.past_key_values, prompt_text)
+        print(f"KV cache: reused {n_cached}/{len(input_ids)} prompt tokens for study {request.cache_key}")
+        return processor.decode(sequence[len(input_ids):], skip_special_tokens=True).strip()
+
+    def _generate_batch_with_cache(self, requests):
+        """
+        Runs triage turns of several studies in one left-padded generate() call
+        and keeps each row's attention cache for the study's next turn.
+        """
+        pipe = self._get_pipeline()
+        model, processor = pipe.model, pipe.processor
+        prompts = [self._triage_prompt(r) for r in requests]
+        width = max(len(ids) for ids, _ in prompts)
+        input_ids = torch.full((len(requests), width), 1, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, (ids, _) in enumerate(prompts):
+            input_ids[row, width - len(ids):] = ids
+            attention_mask[row, width - len(ids):] = 1
+
+        first = requests[0]
+        with torch.inference_mode():
+            output = model.generate(
+                input_ids=input_ids.to(model.device),
+                attention_mask=attention_mask.to(model.device),
+                max_new_tokens=first.max_tokens,
+                do_sample=False,
+                pad_token_id=1,
+                repetition_penalty=1.15,
+                return_dict_in_generate=True,
+                stopping_criteria=stopping_criteria_for(processor.tokenizer, first.stop_format)
             )
-            print(f"MedGemma 1.5 loaded.")
-        return self._pipe
+
+        # Finished rows are padded until the longest one stops
+        fed = output.past_key_values.get_seq_length()
+        texts, sequences, spans = [], [], []
+        for row, (request, (ids, _)) in enumerate(zip(requests, prompts)):
+            new_ids = output.sequences[row, width:]
+            padding = (new_ids == 1).nonzero()
+            generated = int(padding[0]) if len(padding) else len(new_ids)
+            request.prompt_tokens = len(ids)
+            request.generated_tokens = generated
+            start = width - len(ids)
+            sequences.append(output.sequences[row, start:width + generated])
+            spans.append((start, min(len(ids) + generated - 1, fed - start)))
+            texts.append(processor.decode(new_ids[:generated], skip_special_tokens=True).strip())
+
+        caches = split_batch_cache(output.past_key_values, spans)
+        for request, sequence, cache, (_, prompt_text) in zip(requests, sequences, caches, prompts):
+            if cache is None:
+                self.kv_cache.discard(request.cache_key)
+            else:
+                self.kv_cache.put(request.cache_key, sequence, cache, prompt_text)
+        print(f"KV cache: stored the caches of {sum(c is not None for c in caches)}/{len(requests)} batched triage turns.")
+        return texts
+
+    def _triage_prompt(self, request):
+        """
+        Prompt ids of a triage turn and its rendered text. A conversation that
+        continues its cached turn is appended to the raw ids the model generated
+        (not to the re-tokenized stored answer), so the cache is only extended.
+        """
+        pipe = self._get_pipeline()
+        model, processor = pipe.model, pipe.processor
+        prompt_text = processor.apply_chat_template(request.messages, add_generation_prompt=True, tokenize=False)
+        entry = self.kv_cache.peek(request.cache_key)
+        suffix = _continuation_text(processor, request.messages, entry.prompt_text) if entry and entry.prompt_text else None
+        if suffix is not None:
+            previous = entry.token_ids
+            if int(previous[-1]) in _stop_token_ids(model):
+                # The end of turn marker is part of the continuation text
+                previous = previous[:-1]
+            new_ids = processor.tokenizer(suffix, add_special_tokens=False, return_tensors="pt")["input_ids"][0]
+            return torch.cat([previous, new_ids.to(previous.device)]), prompt_text
+        input_ids = processor.apply_chat_template(
+            request.messages, add_generation_prompt=True, tokenize=True,
+            return_dict=True, return_tensors="pt"
+        )["input_ids"][0]
+        return input_ids, prompt_text
+
+    def _ensure_prefix_cache(self, prefix_messages):
+        pipe = self._get_pipeline()
+        model, processor = pipe.model, pipe.processor
+        prefix_ids = processor.apply_chat_template(
+            prefix_messages, tokenize=True, return_dict=True, return_tensors="pt"
+        )["input_ids"].to(model.device)
+        if self.kv_cache.has_prefix(prefix_ids[0]):
+            return
+        with torch.inference_mode():
+            output = model(input_ids=prefix_ids, use_cache=True)
+        self.kv_cache.put_prefix(prefix_ids[0], output.past_key_values)
+        print(f"KV cache: precomputed shared prefix ({prefix_ids.shape[1]} tokens).")
+
+    def release_triage_cache(self, study_id):
+        """Drops the attention cache of a finished triage conversation."""
+        self.kv_cache.discard(study_id)
+
+    def _get_pipeline(self):
+        if os.environ.get("MOCK_AI") == "True":
+            return "MOCK_MODE"
+        return model_registry.get("medgemma")
 
     def analyze_image(self, image_file_path):
         """Stage 1: Generate technical findings following notebook format."""
-        prompt = (
-            "Describe this medical image. \n"
-            "You must strictly follow this output format:\n"
-            "1. Provide your detailed anatomical observations starting with [OBSERVATIONS].\n"
-            "2. You MUST include a section titled exactly '[IRREGULARITIES]' followed by a explanation of the irregularities in the image.\n"
-            "3. At the very end of your response, you MUST include a section titled exactly '[PATHOLOGIES]' followed by a comma-separated list of the top 1 to 3 possible diseases or conditions.\n"
-            "Example:\n"
-            "[OBSERVATIONS] The image is a lateral view of a human left femur\n"
-            "[IRREGULARITIES] The lesion exhibits irregular borders and uneven coloration\n"
-            "[PATHOLOGIES] Pneumonia, Lung Mass, Tuberculosis\n"
-            "Note: Provide the response in English."
-        )
-        return self._query_model(prompt, image_path=image_file_path, persona="expert")
+        return self._query_model(FINDINGS_PROMPT, image_path=image_file_path, persona="expert", stop_format="findings", operation="findings")
+
+    def findings_cache_version(self):
+        """Identifies the model + prompt that produced cached findings."""
+        return f"{_cache_model_id(MEDGEMMA_MODEL_ID, MEDGEMMA_REVISION, 'nf4')}|findings-v{FINDINGS_PROMPT_VERSION}"
+
+    def symptoms_cache_version(self):
+        model_id = _cache_model_id(MEDGEMMA_MODEL_ID, MEDGEMMA_REVISION, 'nf4')
+        return f"{model_id}|symptoms-v{SYMPTOMS_PROMPT_VERSION}"
 
     def extract_symptoms(self, raw_transcript):
         """Extracts medical symptoms from raw ASR text and formats them as a list."""
@@ -90,36 +490,53 @@ class MedGemma15Processor:
             "1. DO NOT include intros or explanations.\n"
             "2. Return a single descriptive text string."
         )
-        return self._query_model(prompt, persona="expert")
+        return self._query_model(prompt, persona="expert", operation="symptoms")
 
-    def run_triage_step(self, history):
+    def run_triage_step(self, history, cache_key=None):
         """Executes a single step of the triage conversation."""
-        # Use a large token limit for the chat steps
-        output = self._query_model(None, history=history, max_tokens=1500)
+        # Use a large token limit for the chat steps.
+        # cache_key (the study id) keeps the attention cache between turns.
+        # Generation stops once the [ASK]/[DIAGNOSIS] block is complete.
+        output = self._query_model(None, history=self._triage_view(history), max_tokens=1500, cache_key=cache_key, stop_format="triage", operation="triage")
+        return output
+
+    def stream_triage_step(self, history, cache_key=None):
+        """
+        Streaming variant of run_triage_step. Yields raw text chunks as they are
+        generated and returns the cleaned step (use with `yield from`).
+        """
+        pipe = self._get_pipeline()
+        if pipe == "MOCK_MODE":
+            output = self.run_triage_step(history, cache_key=cache_key)
+            yield output
+            return output
+
+        self._generation_stats.last = None
+        with profile_section("query_triage"):
+            streamer = TextIteratorStreamer(pipe.processor.tokenizer, skip_prompt=True, skip_special_tokens=True)
+            future = self._get_scheduler().submit(self._triage_view(history), 1500, cache_key, streamer=streamer,
+                                                  stop_format="triage", operation="triage", profile_id=current_profile_id(),
+                                                  kv_cached=self.kv_cache.has_entry(cache_key))
+            # Clean while streaming instead of re-scanning the whole output at the end
+            cleaner = StreamingOutputCleaner()
+            for chunk in streamer:
+                if chunk:
+                    cleaner.feed(chunk)
+                    yield chunk
+
+            raw_text = future.result() # Re-raises generation errors
+            self._generation_stats.last = getattr(future, 'generation_stats', None)
+            output = cleaner.result() or self._clean_ai_output(raw_text)
+        print(f"AI OUTPUT: {output[:100]}...")
         return output
 
-    def generate_final_soap_report(self, initial_symptoms, findings, triage_history):
+    def generate_final_soap_report(self, study):
         """Stage 3: Generate the final SOAP report after triage completion."""
-        # Extract findings parts
-        obs_text = "See findings."
-        irreg_text = findings
-        path_text = "N/A"
-        
-        if "[OBSERVATIONS]" in findings and "[IRREGULARITIES]" in findings and "[PATHOLOGIES]" in findings:
-            part1 = findings.split("[IRREGULARITIES]")
-            obs_text = part1[0].replace("[OBSERVATIONS]", "").strip()
-            part2 = part1[1].split("[PATHOLOGIES]")
-            irreg_text = part2[0].strip()
-            path_text = part2[1].strip()
-
-        # Find the final diagnosis in triage history
-        final_diagnosis = "Pendiente."
-        for msg in reversed(triage_history):
-            if msg['role'] == 'assistant':
-                text_content = "".join(item.get('text', '') for item in msg['content'])
-                if '[DIAGNOSIS]' in text_content:
-                    final_diagnosis = text_content.split('[DIAGNOSIS]')[-1].strip()
-                    break
+        # Findings and diagnosis were parsed when the model output arrived (see findings.py)
+        initial_symptoms = study.symptoms_text
+        obs_text = study.findings_observations or "See findings."
+        irreg_text = study.findings_irregularities or study.medgemma_result
+        final_diagnosis = study.final_diagnosis or "Pendiente."
 
         report_md = f"""# 🏥 Automated Clinical Triage Report (SOAP)
 
@@ -146,47 +563,31 @@ class MedGemma15Processor:
         return report_md
 
     def _clean_integrated_report(self, raw_text):
-        """Surgically cleans only the integrated report, removing AI plans/thought blocks."""
-        # 1. Recovery: Mandatory start at first header
-        if "##" in raw_text:
-             raw_text = raw_text[raw_text.find("##"):].strip()
-
-        # 2. Rule-Stripper: Remove lines that look like AI planning items or rules
-        lines = raw_text.split('\n')
-        cleaned_lines = []
-        for line in lines:
-            # Skip lines that are just numbers followed by instructions (AI echoing rules)
-            if re.match(r'^\d+[\.\)]\s*(Formal|Integrate|Start|Follow|No internal|Only|Summary|Explain)', line, re.IGNORECASE):
-                continue
-            # Skip common "echo" markers from the prompt rules
-            if any(marker in line for marker in ["FORBIDDEN", "OBLIGATORIO", "REGLAS CRÍTICAS", "EJEMPLO"]):
-                continue
-            cleaned_lines.append(line)
-        
-        cleaned_text = "\n".join(cleaned_lines).strip()
-        
-        # 3. Final polish
-        cleaned_text = re.sub(r'^(thought|reasoning|plan).*?\n', '', cleaned_text, flags=re.IGNORECASE)
-        return cleaned_text
+        return clean_integrated_report(raw_text)
 
     def _clean_ai_output(self, raw_text):
-        """Restoring exact notebook logic: use rfind to get the final decision."""
-        # This matches the Notebook's logic exactly
-        pos_diag = raw_text.rfind("[DIAGNOSIS]")
-        pos_ask = raw_text.rfind("[ASK]")
-        
-        if pos_diag > pos_ask:
-            return raw_text[pos_diag:].strip()
-        elif pos_ask > pos_diag:
-            return raw_text[pos_ask:].strip()
-        else:
-            return raw_text.strip()
+        return clean_ai_output(raw_text)
+
+    def _query_model(self, text, image_path=None, history=None, persona="default", max_tokens=800, cache_key=None, stop_format=None, operation="generate"):
+        self._generation_stats.last = None
+        with profile_section(f"query_{operation}"):
+            pipe = self._get_pipeline()
+            if pipe == "MOCK_MODE":
+                return f"[MOCK] Response for: {text[:50] if text else 'History'}"
+
+            messages = self._build_messages(text, image_path, history, persona)
+
+            # Concurrent callers (several kiosks mid-triage) share micro-batches on the GPU
+            future = self._get_scheduler().submit(messages, max_tokens, cache_key, stop_format=stop_format,
+                                                  operation=operation, profile_id=current_profile_id(),
+                                                  kv_cached=self.kv_cache.has_entry(cache_key))
+            raw_text = future.result()
+            self._generation_stats.last = getattr(future, 'generation_stats', None)
+            raw_text = self._clean_ai_output(raw_text)
+        print(f"AI OUTPUT: {raw_text[:100]}...")
+        return raw_text
 
-    def _query_model(self, text, image_path=None, history=None, persona="default", max_tokens=800):
-        pipe = self._get_pipeline()
-        if pipe == "MOCK_MODE":
-            return f"[MOCK] Response for: {text[:50] if text else 'History'}"
-            
+    def _build_messages(self, text, image_path=None, history=None, persona="default"):
         messages = []
         
         if history:
@@ -204,94 +605,13 @@ class MedGemma15Processor:
                 
             content.append({"type": "text", "text": f"{system_instruction}\n\n{text}"})
             messages = [{"role": "user", "content": content}]
-
-        with torch.inference_mode():
-            output = pipe(
-                text=messages,
-                max_new_tokens=max_tokens,
-                do_sample=False,
-                pad_token_id=1,
-                repetition_penalty=1.15
-            )
-        
-        raw_text = output[0]["generated_text"][-1]["content"].strip()
-        raw_text = self._clean_ai_output(raw_text)
-        print(f"AI OUTPUT: {raw_text[:100]}...")
-        return raw_text
+        return messages
 
     def _extract_medical_sections(self, text):
-        """Surgically extracts ## headers and their content, discarding everything else."""
-        # Find all ## sections. Uses a lookahead to handle sections without newlines between them.
-        sections = re.findall(r'(##\s+[A-ZÁÉÍÓÚÑ -]+.*?(?=##|\Z))', text, re.DOTALL | re.IGNORECASE)
-        valid_sections = []
-        
-        # Keywords that indicate the model is just echoing the prompt instructions
-        noise_keywords = [
-            "Summarize the relationship", "State the medical conclusion", "List the recommended next steps",
-            "(Escribe aquí", "Target Format:", "Plan:", "I will", "I need", "**Plan", "translate"
-        ]
-        
-        for s in sections:
-            header_match = re.search(r'##\s+[A-ZÁÉÍÓÚÑ -]+', s, re.IGNORECASE)
-            if not header_match:
-                continue
-            
-            header = header_match.group(0).strip()
-            content = s[header_match.end():].strip()
-            
-            # Surgically remove any noise keywords from the BEGINNING of the content
-            # (where they are usually echoed as instructions)
-            for nk in noise_keywords:
-                # Remove common leading punctuation after echoes like ":", "**", etc.
-                content = re.sub(rf'^[*:\s-]*{re.escape(nk)}[*:\s-]*', '', content, flags=re.IGNORECASE)
-            
-            # Strip any remaining instruction-like placeholder text
-            content = re.sub(r'^\s*\(.*?\)\s*', '', content)
-            
-            if content and len(content) > 5:
-                valid_sections.append(f"{header}\n{content.strip()}")
-        
-        if valid_sections:
-            return "\n\n".join(valid_sections)
-        return text
+        return extract_medical_sections(text)
 
     def _deduplicate_sentences(self, text):
-        """Removes redundant sentences or keywords that are semantically very similar."""
-        if not text:
-            return ""
-        
-        # Clean up any existing bullet prefixes to avoid "- - -"
-        text = re.sub(r'^[ \-*·•]+', '', text, flags=re.MULTILINE)
-        
-        # Split by typical sentence enders OR common delimiters used by this model (*, -, \n, |)
-        parts = re.split(r'(?<=[.!?]) +|[\n\r\*\|]+', text)
-        unique_parts = []
-        seen_normalized = set()
-
-        for p in parts:
-            p = p.strip()
-            if not p:
-                continue
-            
-            # Remove "FINDINGS:" or "IMPRESSION:" prefix if model repeats it inside the section
-            p = re.sub(r'^(FINDINGS|IMPRESSION|DIAGNOSIS|RESULTADOS|HALLAZGOS):', '', p, flags=re.IGNORECASE).strip()
-            
-            # Normalize for comparison: lowercase, remove punctuation/bullets
-            norm = re.sub(r'[^a-zA-Z0-9]', '', p.lower())
-            
-            # Avoid too short junk but allow common medical short terms (e.g. "CHF")
-            if not norm or len(norm) < 3:
-                continue
-                
-            if norm not in seen_normalized:
-                seen_normalized.add(norm)
-                unique_parts.append(p)
-
-        # Optimization: Limit to top 15 findings to prevent runaway loops
-        unique_parts = unique_parts[:15]
-
-        # Re-format as a clean list for clarity
-        return "\n".join([" - " + s for s in unique_parts]).strip()
+        return deduplicate_sentences(text)
 
 class MedASRProcessor:
     """
@@ -299,7 +619,6 @@ class MedASRProcessor:
     Handles high-accuracy medical audio transcription.
     """
     _instance = None
-    _asr_pipeline = None
 
     def __new__(cls):
         if cls._instance is None:
@@ -309,51 +628,55 @@ class MedASRProcessor:
     def _get_pipeline(self):
         if os.environ.get("MOCK_AI") == "True":
             return "MOCK_MODE"
-            
-        if self._asr_pipeline is None:
-            device = 0 if torch.cuda.is_available() else -1
-            print("Loading MedASR model...")
-            self._asr_pipeline = pipeline(
-                "automatic-speech-recognition",
-                model="google/medasr",
-                device=device,
-            )
-            print("MedASR loaded.")
-        return self._asr_pipeline
+        return model_registry.get("medasr")
+
+    def cache_version(self):
+        """Identifies the model + normalization that produced cached transcripts."""
+        model_id = _cache_model_id(MEDASR_MODEL_ID, MEDASR_REVISION, 'fp32')
+        return f"{model_id}|normalize-v{TRANSCRIPT_NORMALIZATION_VERSION}"
 
     def _normalize_output(self, text):
-        """Standard normalization from user notebook."""
-        if not text:
-            return ""
-        text = text.lower()
-        text = text.replace('</s>', '')
-        # Remove special tokens like <epsilon> if they persist
-        text = text.replace("<epsilon>", "")
-        # Allow Spanish characters: a-z, 0-9, spaces, apostrophes, and accents/ñ
-        text = re.sub(r"[^ a-z0-9'áéíóúñ]", ' ', text)
-        return " ".join(text.split()).strip()
-
-    def transcribe(self, audio_file):
+        return normalize_transcript(text)
+
+    def transcribe(self, audio_file, timings=None, pcm_path=None):
+        """
+        Transcribes patient audio. `pcm_path` points to the 16 kHz waveform written
+        at upload (see media_ingest); when present it is memory-mapped instead of
+        decoding the original file.
+        """
         pipe = self._get_pipeline()
         if pipe == "MOCK_MODE":
             return "[MOCK TRANSCRIPTION] The patient presents mild symptoms of cough and fatigue."
             
-        if not librosa:
+        if not pcm_path and not librosa:
             return "Error: librosa is not installed on the server."
             
         try:
-            # If it's a FieldFile or similar, get the path. If it's already a path, use it.
-            path = audio_file.path if hasattr(audio_file, 'path') else audio_file
-            
-            # Load the audio. librosa.load can take a path string or a file-like object.
-            # We use sr=16000 as required by MedASR.
-            audio, sr = librosa.load(path, sr=16000)
-            # Match the parameters from the user's successful notebook call
-            result = pipe(
-                {"raw": audio, "sampling_rate": sr}, 
-                chunk_length_s=20, 
-                stride_length_s=2
-            )
+            t0 = time.perf_counter()
+            if pcm_path and os.path.exists(pcm_path):
+                audio, sr = load_pcm(pcm_path)
+            else:
+                # If it's a FieldFile or similar, get the path. If it's already a path, use it.
+                path = audio_file.path if hasattr(audio_file, 'path') else audio_file
+                
+                # Load the audio. librosa.load can take a path string or a file-like object.
+                # We use sr=16000 as required by MedASR.
+                audio, sr = librosa.load(path, sr=ASR_SAMPLE_RATE)
+            t1 = time.perf_counter()
+            # Match the parameters from the user's successful notebook call.
+            # Held in use: the idle reaper or another model's load cannot unload it mid-call.
+            with model_registry.use("medasr") as pipe:
+                result = pipe(
+                    {"raw": audio, "sampling_rate": sr},
+                    chunk_length_s=20,
+                    stride_length_s=2
+                )
+            t2 = time.perf_counter()
+            observe_stage('audio_decode', t1 - t0)
+            observe_stage('asr', t2 - t1)
+            if timings is not None:
+                timings['audio_decode'] = round(t1 - t0, 3)
+                timings['asr'] = round(t2 - t1, 3)
             raw_text = result.get("text", "")
             print(f"DEBUG: MedASR raw text: {raw_text}")
             clean_text = self._normalize_output(raw_text)
@@ -362,91 +685,43 @@ class MedASRProcessor:
         except Exception as e:
             return f"Error during transcription: {str(e)}"
 
+# The registry owns loading/unloading; the processors above only hold prompts and logic.
+# Attention caches live in GPU memory tied to the loaded model, so they go with it.
+model_registry.register("medgemma", load_medgemma_pipeline,
+                        estimate_mb=int(os.environ.get("AI_MEDGEMMA_ESTIMATE_MB", 3500)),
+                        on_unload=lambda: MedGemma15Processor.kv_cache.clear())
+model_registry.register("medasr", load_medasr_pipeline,
+                        estimate_mb=int(os.environ.get("AI_MEDASR_ESTIMATE_MB", 600)))
+
 class IntegratedAIProcessor:
     """Coordinates the 2-stage multi-modal workflow."""
     def __init__(self):
-        self.medgemma = MedGemma15Processor()
-        self.medasr = MedASRProcessor()
+        if inference_server_address():
+            # Models live in the shared inference server (manage.py run_inference_server)
+            client = RemoteInferenceClient()
+            self.medgemma = RemoteMedGemma(client)
+            self.medasr = RemoteMedASR(client)
+        else:
+            self.medgemma = MedGemma15Processor()
+            self.medasr = MedASRProcessor()
 
     def process_consultation(self, study):
         print(f"\n--- [AI START] Processing Study #{study.id} ---")
-        # Stage 1: Acquisition (Pure transcription and findings)
-        if study.image:
-            print(f"[{time.strftime('%H:%M:%S')}] 📸 Stage 1.1: Analyzing Medical Image (MedGemma)...")
-            study.medgemma_result = self.medgemma.analyze_image(study.image.path)
-            print(f"[{time.strftime('%H:%M:%S')}] ✅ Image Analysis Done.")
-        
-        raw_transcript = ""
-        if study.symptoms_audio:
-            print(f"[{time.strftime('%H:%M:%S')}] 🎙️ Stage 1.2: Transcribing Patient Audio (MedASR)...")
-            try:
-                # Pass the path string directly to avoid pickling issues with open files
-                audio_path = study.symptoms_audio.path
-                print(f"DEBUG: Processing audio from path: {audio_path}")
-                raw_transcript = self.medasr.transcribe(audio_path)
-            except ValueError:
-                # Fallback if file not saved to disk yet
-                print("DEBUG: Processing audio from FieldFile (not yet on disk)")
-                raw_transcript = self.medasr.transcribe(study.symptoms_audio)
-        
-        if raw_transcript:
-            print(f"[{time.strftime('%H:%M:%S')}] ✨ Stage 1.3: Extracting Medical Symptoms from Transcript...")
-            study.symptoms_text = self.medgemma.extract_symptoms(raw_transcript)
-        else:
-            study.symptoms_text = "No symptoms reported via audio."
-
-        print(f"[{time.strftime('%H:%M:%S')}] 🤖 Stage 2: Initializing Triage Conversation...")
-        TRIAGE_SYSTEM_PROMPT = """You are an automated clinical triage assistant. Your role is to act as a structured intermediary between the patient and the human doctor.
-Your goal is to ask precise questions to narrow down symptoms and generate a short differential pre-diagnosis that will later be reviewed by the doctor.
-
-STRICT OPERATING RULES:
-1. EVALUATION: You will receive the patient's symptoms, objective image irregularities, and a list of 'Suggested Pathologies' from a radiologist AI. Your primary task is to ask targeted questions to differentiate, rule in, or rule out these specific pathologies.
-2. FORMAT RESTRICTION: Every question MUST be strictly multiple-choice, with a maximum of 5 options (letters A, B, C, D, E).
-3. THE LAST OPTION: The last letter of your options MUST ALWAYS be: "None of the above".
-4. QUESTION LIMIT: You must never exceed a maximum of 7 questions throughout the triage.
-5. ACTION TAGS:
-   - To ask, use EXACTLY: [ASK]
-   - To give the result, use EXACTLY: [DIAGNOSIS]
+        started = time.perf_counter()
+        timings = {}
+        generation = {} # Token counts per generation call (see metrics.observe_generation)
 
-STRICT FORMAT FOR ASKING:
-[ASK] [Write your clinical question here]?
-A) [Specific option 1]
-B) [Specific option 2]
-C) [Specific option 3]
-D) [Specific option 4]
-E) None of the above
+        pathologies = self._run_stage_one(study, timings, generation, started)
 
-STRICT FORMAT FOR THE PRE-DIAGNOSIS:
-[DIAGNOSIS]
-* Ranked Pre-diagnosis: 
-  1. [Most Probable Illness] - [Brief reason why it's the top match based on symptoms/imaging]
-  2. [Less Probable Illness] - [Brief reason why it's less likely]
-  3. [Least Probable Illness] - [Brief reason why it's the least likely or what symptom is missing]
-  (Note: Adjust numbering based on the number of suspected conditions provided by the radiologist).
-* Clinical summary (Symptoms + Imaging): [Brief summary cross-referencing what the patient said and what the imaging showed]
-* Suggested urgency level: [Low / Medium / High]
-* Note: This is an AI-generated pre-diagnosis that requires mandatory validation by a human doctor.
-"""
-        findings = study.medgemma_result or ""
-        obs_text = ""
-        irreg_text = ""
-        path_text = ""
-
-        try:
-            if "[OBSERVATIONS]" in findings and "[IRREGULARITIES]" in findings and "[PATHOLOGIES]" in findings:
-                part1 = findings.split("[IRREGULARITIES]")
-                obs_text = part1[0].replace("[OBSERVATIONS]", "").strip()
-                part2 = part1[1].split("[PATHOLOGIES]")
-                irreg_text = part2[0].strip()
-                path_text = part2[1].strip()
-            else:
-                obs_text = "See raw findings."
-                irreg_text = findings
-                path_text = "No structured pathologies provided."
-        except Exception as e:
-            obs_text = "Parsing error."
-            irreg_text = findings
-            path_text = "Error extracting pathologies."
+        print(f"[{time.strftime('%H:%M:%S')}] 🤖 Stage 2: Initializing Triage Conversation...")
+        if study.findings_observations is not None:
+            obs_text = study.findings_observations
+            irreg_text = study.findings_irregularities
+            path_text = ", ".join(pathologies) or "No structured pathologies provided."
+        else:
+            obs_text = "See raw findings."
+            irreg_text = study.medgemma_result or ""
+            path_text = "No structured pathologies provided."
 
         initial_message = f"""
 --- INITIAL PATIENT DATA ---
@@ -467,34 +742,181 @@ Please act as the triage doctor. Analyze this cross-referenced data and begin th
 """
         study.triage_history = [
             {"role": "user", "content": [{"type": "text", "text": TRIAGE_SYSTEM_PROMPT}]},
-            {"role": "assistant", "content": [{"type": "text", "text": "Understood. I am ready to evaluate the patient."}]},
+            {"role": "assistant", "content": [{"type": "text", "text": TRIAGE_ACK}]},
             {"role": "user", "content": [{"type": "text", "text": initial_message}]}
         ]
         
         # Get first question
         print(f"[{time.strftime('%H:%M:%S')}] ❓ Generating first triage question...")
-        first_q = self.medgemma.run_triage_step(study.triage_history)
+        with timed_stage('triage_step', timings, 'first_triage_step'):
+            first_q = self.medgemma.run_triage_step(study.triage_history, cache_key=study.id)
+        stats = self.medgemma.last_generation_stats()
+        if stats:
+            generation['triage'] = [stats]
         study.triage_history.append({"role": "assistant", "content": [{"type": "text", "text": first_q}]})
         
         if "[DIAGNOSIS]" in first_q:
             print(f"[{time.strftime('%H:%M:%S')}] 🏁 Triage finished on first step. Generating final SOAP report...")
             study.triage_completed = True
             study.status = 'COMPLETED'
-            study.combined_ai_analysis = self.medgemma.generate_final_soap_report(
-                study.symptoms_text,
-                study.medgemma_result,
-                study.triage_history
-            )
+            self.medgemma.release_triage_cache(study.id)
+            apply_diagnosis(study, first_q)
+            with timed_stage('soap_build', timings):
+                study.combined_ai_analysis = self.medgemma.generate_final_soap_report(study)
         else:
             study.combined_ai_analysis = first_q # Current output for the user
             study.status = 'PROCESSING'
         
+        timings['total'] = round(time.perf_counter() - started, 3)
+        study.stage_timings = timings
+        study.generation_stats = generation
         study.save()
         print(f"[{time.strftime('%H:%M:%S')}] --- [AI READY] Response generated. ---")
         return study
 
+    def _run_stage_one(self, study, timings, generation, started):
+        """Image findings and transcript/symptoms. Returns the suggested pathologies."""
+        # Stage 1: Acquisition (Pure transcription and findings).
+        # Image analysis and audio decode/ASR use different models, so they run in
+        # parallel; symptom extraction starts as soon as the transcript exists.
+        if study.image and not study.image_model_input:
+            # Studies uploaded before ingest preprocessing existed
+            try:
+                prepare_model_image(study)
+            except MediaValidationError as e:
+                print(f"Warning: could not prepare model image, using the original: {e}")
+
+        # Findings are deterministic (greedy decoding), so identical images reuse them.
+        image_hash = file_sha256(study.image) if study.image else None
+        findings_version = self.medgemma.findings_cache_version()
+        cached_findings = cache_get('FINDINGS', image_hash, findings_version) if image_hash else None
+        if cached_findings is not None:
+            print(f"[{time.strftime('%H:%M:%S')}] ♻️ Stage 1.1: Reusing cached image findings ({image_hash[:12]}).")
+            study.medgemma_result = cached_findings
+            timings['image_analysis_cached'] = True
+
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"study-{study.id}") as executor:
+            run_image = study.image and cached_findings is None
+            # bind_priority: bulk_ingest's model calls stay in the bulk class on these threads
+            image_task = executor.submit(bind_priority(self._run_image_stage), study, timings, generation) if run_image else None
+            audio_task = executor.submit(bind_priority(self._run_audio_stage), study, timings, generation)
+            if image_task:
+                study.medgemma_result = image_task.result()
+                cache_put('FINDINGS', image_hash, findings_version, study.medgemma_result)
+            study.symptoms_text = audio_task.result()
+        timings['stage1_total'] = round(time.perf_counter() - started, 3)
+
+        # Parse the findings once; the triage prompt and the SOAP report use the stored fields
+        pathologies = apply_findings(study)
+        save_pathologies(study, pathologies)
+        return pathologies
+
+    def analyze_archived_study(self, study):
+        """
+        Stage 1 only, for archived cases (manage.py bulk_ingest): findings,
+        pathologies and symptoms are stored, no triage is started.
+        """
+        print(f"\n--- [AI START] Analyzing archived Study #{study.id} ---")
+        started = time.perf_counter()
+        timings = {}
+        generation = {}
+        self._run_stage_one(study, timings, generation, started)
+        study.status = 'COMPLETED'
+        timings['total'] = round(time.perf_counter() - started, 3)
+        study.stage_timings = timings
+        study.generation_stats = generation
+        study.save()
+        return study
+
+    def _run_image_stage(self, study, timings, generation):
+        print(f"[{time.strftime('%H:%M:%S')}] 📸 Stage 1.1: Analyzing Medical Image (MedGemma)...")
+        # Prefer the small derivative written at upload over the full-resolution original
+        image_path = study.image_model_input.path if study.image_model_input else study.image.path
+        with timed_stage('image_analysis', timings):
+            result = self.medgemma.analyze_image(image_path)
+        stats = self.medgemma.last_generation_stats()
+        if stats:
+            generation['findings'] = stats
+        print(f"[{time.strftime('%H:%M:%S')}] ✅ Image Analysis Done.")
+        return result
+
+    def _run_audio_stage(self, study, timings, generation):
+        try:
+            return self._transcribe_and_extract(study, timings, generation)
+        finally:
+            # Runs on a stage thread: release the DB connection it opened
+            connections.close_all()
+
+    def _transcribe_and_extract(self, study, timings, generation):
+        raw_transcript = ""
+        if study.symptoms_audio:
+            # Two-level cache: audio content -> transcript, transcript -> symptoms
+            audio_hash = _try_file_sha256(study.symptoms_audio)
+            asr_version = self.medasr.cache_version()
+            cached_transcript = cache_get('TRANSCRIPT', audio_hash, asr_version) if audio_hash else None
+
+            if cached_transcript is not None:
+                print(f"[{time.strftime('%H:%M:%S')}] ♻️ Stage 1.2: Reusing cached transcript ({audio_hash[:12]}).")
+                raw_transcript = cached_transcript
+                timings['asr_cached'] = True
+            else:
+                print(f"[{time.strftime('%H:%M:%S')}] 🎙️ Stage 1.2: Transcribing Patient Audio (MedASR)...")
+                try:
+                    # Pass the path string directly to avoid pickling issues with open files
+                    audio_path = study.symptoms_audio.path
+                    print(f"DEBUG: Processing audio from path: {audio_path}")
+                    pcm_path = study.symptoms_audio_16k.path if study.symptoms_audio_16k else None
+                    raw_transcript = self.medasr.transcribe(audio_path, timings=timings, pcm_path=pcm_path)
+                except ValueError:
+                    # Fallback if file not saved to disk yet
+                    print("DEBUG: Processing audio from FieldFile (not yet on disk)")
+                    raw_transcript = self.medasr.transcribe(study.symptoms_audio, timings=timings)
+
+                if audio_hash and raw_transcript and not raw_transcript.startswith("Error"):
+                    cache_put('TRANSCRIPT', audio_hash, asr_version, raw_transcript)
+        
+        if not raw_transcript:
+            return "No symptoms reported via audio."
+
+        transcript_hash = text_sha256(raw_transcript)
+        symptoms_version = self.medgemma.symptoms_cache_version()
+        cached_symptoms = cache_get('SYMPTOMS', transcript_hash, symptoms_version)
+        if cached_symptoms is not None:
+            print(f"[{time.strftime('%H:%M:%S')}] ♻️ Stage 1.3: Reusing cached symptom extraction.")
+            timings['symptom_extraction_cached'] = True
+            return cached_symptoms
+
+        print(f"[{time.strftime('%H:%M:%S')}] ✨ Stage 1.3: Extracting Medical Symptoms from Transcript...")
+        with timed_stage('symptom_extraction', timings):
+            symptoms_text = self.medgemma.extract_symptoms(raw_transcript)
+        stats = self.medgemma.last_generation_stats()
+        if stats:
+            generation['symptoms'] = stats
+        cache_put('SYMPTOMS', transcript_hash, symptoms_version, symptoms_text)
+        return symptoms_text
+
     def continue_triage(self, study, user_answer):
         """Processes the user's answer and gets the next step from the triage bot."""
+        self._append_triage_answer(study, user_answer)
+
+        print(f"[{time.strftime('%H:%M:%S')}] 🤖 Processing triage answer and generating next step...")
+        t0 = time.perf_counter()
+        next_step = self.medgemma.run_triage_step(study.triage_history, cache_key=study.id)
+        return self._record_triage_step(study, next_step, time.perf_counter() - t0)
+
+    def stream_triage(self, study, user_answer):
+        """
+        Streaming variant of continue_triage. Yields the next step's text as it is
+        generated; the study is updated and saved once the stream is exhausted.
+        """
+        self._append_triage_answer(study, user_answer)
+
+        print(f"[{time.strftime('%H:%M:%S')}] 🤖 Processing triage answer and streaming next step...")
+        t0 = time.perf_counter()
+        next_step = yield from self.medgemma.stream_triage_step(study.triage_history, cache_key=study.id)
+        self._record_triage_step(study, next_step, time.perf_counter() - t0)
+
+    def _append_triage_answer(self, study, user_answer):
         # Combine user answer with system instruction if limit reached to avoid consecutive 'user' roles
         content_text = f"The patient chose option: {user_answer}"
         
@@ -512,24 +934,30 @@ Please act as the triage doctor. Analyze this cross-referenced data and begin th
         if q_count >= 7:
             content_text += "\n\n[SYSTEM INSTRUCTION]: You have reached the question limit. Issue EXACTLY the final [DIAGNOSIS] format right now based on the information you have. DO NOT ask more questions."
 
-
         study.triage_history.append({"role": "user", "content": [{"type": "text", "text": content_text}]})
 
-        print(f"[{time.strftime('%H:%M:%S')}] 🤖 Processing triage answer and generating next step...")
-        next_step = self.medgemma.run_triage_step(study.triage_history)
+    def _record_triage_step(self, study, next_step, seconds):
         # Ensure next_step is wrapped if it's not already
         study.triage_history.append({"role": "assistant", "content": [{"type": "text", "text": next_step}]})
+
+        observe_stage('triage_step', seconds)
+        timings = study.stage_timings or {}
+        timings.setdefault('triage_steps', []).append(round(seconds, 3))
+        study.stage_timings = timings
+        stats = self.medgemma.last_generation_stats()
+        if stats:
+            study.generation_stats = study.generation_stats or {}
+            study.generation_stats.setdefault('triage', []).append(stats)
         
         if "[DIAGNOSIS]" in next_step:
             print(f"[{time.strftime('%H:%M:%S')}] 🏁 Triage finished. Generating final SOAP report...")
             study.triage_completed = True
             study.status = 'COMPLETED'
+            self.medgemma.release_triage_cache(study.id)
             # Final synthesis
-            study.combined_ai_analysis = self.medgemma.generate_final_soap_report(
-                study.symptoms_text,
-                study.medgemma_result,
-                study.triage_history
-            )
+            apply_diagnosis(study, next_step)
+            with timed_stage('soap_build', study.stage_timings):
+                study.combined_ai_analysis = self.medgemma.generate_final_soap_report(study)
             print(f"[{time.strftime('%H:%M:%S')}] ✅ SOAP Report Generated.")
         else:
             study.combined_ai_analysis = next_step # Still asking
@@ -537,3 +965,34 @@ Please act as the triage doctor. Analyze this cross-referenced data and begin th
             
         study.save()
         return study
+
+
+def _continuation_text(processor, messages, prompt_text):
+    """
+    Chat template text that follows the last answer in `messages`, or None when
+    `messages` does not continue the conversation rendered as `prompt_text`.
+    """
+    last = max((i for i, m in enumerate(messages) if m["role"] == "assistant"), default=None)
+    if last is None:
+        return None
+    # Render with a stand-in for the answer: what precedes it must be the cached prompt
+    stand_in = {"role": "assistant", "content": [{"type": "text", "text": _ANSWER_STAND_IN}]}
+    text = processor.apply_chat_template(messages[:last] + [stand_in] + messages[last + 1:],
+                                         add_generation_prompt=True, tokenize=False)
+    head = prompt_text + _ANSWER_STAND_IN
+    if not text.startswith(head):
+        return None
+    return text[len(head):]
+
+
+def _stop_token_ids(model):
+    eos = model.generation_config.eos_token_id
+    return set(eos if isinstance(eos, (list, tuple)) else [eos]) | {1}
+
+
+def _try_file_sha256(field_file):
+    """Content hash of an uploaded file, or None if it is not on disk yet."""
+    try:
+        return file_sha256(field_file)
+    except (ValueError, OSError):
+        return None
@@ -5,18 +5,24 @@ class ApiConfig(AppConfig):
     name = 'api'
 
     def ready(self):
-        # Pre-load AI models to avoid latency on first request
+        # Warm up AI models in the background so the server starts serving right away
+        # (the readiness endpoint /api/health/ reports when they are loaded).
         # Note: In Windows, the reloader might trigger this twice. 
         # We check for RUN_MAIN to avoid redundant loading.
         if os.environ.get('RUN_MAIN') == 'true' or not os.environ.get('DJANGO_SETTINGS_MODULE'):
             if os.environ.get('MOCK_AI') == 'True':
                 print("Iniciando en MOCK MODE: Saltando carga de modelos IA pesados.")
                 return
+            if os.environ.get('AI_INFERENCE_SERVER'):
+                print("Using the shared inference server: models are not loaded in this process.")
+                return
                 
             try:
-                from .ai_processors import MedGemma15Processor, MedASRProcessor
-                print("Pre-loading AI models...")
-                MedGemma15Processor()._get_pipeline()
-                MedASRProcessor()._get_pipeline()
+                from .model_registry import model_registry
+                from . import ai_processors # Registers the models
+                model_registry.start_idle_reaper()
+                if os.environ.get('AI_MODEL_WARMUP', 'True') == 'True':
+                    print("Warming up AI models in the background...")
+                    model_registry.warmup()
             except Exception as e:
-                print(f"Warning: AI model pre-loading failed: {e}")
+                print(f"Warning: AI model warmup failed: {e}")
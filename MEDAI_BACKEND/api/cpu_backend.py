@@ -0,0 +1,71 @@
+import os
+import torch
+
+DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+}
+
+
+def inference_backend():
+    """
+    'cuda', 'cpu' or 'simulated' (scripted outputs with realistic timing, see
+    simulated_backend.py). AI_BACKEND overrides the default (CUDA when available).
+    """
+    backend = os.environ.get("AI_BACKEND", "").lower()
+    if backend in ('cpu', 'cuda', 'simulated'):
+        return backend
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def cpu_backend_config():
+    """
+    CPU inference settings, from the environment:
+    - AI_CPU_DTYPE: 'fp32' or 'bf16' (default fp32, bf16 needs AVX512-BF16/AMX to pay off).
+    - AI_CPU_QUANTIZE: 'int8' for dynamic int8 quantization of Linear layers, or 'none'.
+    - AI_CPU_THREADS: intra-op threads (default: all physical cores torch sees).
+    - AI_TORCH_COMPILE: 'True' to wrap the forward pass with torch.compile.
+    """
+    return {
+        'dtype': os.environ.get("AI_CPU_DTYPE", "fp32").lower(),
+        'quantize': os.environ.get("AI_CPU_QUANTIZE", "int8").lower(),
+        'threads': int(os.environ.get("AI_CPU_THREADS", 0)) or None,
+        'compile': os.environ.get("AI_TORCH_COMPILE") == "True",
+    }
+
+
+def load_dtype(config):
+    # Dynamic int8 quantization works on fp32 weights
+    if config['quantize'] == 'int8':
+        return torch.float32
+    if config['dtype'] not in DTYPES:
+        raise ValueError(f"Unsupported AI_CPU_DTYPE: {config['dtype']} (use {', '.join(DTYPES)})")
+    return DTYPES[config['dtype']]
+
+
+def configure_threads(threads):
+    """Pins the intra-op thread pool. Must run before the first inference call."""
+    if threads:
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass # Already set once inter-op work has started
+    return torch.get_num_threads()
+
+
+def optimize_for_cpu(model, config):
+    """Applies the configured quantization / compilation to a model loaded on CPU."""
+    model.eval()
+    if config['quantize'] == 'int8':
+        torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    elif config['quantize'] not in ('none', ''):
+        raise ValueError(f"Unsupported AI_CPU_QUANTIZE: {config['quantize']} (use int8 or none)")
+    if config['compile']:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+def describe(config):
+    quant = config['quantize'] if config['quantize'] not in ('none', '') else config['dtype']
+    return f"cpu/{quant}/threads={torch.get_num_threads()}{'/compiled' if config['compile'] else ''}"
@@ -0,0 +1,104 @@
+import re
+
+_SECTION = re.compile(r"\[(OBSERVATIONS|IRREGULARITIES|PATHOLOGIES)\]")
+_LIST_SPLIT = re.compile(r"[,;\n]")
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[\.\)])\s*")
+_RANKED_BLOCK = re.compile(r"Ranked Pre-diagnosis\s*:?(.*?)(?=\*\s*Clinical summary|\*\s*Suggested urgency|$)", re.IGNORECASE | re.DOTALL)
+# Items may or may not be on their own line ("...:1. Pneumonia - [...]2. Lung Mass - [...]")
+_RANKED_ITEM = re.compile(r"(?<!\w)(\d{1,2})[\.\)]\s*")
+_URGENCY = re.compile(r"urgency level\s*:?\s*\**\s*\[?\s*(low|medium|high)", re.IGNORECASE)
+
+URGENCY_CHOICES = [
+    ('LOW', 'Low'),
+    ('MEDIUM', 'Medium'),
+    ('HIGH', 'High'),
+]
+
+
+def parse_findings(text):
+    """
+    Splits MedGemma image findings into their [OBSERVATIONS], [IRREGULARITIES]
+    and [PATHOLOGIES] sections. Returns None if the output is not structured.
+    """
+    text = text or ""
+    parts = _SECTION.split(text)
+    sections = {name: body.strip() for name, body in zip(parts[1::2], parts[2::2])}
+    if set(sections) != {'OBSERVATIONS', 'IRREGULARITIES', 'PATHOLOGIES'}:
+        return None
+    return {
+        'observations': sections['OBSERVATIONS'],
+        'irregularities': sections['IRREGULARITIES'],
+        'pathologies': parse_pathology_list(sections['PATHOLOGIES']),
+    }
+
+
+def parse_pathology_list(text):
+    """'Pneumonia, Lung Mass, Tuberculosis.' -> ['Pneumonia', 'Lung Mass', 'Tuberculosis']"""
+    # Stop at the first blank line: anything after the list is trailing model chatter
+    text = text.strip().split("\n\n")[0]
+    names = []
+    for item in _LIST_SPLIT.split(text):
+        item = _LIST_MARKER.sub("", item).strip(" .*:")
+        if item and normalize_pathology(item) not in [normalize_pathology(n) for n in names]:
+            names.append(item)
+    return names
+
+
+def normalize_pathology(name):
+    """Lookup key for a pathology name: lowercase, single-spaced, no parenthetical notes."""
+    name = re.sub(r"\(.*?\)", "", name)
+    return " ".join(name.lower().split())[:120]
+
+
+def parse_diagnosis(text):
+    """
+    Extracts the final [DIAGNOSIS] block of a triage step: the full text, the
+    ranked conditions and the suggested urgency (LOW/MEDIUM/HIGH or None).
+    """
+    text = (text or "").split("[DIAGNOSIS]")[-1].strip()
+    ranked = []
+    block = _RANKED_BLOCK.search(text)
+    parts = _RANKED_ITEM.split(block.group(1)) if block else []
+    for rank, item in zip(parts[1::2], parts[2::2]):
+        if int(rank) != len(ranked) + 1:
+            # A number inside a reason ("... for 2) weeks"), not the next item
+            if ranked:
+                ranked[-1]['reason'] += f" {rank}. {item.strip()}"
+            continue
+        condition, _, reason = item.strip().partition(" - ")
+        ranked.append({'rank': int(rank), 'condition': condition.strip(" *[]"), 'reason': reason.strip(" *[]\n")})
+    urgency = _URGENCY.search(text)
+    return {
+        'text': text,
+        'ranked': ranked,
+        'urgency': urgency.group(1).upper() if urgency else None,
+    }
+
+
+def apply_findings(study):
+    """Stores the parsed image findings on the study (pathology rows are written by save_pathologies)."""
+    parsed = parse_findings(study.medgemma_result)
+    if parsed is None:
+        study.findings_observations = None
+        study.findings_irregularities = None
+        return []
+    study.findings_observations = parsed['observations']
+    study.findings_irregularities = parsed['irregularities']
+    return parsed['pathologies']
+
+
+def apply_diagnosis(study, diagnosis_text):
+    parsed = parse_diagnosis(diagnosis_text)
+    study.final_diagnosis = parsed['text']
+    study.ranked_diagnosis = parsed['ranked']
+    study.urgency = parsed['urgency']
+
+
+def save_pathologies(study, names):
+    """Replaces the study's normalized pathology rows (rank 1 = most likely)."""
+    from .models import StudyPathology
+    study.pathologies.all().delete()
+    StudyPathology.objects.bulk_create([
+        StudyPathology(study=study, name=normalize_pathology(label), label=label[:200], rank=rank)
+        for rank, label in enumerate(names, start=1)
+    ])
@@ -0,0 +1,214 @@
+import json
+import time
+import hashlib
+import threading
+from datetime import timedelta
+from functools import wraps
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from .models import IdempotencyKey
+from .metrics import IDEMPOTENT_REQUESTS
+
+# Retries of a POST that carry the same `Idempotency-Key` header run it only once.
+# A retry that arrives while the first request is still running waits for it and
+# gets its response (single flight); a later one gets the stored response again.
+# Only successful (2xx) responses are stored: after an error the key can be retried.
+
+KEY_HEADER = 'HTTP_IDEMPOTENCY_KEY' # Idempotency-Key: <client-generated id, e.g. a UUID>
+REPLAYED_HEADER = 'Idempotent-Replayed'
+POLL_INTERVAL = 0.5 # seconds, waiting on a request running in another process
+PURGE_INTERVAL = 600 # seconds between deletions of expired keys
+
+# Requests running in this process: (scope, key) -> Event set when they finish
+_inflight = {}
+_inflight_lock = threading.Lock()
+_last_purge = 0.0
+
+
+def idempotent(scope):
+    """
+    Decorator for APIView methods. `scope` names the endpoint and may use the URL
+    kwargs, e.g. "triage:{pk}"; the same key can be reused on another scope.
+    """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.META.get(KEY_HEADER, '').strip()
+            if not key:
+                return method(self, request, *args, **kwargs)
+            if len(key) > 255:
+                return Response({"error": "Idempotency-Key is too long (max 255 characters)."},
+                                status=status.HTTP_400_BAD_REQUEST)
+            name = scope.format(**kwargs)
+            return _run_once(lambda: method(self, request, *args, **kwargs), name, key, request_fingerprint(request))
+        return wrapper
+    return decorator
+
+
+def request_fingerprint(request):
+    """sha256 of the submitted fields and file contents: a key reused for another request is rejected."""
+    digest = hashlib.sha256()
+    data = request.data
+    for name in sorted(data.keys()):
+        values = data.getlist(name) if hasattr(data, 'getlist') else [data[name]]
+        for value in values:
+            digest.update(name.encode() + b'\0')
+            if hasattr(value, 'chunks'):
+                for chunk in value.chunks():
+                    digest.update(chunk)
+                value.seek(0)
+            else:
+                digest.update(json.dumps(value, sort_keys=True, cls=JSONEncoder).encode())
+            digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def _run_once(run, scope, key, fingerprint):
+    deadline = time.monotonic() + settings.AI_IDEMPOTENCY_WAIT_SECONDS
+    coalesced = False
+    while True:
+        record, created = _claim(scope, key, fingerprint)
+        if created:
+            IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='new')
+            return _execute(run, record)
+        # record is None when the running request failed and released the key in the
+        # meantime: claim it again after the usual wait, within the same deadline
+        if record is not None:
+            if record.request_hash != fingerprint:
+                return _mismatch_response(scope)
+            if record.status == 'COMPLETED':
+                IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='coalesced' if coalesced else 'replayed')
+                response = Response(record.response_body, status=record.response_status)
+                response[REPLAYED_HEADER] = 'true'
+                return response
+            if _take_over_if_stale(record):
+                print(f"[{time.strftime('%H:%M:%S')}] ⚠️ Idempotency key {key} ({scope}) was left running, retrying it.")
+                return _execute(run, record)
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='timeout')
+            return _in_progress_response()
+        # Attach to the running request instead of starting the work again
+        coalesced = True
+        with _inflight_lock:
+            event = _inflight.get((scope, key))
+        if event is not None:
+            event.wait(remaining)
+        else:
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+
+def claim_stream(request, scope, replay):
+    """
+    Idempotency-Key for streaming responses, which a retry cannot join while they
+    run. Returns (record, None) when this request owns the key (record is None
+    without a key) and must then call finish_stream(), or (None, response) for a
+    retry: 409 while the original is streaming, `replay(stored body)` once it
+    completed, 422 for a different request.
+    """
+    key = request.META.get(KEY_HEADER, '').strip()
+    if not key:
+        return None, None
+    if len(key) > 255:
+        return None, Response({"error": "Idempotency-Key is too long (max 255 characters)."},
+                              status=status.HTTP_400_BAD_REQUEST)
+    fingerprint = request_fingerprint(request)
+    record, created = _claim(scope, key, fingerprint)
+    if record is None:
+        # The original just failed and released the key: this retry may run it
+        record, created = _claim(scope, key, fingerprint)
+    if record is not None and not created and record.request_hash != fingerprint:
+        return None, _mismatch_response(scope)
+    if created or (record is not None and record.status != 'COMPLETED' and _take_over_if_stale(record)):
+        IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='new')
+        return record, None
+    if record is None or record.status != 'COMPLETED':
+        IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='in_progress')
+        return None, _in_progress_response()
+    IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='replayed')
+    response = replay(record.response_body)
+    response[REPLAYED_HEADER] = 'true'
+    return None, response
+
+
+def finish_stream(record, body=None):
+    """Stores the final payload of a stream claimed with claim_stream(), or releases the key if `body` is None."""
+    if record is None:
+        return
+    if body is None:
+        record.delete()
+        return
+    record.status = 'COMPLETED'
+    record.response_status = status.HTTP_200_OK
+    record.response_body = json.loads(json.dumps(body, cls=JSONEncoder))
+    record.save(update_fields=['status', 'response_status', 'response_body', 'updated_at'])
+
+
+def _mismatch_response(scope):
+    IDEMPOTENT_REQUESTS.inc(scope=scope.split(':')[0], outcome='mismatch')
+    return Response({"error": "This Idempotency-Key was already used for a different request."},
+                    status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+def _in_progress_response():
+    response = Response({"error": "A request with this Idempotency-Key is still being processed."},
+                        status=status.HTTP_409_CONFLICT)
+    response['Retry-After'] = str(max(1, round(settings.AI_IDEMPOTENCY_WAIT_SECONDS / 4)))
+    return response
+
+
+def _claim(scope, key, fingerprint):
+    """Returns (record, True) if this request owns the key, else the existing record (or None if it just vanished)."""
+    _purge_expired()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(scope=scope, key=key, request_hash=fingerprint), True
+    except IntegrityError:
+        return IdempotencyKey.objects.filter(scope=scope, key=key).first(), False
+
+
+def _take_over_if_stale(record):
+    """Claims a key left IN_PROGRESS by a process that crashed or was killed."""
+    cutoff = timezone.now() - timedelta(seconds=settings.AI_IDEMPOTENCY_LOCK_SECONDS)
+    if record.updated_at >= cutoff:
+        return False
+    return IdempotencyKey.objects.filter(
+        id=record.id, status='IN_PROGRESS', updated_at=record.updated_at
+    ).update(updated_at=timezone.now()) == 1
+
+
+def _execute(run, record):
+    event = threading.Event()
+    with _inflight_lock:
+        _inflight[(record.scope, record.key)] = event
+    try:
+        response = run()
+        if 200 <= response.status_code < 300 and hasattr(response, 'data'):
+            record.status = 'COMPLETED'
+            record.response_status = response.status_code
+            record.response_body = json.loads(json.dumps(response.data, cls=JSONEncoder))
+            record.save(update_fields=['status', 'response_status', 'response_body', 'updated_at'])
+        else:
+            record.delete() # Errors are not replayed: the client may fix the request or retry later
+        return response
+    except Exception:
+        record.delete()
+        raise
+    finally:
+        with _inflight_lock:
+            _inflight.pop((record.scope, record.key), None)
+        event.set()
+
+
+def _purge_expired():
+    global _last_purge
+    if time.monotonic() - _last_purge < PURGE_INTERVAL:
+        return
+    _last_purge = time.monotonic()
+    cutoff = timezone.now() - timedelta(hours=settings.AI_IDEMPOTENCY_TTL_HOURS)
+    IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()
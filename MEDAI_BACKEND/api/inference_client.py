@@ -0,0 +1,141 @@
+import os
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+
+def inference_server_address():
+    """
+    Address of the shared inference server from AI_INFERENCE_SERVER, or None to
+    run the models in-process. Accepts "host:port" or "unix:/path/to/socket".
+    """
+    value = os.environ.get("AI_INFERENCE_SERVER", "").strip()
+    if not value:
+        return None
+    if value.startswith("unix:"):
+        return value[len("unix:"):]
+    host, _, port = value.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+class InferenceServerError(Exception):
+    """Raised when the inference server reports an error or cannot be reached."""
+    pass
+
+
+# Requests travel pickled, and unpickling runs code: whoever knows the authkey can
+# execute anything as the server's user. There is no default key on purpose.
+MIN_AUTHKEY_LENGTH = 16
+
+
+def inference_authkey():
+    """Shared secret from AI_INFERENCE_AUTHKEY. Raises InferenceServerError if missing or too short."""
+    key = os.environ.get("AI_INFERENCE_AUTHKEY", "")
+    if len(key) < MIN_AUTHKEY_LENGTH:
+        raise InferenceServerError(
+            f"AI_INFERENCE_AUTHKEY must be set to a secret of at least {MIN_AUTHKEY_LENGTH} characters "
+            "(e.g. `python -c \"import secrets; print(secrets.token_hex(32))\"`) in the inference server "
+            "and in every process that uses it."
+        )
+    return key.encode()
+
+
+class RemoteInferenceClient:
+    """Sends one request per connection to the inference server (see run_inference_server)."""
+    def __init__(self, address=None):
+        self.address = address or inference_server_address()
+
+    def call(self, op, *args, **kwargs):
+        with self._connect() as conn:
+            conn.send(self._request(op, args, kwargs))
+            return self._receive(conn)
+
+    def stream(self, op, *args, **kwargs):
+        """Yields streamed chunks and returns the final result (use with `yield from`)."""
+        with self._connect() as conn:
+            conn.send(self._request(op, args, kwargs))
+            while True:
+                message = conn.recv()
+                if 'chunk' in message:
+                    yield message['chunk']
+                    continue
+                return self._unwrap(message)
+
+    def _request(self, op, args, kwargs):
+        from .inference_scheduler import current_priority
+        # The server's scheduler orders requests by the caller's priority class
+        return {'op': op, 'args': args, 'kwargs': kwargs, 'priority': current_priority()}
+
+    def status(self):
+        return self.call('status')
+
+    def _connect(self):
+        try:
+            return Client(self.address, authkey=inference_authkey())
+        except OSError as e:
+            raise InferenceServerError(f"Cannot reach the inference server at {self.address}: {e}")
+        except AuthenticationError:
+            raise InferenceServerError(f"The inference server at {self.address} rejected AI_INFERENCE_AUTHKEY.")
+
+    def _receive(self, conn):
+        return self._unwrap(conn.recv())
+
+    def _unwrap(self, message):
+        if not message.get('ok'):
+            raise InferenceServerError(message.get('error', 'Unknown inference server error'))
+        return message.get('result')
+
+
+class RemoteMedGemma:
+    """Drop-in for MedGemma15Processor that runs generation on the inference server."""
+    def __init__(self, client):
+        self.client = client
+        # Prompt/report helpers that do not touch the model run locally
+        from .ai_processors import MedGemma15Processor
+        self._local = MedGemma15Processor()
+
+    def analyze_image(self, image_file_path):
+        return self.client.call('analyze_image', str(image_file_path))
+
+    def extract_symptoms(self, raw_transcript):
+        return self.client.call('extract_symptoms', raw_transcript)
+
+    def run_triage_step(self, history, cache_key=None):
+        return self.client.call('run_triage_step', history, cache_key=cache_key)
+
+    def stream_triage_step(self, history, cache_key=None):
+        return (yield from self.client.stream('stream_triage_step', history, cache_key=cache_key))
+
+    def release_triage_cache(self, study_id):
+        return self.client.call('release_triage_cache', study_id)
+
+    def last_generation_stats(self):
+        # Token metrics are recorded by the inference server process
+        return None
+
+    def generate_final_soap_report(self, study):
+        return self._local.generate_final_soap_report(study)
+
+    def findings_cache_version(self):
+        return self._local.findings_cache_version()
+
+    def symptoms_cache_version(self):
+        return self._local.symptoms_cache_version()
+
+
+class RemoteMedASR:
+    """Drop-in for MedASRProcessor that runs transcription on the inference server."""
+    def __init__(self, client):
+        self.client = client
+        from .ai_processors import MedASRProcessor
+        self._local = MedASRProcessor()
+
+    def transcribe(self, audio_file, timings=None, pcm_path=None):
+        # The server shares the media directory, so only paths travel over the socket
+        path = audio_file.path if hasattr(audio_file, 'path') else str(audio_file)
+        text, remote_timings = self.client.call('transcribe', path, pcm_path=pcm_path)
+        if timings is not None:
+            timings.update(remote_timings)
+        return text
+
+    def cache_version(self):
+        return self._local.cache_version()
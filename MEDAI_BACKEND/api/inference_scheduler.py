@@ -0,0 +1,215 @@
+import os
+import time
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import Future
+from .metrics import QUEUE_WAIT_SECONDS, GENERATION_QUEUE_DEPTH, GENERATION_QUEUE_WAIT_SECONDS, GENERATION_AGED_TOTAL
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Priority classes, most urgent first. A patient waiting at the kiosk for the next
+# triage question goes before the analysis of a new upload, which goes before
+# archive backfills (manage.py bulk_ingest).
+PRIORITIES = ('interactive', 'analysis', 'bulk')
+# Class used when the caller did not set one with inference_priority()
+OPERATION_PRIORITIES = {'triage': 'interactive'}
+
+_state = threading.local()
+
+
+def current_priority():
+    """Priority class set on this thread by inference_priority(), or None."""
+    return getattr(_state, 'priority', None)
+
+
+@contextmanager
+def inference_priority(priority):
+    """Runs the model calls made inside the block (on this thread) with the given priority class."""
+    if priority is not None and priority not in PRIORITIES:
+        raise ValueError(f"Unknown inference priority: {priority}")
+    previous = current_priority()
+    _state.priority = priority
+    try:
+        yield
+    finally:
+        _state.priority = previous
+
+
+def bind_priority(fn):
+    """Wraps `fn` so it keeps the caller's priority class when run on another thread."""
+    priority = current_priority()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with inference_priority(priority):
+            return fn(*args, **kwargs)
+    return wrapper
+
+
+class GenerationRequest:
+    """A single pending generation call waiting for a batch slot."""
+    def __init__(self, messages, max_tokens, cache_key=None, streamer=None, stop_format=None, operation="generate", profile_id=None, priority=None,
+                 kv_cached=False):
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.cache_key = cache_key
+        self.kv_cached = kv_cached # The backend holds an attention cache for cache_key
+        self.streamer = streamer
+        self.stop_format = stop_format
+        self.operation = operation # Metrics label (findings, symptoms, triage)
+        self.profile_id = profile_id # Set when the caller is being profiled (see profiling.py)
+        self.priority = priority or current_priority() or OPERATION_PRIORITIES.get(operation, 'analysis')
+        self.future = Future()
+        self.enqueued_at = time.monotonic()
+        # Filled in by the generation backend when it knows them
+        self.prompt_tokens = None
+        self.generated_tokens = None
+
+    @property
+    def batch_key(self):
+        # Only requests sharing generation parameters can run in the same pipe() call.
+        # Requests tied to a token streamer run on their own, and so do turns continuing
+        # an attention cache (only their new tokens are encoded). Triage turns of studies
+        # without a cache batch together and the backend keeps each row's cache.
+        if self.streamer is not None or self.kv_cached:
+            return id(self)
+        return (self.max_tokens, self.stop_format)
+
+
+class BatchingScheduler:
+    """
+    Collects concurrent generation requests into micro-batches.
+    A single background thread owns the GPU: it waits up to `batch_window_ms`
+    for compatible requests, runs them together and resolves each caller's future.
+
+    Pending requests are served by priority class (see PRIORITIES), oldest first
+    within a class. Every `aging_seconds` spent waiting moves a request up one
+    class, so bulk work still progresses during a burst of uploads, but never
+    ahead of an interactive request unless it has waited `max_wait_seconds`: the
+    triage latency holds during bursts and nothing waits forever. A batch that is
+    already running is never interrupted.
+    """
+    def __init__(self, run_batch, max_batch_size=None, batch_window_ms=None, memory_per_request_mb=None,
+                 aging_seconds=None, max_wait_seconds=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size or int(os.environ.get("AI_BATCH_MAX_SIZE", 4))
+        self.batch_window = (batch_window_ms if batch_window_ms is not None
+                             else float(os.environ.get("AI_BATCH_WINDOW_MS", 25))) / 1000.0
+        self.memory_per_request = (memory_per_request_mb or int(os.environ.get("AI_BATCH_MEMORY_PER_REQUEST_MB", 512))) * 1024 * 1024
+        self.aging_seconds = aging_seconds or float(os.environ.get("AI_SCHEDULER_AGING_SECONDS", 10))
+        self.max_wait = max_wait_seconds or float(os.environ.get("AI_SCHEDULER_MAX_WAIT_SECONDS", 120))
+        # Lowered after an out-of-memory error, slowly raised again after successful batches
+        self.oom_cap = self.max_batch_size
+
+        self._pending = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._loop, name="medgemma-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, messages, max_tokens, cache_key=None, streamer=None, stop_format=None, operation="generate", profile_id=None, priority=None,
+               kv_cached=False):
+        """Queues a generation request and returns a Future with the raw model text."""
+        request = GenerationRequest(messages, max_tokens, cache_key, streamer, stop_format, operation, profile_id, priority, kv_cached)
+        with self._cond:
+            self._pending.append(request)
+            self._update_depth()
+            self._cond.notify()
+        return request.future
+
+    def queue_depth(self):
+        """Pending requests per priority class."""
+        with self._cond:
+            return {p: sum(1 for r in self._pending if r.priority == p) for p in PRIORITIES}
+
+    def _rank(self, request, now):
+        waited = now - request.enqueued_at
+        level = PRIORITIES.index(request.priority)
+        if level and waited < self.max_wait:
+            level = max(0.5, level - waited / self.aging_seconds) # Just behind interactive at most
+        elif level:
+            level = -1 # Starving: oldest first, ahead of everything
+        return (level, request.enqueued_at)
+
+    def _update_depth(self):
+        for p in PRIORITIES:
+            GENERATION_QUEUE_DEPTH.set(sum(1 for r in self._pending if r.priority == p), priority=p)
+
+    def _adaptive_batch_size(self):
+        """Largest batch that fits in the currently free accelerator memory."""
+        limit = min(self.max_batch_size, self.oom_cap)
+        if torch is not None and torch.cuda.is_available():
+            try:
+                free_bytes, _ = torch.cuda.mem_get_info()
+                limit = min(limit, int(free_bytes * 0.9 // self.memory_per_request))
+            except RuntimeError:
+                pass
+        return max(1, limit)
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+
+            # Give concurrent callers a short window to join the batch of the most
+            # urgent request (which can change while waiting)
+            batch_size = self._adaptive_batch_size()
+            while True:
+                head = min(self._pending, key=lambda r: self._rank(r, time.monotonic()))
+                compatible = [r for r in self._pending if r.batch_key == head.batch_key]
+                remaining = head.enqueued_at + self.batch_window - time.monotonic()
+                if len(compatible) >= batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            now = time.monotonic()
+            batch = sorted(compatible, key=lambda r: self._rank(r, now))[:batch_size]
+            self._pending = [r for r in self._pending if r not in batch]
+            self._update_depth()
+            head_class = PRIORITIES.index(head.priority)
+            if any(PRIORITIES.index(r.priority) < head_class for r in self._pending):
+                # Ran ahead of more urgent work that was waiting
+                GENERATION_AGED_TOTAL.inc(priority=head.priority)
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            self._execute(batch)
+
+    def _execute(self, batch):
+        started = time.monotonic()
+        for r in batch:
+            QUEUE_WAIT_SECONDS.observe(started - r.enqueued_at, queue="generation")
+            GENERATION_QUEUE_WAIT_SECONDS.observe(started - r.enqueued_at, priority=r.priority)
+        try:
+            results = self.run_batch(batch)
+        except Exception as e:
+            if len(batch) > 1 and _is_oom(e):
+                # Shrink the batch and retry the halves instead of failing everyone
+                self.oom_cap = max(1, len(batch) // 2)
+                print(f"[{time.strftime('%H:%M:%S')}] ⚠️ Out of memory with batch of {len(batch)}, retrying with {self.oom_cap}.")
+                if torch is not None and torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+                half = len(batch) // 2
+                self._execute(batch[:half])
+                self._execute(batch[half:])
+                return
+            for r in batch:
+                if r.streamer is not None:
+                    # Unblock the consumer iterating over the stream
+                    r.streamer.end()
+                r.future.set_exception(e)
+            return
+
+        if self.oom_cap < self.max_batch_size:
+            self.oom_cap += 1
+        for r, text in zip(batch, results):
+            r.future.set_result(text)
+
+
+def _is_oom(error):
+    return "out of memory" in str(error).lower()
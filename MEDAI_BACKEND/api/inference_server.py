@@ -0,0 +1,115 @@
+import os
+import time
+import socket
+import struct
+import threading
+import traceback
+from multiprocessing.connection import Listener, AuthenticationError, answer_challenge, deliver_challenge
+from .inference_client import inference_authkey
+from .inference_scheduler import inference_priority
+from .model_registry import model_registry
+
+HANDSHAKE_TIMEOUT = 10 # seconds a client has to answer the authkey challenge
+
+
+class InferenceServer:
+    """
+    Holds the only copy of the AI models and serves them to every web/worker
+    process over a local socket, so the HTTP tier can run many processes.
+    Each connection carries one request and is handled on its own thread; GPU
+    work is still serialized and micro-batched by the MedGemma scheduler.
+    """
+    def __init__(self, address):
+        from .ai_processors import MedGemma15Processor, MedASRProcessor
+        self.address = address
+        self.medgemma = MedGemma15Processor()
+        self.medasr = MedASRProcessor()
+
+    def serve_forever(self):
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address) # Stale socket from a previous run
+
+        authkey = inference_authkey() # Refuses to start without a real secret
+        # No authkey on the Listener: accept() would run the challenge on this (only)
+        # accepting thread, where one stalled client blocks every other one
+        with Listener(self.address) as listener:
+            if isinstance(self.address, str):
+                os.chmod(self.address, 0o600) # Only this user can connect to the socket
+            print(f"[{time.strftime('%H:%M:%S')}] 🧠 Inference server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except OSError as e:
+                    print(f"Warning: could not accept inference connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn, authkey), daemon=True).start()
+
+    def _handle(self, conn, authkey):
+        with conn:
+            try:
+                _set_timeout(conn, HANDSHAKE_TIMEOUT)
+                deliver_challenge(conn, authkey)
+                answer_challenge(conn, authkey)
+                _set_timeout(conn, 0) # Requests may legitimately take minutes
+            except (OSError, EOFError, AuthenticationError) as e:
+                print(f"Warning: rejected inference connection: {e}")
+                return
+            try:
+                request = conn.recv()
+            except EOFError:
+                return
+
+            op = request.get('op')
+            args = request.get('args', ())
+            kwargs = request.get('kwargs', {})
+            try:
+                with inference_priority(request.get('priority')):
+                    if op == 'stream_triage_step':
+                        result = self._stream(conn, self.medgemma.stream_triage_step(*args, **kwargs))
+                    else:
+                        result = self._dispatch(op, args, kwargs)
+                conn.send({'ok': True, 'result': result})
+            except Exception as e:
+                traceback.print_exc()
+                try:
+                    conn.send({'ok': False, 'error': f"{type(e).__name__}: {e}"})
+                except OSError:
+                    pass # Client went away
+
+    def _stream(self, conn, generator):
+        while True:
+            try:
+                chunk = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            conn.send({'chunk': chunk})
+
+    def _dispatch(self, op, args, kwargs):
+        if op == 'analyze_image':
+            return self.medgemma.analyze_image(*args, **kwargs)
+        if op == 'extract_symptoms':
+            return self.medgemma.extract_symptoms(*args, **kwargs)
+        if op == 'run_triage_step':
+            return self.medgemma.run_triage_step(*args, **kwargs)
+        if op == 'release_triage_cache':
+            return self.medgemma.release_triage_cache(*args, **kwargs)
+        if op == 'transcribe':
+            timings = {}
+            text = self.medasr.transcribe(*args, timings=timings, **kwargs)
+            return text, timings
+        if op == 'status':
+            return {
+                'ready': os.environ.get("MOCK_AI") == "True" or model_registry.is_ready(),
+                'models': model_registry.status(),
+            }
+        raise ValueError(f"Unknown inference operation: {op}")
+
+
+def _set_timeout(conn, seconds):
+    """Timeout of blocking reads/writes on the connection's socket (0: none)."""
+    # SO_RCVTIMEO also applies to the os.read() calls of Connection; settimeout()
+    # would make the shared file descriptor non-blocking instead
+    timeval = struct.pack('ll', int(seconds), 0)
+    with socket.socket(fileno=os.dup(conn.fileno())) as sock:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeval)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeval)
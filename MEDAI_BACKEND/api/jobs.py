@@ -0,0 +1,169 @@
+import time
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from .models import ConsultationJob, MedicalHistory
+from .metrics import QUEUE_WAIT_SECONDS
+
+BACKLOG_WINDOW_SECONDS = 600 # Finished jobs used to estimate the worker throughput
+
+
+def enqueue_consultation(study):
+    """Queues the AI consultation pipeline for a freshly uploaded study."""
+    study.status = 'PENDING'
+    study.save(update_fields=['status', 'updated_at'])
+    return ConsultationJob.objects.create(
+        study=study,
+        max_attempts=settings.AI_JOB_MAX_ATTEMPTS
+    )
+
+
+def job_backlog():
+    """
+    Queued consultations and how long the workers should take to run them, from the
+    durations of the last jobs and the number of workers seen recently.
+    """
+    since = timezone.now() - timedelta(seconds=BACKLOG_WINDOW_SECONDS)
+    queued = ConsultationJob.objects.filter(status='QUEUED').count()
+    recent = list(
+        ConsultationJob.objects.filter(status='DONE', finished_at__gte=since, started_at__isnull=False)
+        .order_by('-finished_at').values_list('worker', 'started_at', 'finished_at')[:50]
+    )
+    running = set(ConsultationJob.objects.filter(status='RUNNING').values_list('worker', flat=True))
+    workers = len(running | {worker for worker, _, _ in recent}) or 1
+    if recent:
+        job_seconds = sum((finished - started).total_seconds() for _, started, finished in recent) / len(recent)
+    else:
+        job_seconds = settings.AI_ADMISSION_JOB_SECONDS # Nothing to measure yet
+    return {
+        'queued': queued,
+        'workers': workers,
+        'job_seconds': round(job_seconds, 2),
+        'drain_seconds': round(queued * job_seconds / workers, 1),
+    }
+
+
+def claim_next_job(worker_id):
+    """
+    Atomically claims the oldest available job.
+    Uses a conditional UPDATE instead of row locks so it also works on SQLite.
+    """
+    candidates = ConsultationJob.objects.filter(
+        status='QUEUED', available_at__lte=timezone.now()
+    ).values_list('id', flat=True)[:5]
+
+    for job_id in candidates:
+        claimed = ConsultationJob.objects.filter(id=job_id, status='QUEUED').update(
+            status='RUNNING',
+            worker=worker_id,
+            started_at=timezone.now(),
+            updated_at=timezone.now()
+        )
+        if claimed:
+            return ConsultationJob.objects.select_related('study').get(id=job_id)
+    return None
+
+
+def requeue_stale_jobs():
+    """Recovers jobs left RUNNING by a worker that crashed or was killed (no heartbeat, see run_job)."""
+    cutoff = timezone.now() - timedelta(seconds=settings.AI_JOB_STALE_TIMEOUT)
+    stale_jobs = list(
+        ConsultationJob.objects.filter(status='RUNNING', updated_at__lt=cutoff).select_related('study')
+    )
+    for job in stale_jobs:
+        # The attempt was already counted when the job started running
+        _retry_or_fail(job, "Worker stopped responding (stale job).")
+    return len(stale_jobs)
+
+
+def run_job(job):
+    """Runs the consultation pipeline for a claimed job and records the outcome."""
+    # Imported here so the queue can be used without loading the AI stack
+    from .ai_processors import IntegratedAIProcessor
+
+    study = job.study
+    job.attempts += 1
+    job.save(update_fields=['attempts', 'updated_at'])
+    # From the moment the job became available (upload or retry backoff) until a worker claimed it
+    queue_wait = max(0.0, (job.started_at - job.available_at).total_seconds())
+    QUEUE_WAIT_SECONDS.observe(queue_wait, queue="consultation")
+
+    study.status = 'PROCESSING'
+    study.save(update_fields=['status', 'updated_at'])
+    print(f"[{time.strftime('%H:%M:%S')}] ⚙️ Job #{job.id}: Study #{study.id} (attempt {job.attempts}/{job.max_attempts})")
+
+    try:
+        with _heartbeat(job):
+            study = IntegratedAIProcessor().process_consultation(study)
+    except Exception as e:
+        print(f"[{time.strftime('%H:%M:%S')}] ❌ Job #{job.id} failed: {e}")
+        _retry_or_fail(job, traceback.format_exc())
+        return job
+
+    study.stage_timings = {**(study.stage_timings or {}), 'queue_wait': round(queue_wait, 3)}
+    study.save(update_fields=['stage_timings', 'updated_at'])
+
+    with transaction.atomic():
+        job.status = 'DONE'
+        job.finished_at = timezone.now()
+        job.save(update_fields=['status', 'finished_at', 'updated_at'])
+
+        # We only create the History entry for the initiation.
+        MedicalHistory.objects.create(
+            patient=study.patient,
+            title=f"Triaje Iniciado - Estudio #{study.id}",
+            description=(
+                f"Iniciando triaje inteligente.\n"
+                f"Hallazgos iniciales: {(study.medgemma_result or '')[:200]}..."
+            )
+        )
+    print(f"[{time.strftime('%H:%M:%S')}] ✅ Job #{job.id} done.")
+    return job
+
+
+@contextmanager
+def _heartbeat(job):
+    """
+    Refreshes the job's updated_at while the block runs, so a slow consultation is
+    not taken for the job of a dead worker and run a second time.
+    """
+    stop = threading.Event()
+    interval = max(1, settings.AI_JOB_STALE_TIMEOUT // 4)
+
+    def beat():
+        try:
+            while not stop.wait(interval):
+                try:
+                    ConsultationJob.objects.filter(id=job.id, status='RUNNING', worker=job.worker).update(updated_at=timezone.now())
+                except Exception as e:
+                    print(f"[{time.strftime('%H:%M:%S')}] ⚠️ Job #{job.id}: heartbeat failed: {e}")
+        finally:
+            connection.close() # This thread's connection
+    thread = threading.Thread(target=beat, name=f"job-{job.id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _retry_or_fail(job, error):
+    study = job.study
+    job.last_error = error
+
+    if job.attempts < job.max_attempts:
+        job.status = 'QUEUED'
+        job.available_at = timezone.now() + timedelta(seconds=settings.AI_JOB_RETRY_DELAY * job.attempts)
+        study.status = 'PENDING'
+    else:
+        job.status = 'FAILED'
+        job.finished_at = timezone.now()
+        study.status = 'FAILED'
+
+    job.save()
+    study.save(update_fields=['status', 'updated_at'])
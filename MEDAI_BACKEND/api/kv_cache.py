@@ -0,0 +1,179 @@
+import os
+import copy
+import threading
+from collections import OrderedDict
+from .metrics import KV_CACHE_REQUESTS
+
+
+class CacheEntry:
+    """
+    Attention cache for a token sequence already run through the model.
+    `token_ids` are the raw ids (prompt + generated), the cache covers all of them
+    but the last generated one. `prompt_text` is the rendered prompt of that turn.
+    """
+    def __init__(self, token_ids, past_key_values, prompt_text=None):
+        self.token_ids = token_ids.detach()
+        self.past_key_values = past_key_values
+        self.prompt_text = prompt_text
+        self.nbytes = _cache_nbytes(past_key_values)
+
+
+class TriageKVCache:
+    """
+    Keeps attention (KV) caches between triage turns so that each turn only
+    encodes the tokens that are new since the previous one.
+
+    - Per-study entries, keyed by study id, evicted LRU under a memory budget.
+    - Shared prefix entries (e.g. the triage system prompt) that every new
+      conversation starts from. They are pinned and never evicted.
+    """
+    def __init__(self, budget_mb=None):
+        budget_mb = budget_mb or int(os.environ.get("AI_KV_CACHE_BUDGET_MB", 2048))
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self._entries = OrderedDict()
+        self._prefixes = {}
+        self._lock = threading.Lock()
+
+    @property
+    def used_bytes(self):
+        return sum(e.nbytes for e in self._entries.values()) + sum(e.nbytes for e in self._prefixes.values())
+
+    def has_entry(self, key):
+        return key in self._entries
+
+    def peek(self, key):
+        """The entry of `key` (left in place), or None."""
+        return self._entries.get(key)
+
+    def has_prefix(self, token_ids):
+        return _ids_key(token_ids) in self._prefixes
+
+    def put_prefix(self, token_ids, past_key_values):
+        with self._lock:
+            self._prefixes[_ids_key(token_ids)] = CacheEntry(token_ids, past_key_values)
+
+    def put(self, key, token_ids, past_key_values, prompt_text=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = CacheEntry(token_ids, past_key_values, prompt_text)
+            self._evict()
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Drops every entry, including shared prefixes (e.g. when the model is unloaded)."""
+        with self._lock:
+            self._entries.clear()
+            self._prefixes.clear()
+
+    def lookup(self, key, input_ids):
+        """
+        Returns (past_key_values, n_cached) usable to generate from `input_ids`,
+        or (None, 0) on a miss. The per-study entry is handed over (not copied),
+        shared prefixes are deep-copied since generation mutates the cache.
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                past = _reuse(entry, input_ids)
+                if past is not None:
+                    KV_CACHE_REQUESTS.inc(result="hit")
+                    return past, past.get_seq_length()
+
+            for prefix in self._prefixes.values():
+                n = _common_prefix_len(prefix.token_ids, input_ids)
+                if n == len(prefix.token_ids) and n < len(input_ids):
+                    KV_CACHE_REQUESTS.inc(result="prefix")
+                    return copy.deepcopy(prefix.past_key_values), n
+
+            KV_CACHE_REQUESTS.inc(result="miss")
+            return None, 0
+
+    def _evict(self):
+        while self._entries and self.used_bytes > self.budget_bytes:
+            evicted_key, _ = self._entries.popitem(last=False)
+            print(f"KV cache: evicted study {evicted_key} (budget {self.budget_bytes // (1024 * 1024)} MB)")
+
+
+def _reuse(entry, input_ids):
+    """
+    Continues a cached conversation. A prompt that extends the cached ids uses the
+    cache as is, otherwise it is cropped to the part shared with the new prompt.
+    """
+    past = entry.past_key_values
+    n = _common_prefix_len(entry.token_ids, input_ids)
+    # At least one prompt token must remain to be encoded by generate()
+    n = min(n, len(input_ids) - 1, past.get_seq_length())
+    if n <= 0:
+        return None
+    if n < past.get_seq_length():
+        try:
+            # Negative values drop tokens from the end
+            past.crop(n - past.get_seq_length())
+        except Exception:
+            # Sliding window layers cannot be rewound once the window is full
+            return None
+    return past
+
+
+def split_batch_cache(past_key_values, spans):
+    """
+    Splits the cache of a left-padded batch into one cache per row.
+    `spans` holds (start, length) of each row's tokens in the padded sequence.
+    Returns None for a row whose sliding window layers no longer hold its last
+    tokens (a row that finished long before the others).
+    """
+    caches = []
+    for row, (start, length) in enumerate(spans):
+        cache = copy.copy(past_key_values)
+        cache.layers = []
+        for layer in past_key_values.layers:
+            row_layer = copy.copy(layer)
+            if getattr(layer, "is_sliding", False):
+                # Only the last window - 1 positions of the batch are kept
+                stored = layer.keys.shape[-2]
+                offset = layer.cumulative_length - stored
+                keep = min(length, layer.sliding_window - 1)
+                first = start + length - keep - offset
+                if first < 0:
+                    cache = None
+                    break
+                row_layer.keys = layer.keys[row:row + 1, :, first:first + keep].clone()
+                row_layer.values = layer.values[row:row + 1, :, first:first + keep].clone()
+                row_layer.cumulative_length = length
+            else:
+                row_layer.keys = layer.keys[row:row + 1, :, start:start + length].clone()
+                row_layer.values = layer.values[row:row + 1, :, start:start + length].clone()
+            cache.layers.append(row_layer)
+        caches.append(cache)
+    return caches
+
+
+def _common_prefix_len(a, b):
+    n = min(len(a), len(b))
+    if n == 0:
+        return 0
+    a = a[:n].to(b.device)
+    mismatch = (a != b[:n]).nonzero()
+    return int(mismatch[0]) if len(mismatch) else n
+
+
+def _ids_key(token_ids):
+    return tuple(token_ids.tolist())
+
+
+def _cache_nbytes(past_key_values):
+    total = 0
+    layers = getattr(past_key_values, "layers", None)
+    if layers is not None:
+        for layer in layers:
+            for tensor in (getattr(layer, "keys", None), getattr(layer, "values", None)):
+                if tensor is not None and hasattr(tensor, "numel"):
+                    total += tensor.numel() * tensor.element_size()
+        return total
+    for layer in past_key_values.to_legacy_cache():
+        for tensor in layer:
+            total += tensor.numel() * tensor.element_size()
+    return total
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from api.ai_cache import cache_stats
+
+
+class Command(BaseCommand):
+    help = ("Shows the size and hit counters of the persistent AI result cache. Hits and misses are "
+            "the lookups counted by the running web, worker and inference processes (merged from AI_METRICS_DIR).")
+
+    def handle(self, *args, **options):
+        for kind, stats in cache_stats().items():
+            hit_rate = f"{stats['hit_rate']:.1%}" if stats['hit_rate'] is not None else "-"
+            self.stdout.write(f"{kind:<12} entries={stats['entries']:<6} stored_hits={stats['stored_hits']:<6} "
+                              f"hits={stats['hits']:<6} misses={stats['misses']:<6} hit_rate={hit_rate}")
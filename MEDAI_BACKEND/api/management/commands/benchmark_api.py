@@ -0,0 +1,350 @@
+import io
+import os
+import sys
+import json
+import time
+import uuid
+import wave
+import random
+import threading
+import numpy as np
+from contextlib import redirect_stdout, nullcontext
+from datetime import date
+from PIL import Image
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+# Synthetic patients are created with this DNI prefix (and removed afterwards unless --keep)
+DNI_PREFIX = "LT-"
+ANSWERS = "ABCD"
+
+
+class _InProcessClient:
+    """Calls the views through Django's test client: no server needed."""
+    def __init__(self):
+        from django.test import Client
+        host = next((h for h in settings.ALLOWED_HOSTS if h not in ('*',) and not h.startswith('.')), 'localhost')
+        self.client = Client(SERVER_NAME=host)
+
+    def request(self, method, path, data=None, files=None):
+        if method == 'GET':
+            response = self.client.get(path)
+        elif files:
+            response = self.client.post(path, {**(data or {}), **files})
+        else:
+            response = self.client.post(path, data or {}, content_type='application/json')
+        try:
+            body = json.loads(response.content or b'null')
+        except ValueError:
+            body = None
+        return response.status_code, body
+
+
+class _HttpClient:
+    """Calls a running deployment over HTTP."""
+    def __init__(self, base_url, timeout):
+        import requests
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def request(self, method, path, data=None, files=None):
+        url = self.base_url + path
+        if method == 'GET':
+            response = self.session.get(url, timeout=self.timeout)
+        elif files:
+            files = {name: (f.name, f) for name, f in files.items()}
+            response = self.session.post(url, data=data, files=files, timeout=self.timeout)
+        else:
+            response = self.session.post(url, json=data, timeout=self.timeout)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, body
+
+
+class _Recorder:
+    """Latency samples per endpoint, plus per-consultation outcomes."""
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.flows = []
+        self._lock = threading.Lock()
+
+    def call(self, client, endpoint, method, path, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            status_code, body = client.request(method, path, **kwargs)
+        except Exception as e:
+            status_code, body = type(e).__name__, None
+        seconds = time.perf_counter() - t0
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append(seconds)
+            if not isinstance(status_code, int) or status_code >= 400:
+                errors = self.errors.setdefault(endpoint, {})
+                errors[str(status_code)] = errors.get(str(status_code), 0) + 1
+        return status_code, body
+
+    def flow(self, outcome):
+        with self._lock:
+            self.flows.append(outcome)
+
+
+def _percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(values) - 1, int(np.ceil(pct / 100 * len(values))) - 1))
+    return values[index]
+
+
+def _latency_summary(values, duration):
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'throughput_rps': round(len(values) / duration, 3) if duration else None,
+        'mean_ms': round(sum(values) / len(values) * 1000, 1),
+        'p50_ms': round(_percentile(values, 50) * 1000, 1),
+        'p95_ms': round(_percentile(values, 95) * 1000, 1),
+        'p99_ms': round(_percentile(values, 99) * 1000, 1),
+        'max_ms': round(values[-1] * 1000, 1),
+    }
+
+
+def _synthetic_image(rng):
+    # Random noise so every upload is a distinct file (no AI result cache hits)
+    pixels = rng.integers(0, 256, size=(512, 512), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels, mode='L').save(buffer, format='PNG')
+    buffer.name = 'loadtest.png'
+    buffer.seek(0)
+    return buffer
+
+
+def _synthetic_audio(rng, seconds=3, sample_rate=16000):
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    signal = 0.3 * np.sin(2 * np.pi * rng.uniform(120, 300) * t) + 0.05 * rng.standard_normal(t.shape)
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes((signal * 32767).astype('<i2').tobytes())
+    buffer.name = 'loadtest.wav'
+    buffer.seek(0)
+    return buffer
+
+
+class Command(BaseCommand):
+    help = ("Load-tests the REST API with concurrent simulated kiosks (upload, triage until the diagnosis, "
+            "history) and doctor dashboards. Reports throughput and p50/p95/p99 latency per endpoint as JSON.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kiosks', type=int, default=4, help="Concurrent kiosks running consultations.")
+        parser.add_argument('--consultations', type=int, default=3, help="Consultations per kiosk.")
+        parser.add_argument('--dashboards', type=int, default=1, help="Doctor screens polling the dashboard.")
+        parser.add_argument('--workers', type=int, default=1,
+                            help="AI worker threads started by this command (in-process mode only).")
+        parser.add_argument('--base-url',
+                            help="Benchmark a running server (e.g. http://127.0.0.1:8000) instead of calling the "
+                                 "views in-process. Its AI workers must be running.")
+        # Frontend polling rates (src/hooks/use-dashboard.ts, use-consultations.ts)
+        parser.add_argument('--dashboard-interval', type=float, default=5.0, help="Seconds between dashboard polls.")
+        parser.add_argument('--poll-interval', type=float, default=5.0,
+                            help="Seconds between study polls while the AI pipeline runs.")
+        parser.add_argument('--think-time', type=float, default=2.0, help="Seconds a patient takes to answer.")
+        parser.add_argument('--max-turns', type=int, default=10, help="Triage answers before giving up on a diagnosis.")
+        parser.add_argument('--pipeline-timeout', type=float, default=600, help="Seconds to wait for the first question.")
+        parser.add_argument('--request-timeout', type=float, default=300, help="HTTP timeout per request (--base-url).")
+        parser.add_argument('--no-audio', action='store_true', help="Upload only an image.")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help="Also write the JSON report to this file.")
+        parser.add_argument('--keep', action='store_true', help="Keep the synthetic patients and studies.")
+
+    def handle(self, *args, **options):
+        in_process = not options['base_url']
+        offline = os.environ.get('MOCK_AI') == 'True' or os.environ.get('AI_BACKEND', '').lower() == 'simulated'
+        if in_process and not offline and not os.environ.get('AI_INFERENCE_SERVER'):
+            raise CommandError("In-process runs load the real models. Set MOCK_AI=True or AI_BACKEND=simulated "
+                               "(offline) or pass --base-url.")
+        self.options = options
+        self.run_id = uuid.uuid4().hex[:6]
+        self.recorder = _Recorder()
+        self.stop_event = threading.Event()
+
+        threads = []
+        if in_process:
+            threads += [threading.Thread(target=self._worker_loop, args=(f"loadtest:{os.getpid()}#{i}",), daemon=True)
+                        for i in range(max(1, options['workers']))]
+        threads += [threading.Thread(target=self._dashboard_loop, daemon=True) for _ in range(options['dashboards'])]
+        kiosks = [threading.Thread(target=self._kiosk, args=(k,), daemon=True) for k in range(options['kiosks'])]
+
+        self.stderr.write(f"[{time.strftime('%H:%M:%S')}] 🚦 Load test {self.run_id}: {options['kiosks']} kiosk(s) x "
+                          f"{options['consultations']} consultation(s), {options['dashboards']} dashboard(s), "
+                          f"{'in-process' if in_process else options['base_url']}")
+        # In-process, the views and AI workers print their logs: send them to stderr so
+        # stdout only carries the JSON report (e.g. `... | python -m json.tool`)
+        with redirect_stdout(sys.stderr) if in_process else nullcontext():
+            started = time.perf_counter()
+            for t in threads + kiosks:
+                t.start()
+            try:
+                for t in kiosks:
+                    t.join()
+            finally:
+                duration = time.perf_counter() - started
+                self.stop_event.set()
+                for t in threads:
+                    t.join(timeout=options['poll_interval'] + options['dashboard_interval'] + 5)
+
+            report = self._report(duration, in_process)
+            if in_process and not options['keep']:
+                self._cleanup()
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+    def _client(self):
+        if self.options['base_url']:
+            return _HttpClient(self.options['base_url'], self.options['request_timeout'])
+        return _InProcessClient()
+
+    def _kiosk(self, kiosk):
+        client = self._client()
+        # Media differ between runs (no AI result cache hits), answers are reproducible with --seed
+        rng = np.random.default_rng([self.options['seed'], kiosk, int(self.run_id, 16)])
+        answers = random.Random(f"{self.options['seed']}-{kiosk}")
+        try:
+            for i in range(self.options['consultations']):
+                self.recorder.flow(self._consultation(client, rng, answers, f"{kiosk}-{i}"))
+        finally:
+            close_old_connections()
+
+    def _consultation(self, client, rng, answers, label):
+        """Kiosk flow: register patient, upload, wait for the first question, answer until [DIAGNOSIS], history."""
+        rec, opts = self.recorder, self.options
+        outcome = {'kiosk': label, 'outcome': 'failed', 'triage_turns': 0}
+        t0 = time.perf_counter()
+
+        status_code, patient = rec.call(client, 'POST patients/', 'POST', '/api/patients/', data={
+            'first_name': 'Load', 'last_name': f'Test {label}',
+            'dni': f"{DNI_PREFIX}{self.run_id}-{label}", 'birth_date': date(1980, 1, 1).isoformat(),
+        })
+        if status_code != 201:
+            return outcome
+
+        files = {'image': _synthetic_image(rng)}
+        if not opts['no_audio']:
+            files['audio'] = _synthetic_audio(rng)
+        status_code, study = rec.call(client, 'POST consultations/', 'POST', '/api/consultations/',
+                                      data={'patient_id': patient['id']}, files=files)
+        if status_code not in (201, 202):
+            return outcome
+        pk = study['id']
+
+        # The frontend polls the study while the AI pipeline runs
+        deadline = time.perf_counter() + opts['pipeline_timeout']
+        while not self._triage_ready(study):
+            if study.get('status') == 'FAILED' or time.perf_counter() > deadline:
+                outcome['outcome'] = 'pipeline_failed' if study.get('status') == 'FAILED' else 'pipeline_timeout'
+                return outcome
+            time.sleep(opts['poll_interval'])
+            status_code, body = rec.call(client, 'GET studies/<pk>/', 'GET', f'/api/studies/{pk}/')
+            if status_code == 200:
+                study = body
+        outcome['first_question_seconds'] = round(time.perf_counter() - t0, 3)
+
+        while not study.get('triage_completed') and outcome['triage_turns'] < opts['max_turns']:
+            time.sleep(opts['think_time'])
+            status_code, body = rec.call(client, 'POST studies/<pk>/triage/', 'POST', f'/api/studies/{pk}/triage/',
+                                         data={'answer': answers.choice(ANSWERS)})
+            outcome['triage_turns'] += 1
+            if status_code != 200:
+                return outcome
+            study = body
+
+        # The frontend polls the history until the entry of this study shows up
+        title = f"Triaje {'Completado' if study.get('triage_completed') else 'Iniciado'} - Estudio #{pk}"
+        deadline = time.perf_counter() + opts['pipeline_timeout']
+        while True:
+            status_code, history = rec.call(client, 'GET patients/<pk>/history/', 'GET',
+                                            f"/api/patients/{patient['id']}/history/")
+            if status_code == 200 and any(entry.get('title') == title for entry in history or []):
+                break
+            if time.perf_counter() > deadline:
+                outcome['outcome'] = 'history_timeout'
+                return outcome
+            time.sleep(opts['poll_interval'])
+        outcome['outcome'] = 'diagnosed' if study.get('triage_completed') else 'max_turns'
+        outcome['total_seconds'] = round(time.perf_counter() - t0, 3)
+        return outcome
+
+    def _triage_ready(self, study):
+        return study.get('triage_completed') or len(study.get('triage_history') or []) > 3
+
+    def _dashboard_loop(self):
+        client = self._client()
+        while not self.stop_event.is_set():
+            self.recorder.call(client, 'GET dashboard/stats/', 'GET', '/api/dashboard/stats/')
+            self.stop_event.wait(self.options['dashboard_interval'])
+        close_old_connections()
+
+    def _worker_loop(self, worker_id):
+        from api.jobs import claim_next_job, run_job
+        while not self.stop_event.is_set():
+            close_old_connections()
+            job = claim_next_job(worker_id)
+            if job is None:
+                self.stop_event.wait(0.2)
+                continue
+            run_job(job)
+        close_old_connections()
+
+    def _report(self, duration, in_process):
+        flows = self.recorder.flows
+        outcomes = {}
+        for f in flows:
+            outcomes[f['outcome']] = outcomes.get(f['outcome'], 0) + 1
+        flow_latency = {}
+        for key in ('first_question_seconds', 'total_seconds'):
+            values = sorted(f[key] for f in flows if key in f)
+            if values:
+                flow_latency[key.replace('_seconds', '')] = {
+                    'p50_s': _percentile(values, 50), 'p95_s': _percentile(values, 95),
+                    'p99_s': _percentile(values, 99), 'max_s': values[-1],
+                }
+        return {
+            'run_id': self.run_id,
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(time.time() - duration)),
+            'duration_seconds': round(duration, 3),
+            'target': 'in-process' if in_process else self.options['base_url'],
+            'mock_ai': os.environ.get('MOCK_AI') == 'True',
+            'ai_backend': os.environ.get('AI_BACKEND') or None,
+            'sim_profile': os.environ.get('AI_SIM_PROFILE', 'gpu') if os.environ.get('AI_BACKEND') == 'simulated' else None,
+            'config': {k: self.options[k] for k in ('kiosks', 'consultations', 'dashboards', 'workers',
+                                                    'dashboard_interval', 'poll_interval', 'think_time',
+                                                    'max_turns', 'no_audio', 'seed')},
+            'consultations': {
+                'total': len(flows),
+                'outcomes': outcomes,
+                'completed_per_minute': round(outcomes.get('diagnosed', 0) / duration * 60, 3) if duration else None,
+                'latency': flow_latency,
+            },
+            'endpoints': {
+                endpoint: {**_latency_summary(values, duration), 'errors': self.recorder.errors.get(endpoint, {})}
+                for endpoint, values in sorted(self.recorder.samples.items())
+            },
+        }
+
+    def _cleanup(self):
+        """Deletes the synthetic patients (studies, reports and history cascade) and their files."""
+        from api.models import Patient, Study
+        from api.media_ingest import delete_study_media
+        for study in Study.objects.filter(patient__dni__startswith=f"{DNI_PREFIX}{self.run_id}-"):
+            delete_study_media(study)
+            report = getattr(study, 'report', None)
+            if report is not None and report.report_pdf:
+                report.report_pdf.delete(save=False)
+        Patient.objects.filter(dni__startswith=f"{DNI_PREFIX}{self.run_id}-").delete()
@@ -0,0 +1,129 @@
+import json
+import sys
+import time
+import multiprocessing
+from django.core.management.base import BaseCommand, CommandError
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KB on Linux, bytes on macOS
+        return round(peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024, 1)
+    except ImportError:
+        import psutil
+        return round(psutil.Process().memory_info().peak_wset / (1024 * 1024), 1)
+
+
+def _load_model(model_id, config):
+    from api.cpu_backend import load_dtype
+    if model_id == 'tiny':
+        # Random weights, no download: measures the backend, not the model
+        import torch
+        from transformers import LlamaConfig, LlamaForCausalLM
+        torch.manual_seed(0)
+        model = LlamaForCausalLM(LlamaConfig(
+            vocab_size=32000, hidden_size=512, intermediate_size=1376,
+            num_hidden_layers=8, num_attention_heads=8, num_key_value_heads=8,
+        )).to(load_dtype(config))
+        return model, None
+
+    import os
+    from transformers import AutoModelForImageTextToText, AutoTokenizer
+    token = os.environ.get("HF_TOKEN")
+    model = AutoModelForImageTextToText.from_pretrained(model_id, dtype=load_dtype(config), token=token)
+    tokenizer = AutoTokenizer.from_pretrained(model_id, token=token)
+    return model, tokenizer
+
+
+def _run_config(name, options, queue):
+    """Runs in a fresh process so peak RSS and thread settings do not leak between configs."""
+    try:
+        import torch
+        from api.cpu_backend import configure_threads, optimize_for_cpu, describe
+        config = {
+            'dtype': 'bf16' if name == 'bf16' else 'fp32',
+            'quantize': 'int8' if name == 'int8' else 'none',
+            'threads': options['threads'],
+            'compile': options['compile'],
+        }
+        configure_threads(config['threads'])
+
+        t0 = time.perf_counter()
+        model, tokenizer = _load_model(options['model'], config)
+        optimize_for_cpu(model, config)
+        load_seconds = time.perf_counter() - t0
+
+        prompt = "Patient reports persistent cough and mild fever for three days."
+        if tokenizer is not None:
+            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        else:
+            input_ids = torch.randint(0, model.config.vocab_size, (1, 32))
+        kwargs = {'max_new_tokens': options['tokens'], 'min_new_tokens': options['tokens'], 'do_sample': False}
+
+        with torch.inference_mode():
+            model.generate(input_ids, max_new_tokens=4, do_sample=False) # Warmup (and compile)
+            t0 = time.perf_counter()
+            output = model.generate(input_ids, **kwargs)
+            elapsed = time.perf_counter() - t0
+
+        generated = output.shape[-1] - input_ids.shape[-1]
+        queue.put({
+            'config': name,
+            'backend': describe(config),
+            'load_seconds': round(load_seconds, 2),
+            'tokens': generated,
+            'tokens_per_second': round(generated / elapsed, 2),
+            'peak_rss_mb': _peak_rss_mb(),
+        })
+    except Exception as e:
+        queue.put({'config': name, 'error': str(e)})
+
+
+class Command(BaseCommand):
+    help = "Benchmarks the CPU inference configurations (fp32 / bf16 / int8) on this machine."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', default='tiny',
+                            help="'tiny' (random weights, no download) or a Hugging Face model id.")
+        parser.add_argument('--configs', default='fp32,bf16,int8',
+                            help="Comma-separated configurations to compare.")
+        parser.add_argument('--threads', type=int, default=None, help="Intra-op threads (default: torch default).")
+        parser.add_argument('--tokens', type=int, default=64, help="Tokens to generate per run.")
+        parser.add_argument('--compile', action='store_true', help="Also wrap the model with torch.compile.")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        names = [c.strip() for c in options['configs'].split(',') if c.strip()]
+        unknown = set(names) - {'fp32', 'bf16', 'int8'}
+        if unknown:
+            raise CommandError(f"Unknown configuration(s): {', '.join(sorted(unknown))}")
+
+        run_options = {k: options[k] for k in ('model', 'threads', 'tokens', 'compile')}
+        ctx = multiprocessing.get_context('spawn')
+        results = []
+        for name in names:
+            if not options['json']:
+                self.stdout.write(f"[{time.strftime('%H:%M:%S')}] Benchmarking {name}...")
+            queue = ctx.Queue()
+            process = ctx.Process(target=_run_config, args=(name, run_options, queue))
+            process.start()
+            process.join()
+            try:
+                results.append(queue.get(timeout=5))
+            except Exception:
+                results.append({'config': name, 'error': f"exit code {process.exitcode}"})
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        for r in results:
+            if 'error' in r:
+                self.stdout.write(self.style.ERROR(f"{r['config']:>5}: failed ({r['error']})"))
+                continue
+            self.stdout.write(
+                f"{r['config']:>5}: {r['tokens_per_second']:>8} tok/s  "
+                f"peak RSS {r['peak_rss_mb']:>8} MB  load {r['load_seconds']}s  ({r['backend']})"
+            )
@@ -0,0 +1,85 @@
+import json
+import time
+from django.core.management.base import BaseCommand, CommandError
+from api.models import Study
+from api import postprocess
+
+
+def _recorded_outputs():
+    """Model outputs already stored in the database: findings, symptoms, triage turns and reports."""
+    texts = []
+    for study in Study.objects.all().iterator():
+        texts += [t for t in (study.medgemma_result, study.symptoms_text, study.combined_ai_analysis) if t]
+        for msg in study.triage_history or []:
+            content = msg.get('content', [])
+            if msg.get('role') == 'assistant' and isinstance(content, list):
+                texts.append("".join(item.get('text', '') for item in content if isinstance(item, dict)))
+    return [t for t in texts if t]
+
+
+def _load_corpus(path):
+    """A JSONL file with one {"text": ...} per line, or a plain text file with outputs separated by blank lines."""
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            return [json.loads(line)['text'] for line in f if line.strip()]
+        return [t for t in f.read().split("\n\n\n") if t.strip()]
+
+
+def _stream(text, chunk_size=4):
+    # Roughly one token per chunk, as TextIteratorStreamer delivers them
+    cleaner = postprocess.StreamingOutputCleaner()
+    for i in range(0, len(text), chunk_size):
+        cleaner.feed(text[i:i + chunk_size])
+    return cleaner.result()
+
+
+CASES = {
+    'clean_ai_output': postprocess.clean_ai_output,
+    'streaming_cleaner': _stream,
+    'clean_integrated_report': postprocess.clean_integrated_report,
+    'extract_medical_sections': postprocess.extract_medical_sections,
+    'deduplicate_sentences': postprocess.deduplicate_sentences,
+    'normalize_transcript': postprocess.normalize_transcript,
+}
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmarks the model output post-processing over recorded outputs."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--corpus', help="JSONL/text file of outputs (default: outputs stored in the database).")
+        parser.add_argument('--repeat', type=int, default=50, help="Passes over the corpus per function.")
+        parser.add_argument('--scale', type=int, default=1,
+                            help="Concatenate each output N times to check cost grows linearly with length.")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+    def handle(self, *args, **options):
+        corpus = _load_corpus(options['corpus']) if options['corpus'] else _recorded_outputs()
+        if not corpus:
+            raise CommandError("No recorded outputs found. Pass --corpus or process some studies first.")
+        if options['scale'] > 1:
+            corpus = ["\n".join([t] * options['scale']) for t in corpus]
+
+        total_kb = sum(len(t.encode('utf-8')) for t in corpus) / 1024
+        results = []
+        for name, func in CASES.items():
+            t0 = time.perf_counter()
+            for _ in range(options['repeat']):
+                for text in corpus:
+                    func(text)
+            elapsed = time.perf_counter() - t0
+            calls = options['repeat'] * len(corpus)
+            results.append({
+                'function': name,
+                'calls': calls,
+                'us_per_call': round(elapsed / calls * 1e6, 2),
+                'us_per_kb': round(elapsed / (options['repeat'] * total_kb) * 1e6, 2),
+            })
+
+        if options['json']:
+            self.stdout.write(json.dumps({'outputs': len(corpus), 'corpus_kb': round(total_kb, 1), 'results': results}, indent=2))
+            return
+
+        self.stdout.write(f"{len(corpus)} outputs, {total_kb:.1f} KB, {options['repeat']} passes")
+        for r in results:
+            self.stdout.write(f"{r['function']:>26}: {r['us_per_call']:>10} µs/call  {r['us_per_kb']:>10} µs/KB")
@@ -0,0 +1,78 @@
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from api import ai_processors
+from api.cpu_backend import inference_backend
+from api.model_artifacts import (
+    ArtifactError, artifact_path, artifact_variant, read_manifest, resolve_revision, save_artifact, verify_artifact
+)
+
+MODELS = {
+    'medgemma': (ai_processors.MEDGEMMA_MODEL_ID, "nf4", ai_processors.load_medgemma_pipeline, ai_processors.MEDGEMMA_REVISION),
+    'medasr': (ai_processors.MEDASR_MODEL_ID, "fp32", ai_processors.load_medasr_pipeline, ai_processors.MEDASR_REVISION),
+}
+
+
+def _size_mb(manifest):
+    return round(sum(f['size'] for f in manifest['files'].values()) / (1024 * 1024), 1)
+
+
+class Command(BaseCommand):
+    help = ("Downloads the AI models once and saves them as local, already-quantized artifacts "
+            "(weights + processor) that the loaders use instead of the Hub.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--model', choices=['all', *MODELS], default='all')
+        parser.add_argument('--revision', help="Hub branch, tag or commit to build from "
+                                               "(default: AI_MEDGEMMA_REVISION / AI_MEDASR_REVISION, else the default branch).")
+        parser.add_argument('--force', action='store_true', help="Rebuild artifacts that already exist.")
+        parser.add_argument('--verify', action='store_true', help="Only check the existing artifacts against their checksums.")
+
+    def handle(self, *args, **options):
+        if inference_backend() == 'simulated':
+            raise CommandError("AI_BACKEND=simulated does not load real models: nothing to build.")
+        names = list(MODELS) if options['model'] == 'all' else [options['model']]
+        for name in names:
+            model_id, gpu_variant, loader, pinned = MODELS[name]
+            variant = artifact_variant(gpu_variant)
+            if options['verify']:
+                self._verify(model_id, variant)
+            else:
+                self._build(model_id, variant, loader, options['revision'] or pinned, options['force'])
+
+    def _build(self, model_id, variant, loader, revision, force):
+        directory = artifact_path(model_id, variant)
+        if os.path.exists(directory) and not force:
+            self.stdout.write(f"{directory} already exists, skipping (use --force to rebuild).")
+            return
+        try:
+            source_revision = resolve_revision(model_id, revision, token=os.environ.get("HF_TOKEN"))
+        except Exception as e:
+            raise CommandError(f"Could not resolve {model_id}@{revision or 'default branch'} on the Hub: {e}")
+
+        self.stdout.write(f"[{time.strftime('%H:%M:%S')}] 🏗️ Building {model_id} ({variant}) from revision {source_revision[:12]}...")
+        t0 = time.perf_counter()
+        pipe = loader(revision=source_revision, building_artifact=True)
+        load_seconds = time.perf_counter() - t0
+        try:
+            directory, manifest = save_artifact(pipe, model_id, variant, revision, source_revision, force=force)
+        except ArtifactError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(
+            f"[{time.strftime('%H:%M:%S')}] ✅ {directory}: {len(manifest['files'])} files, {_size_mb(manifest)} MB "
+            f"(Hub load + quantization took {load_seconds:.0f}s, saved in {time.perf_counter() - t0 - load_seconds:.0f}s)"
+        ))
+
+    def _verify(self, model_id, variant):
+        directory = artifact_path(model_id, variant)
+        manifest = read_manifest(directory)
+        if manifest is None:
+            self.stdout.write(self.style.WARNING(f"{directory}: no artifact."))
+            return
+        try:
+            verify_artifact(directory, manifest, mode='sha256')
+        except ArtifactError as e:
+            raise CommandError(f"{directory}: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"{directory}: OK ({_size_mb(manifest)} MB, revision {manifest['source_revision'][:12]}, built {manifest['created_at']})"
+        ))
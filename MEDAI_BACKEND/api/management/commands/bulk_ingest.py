@@ -0,0 +1,323 @@
+import os
+import csv
+import json
+import time
+import hashlib
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, transaction
+from api.inference_scheduler import inference_priority
+from api.models import Patient, Study
+
+# Archived files are stored as `bulk_<digest>_<original name>`, where the digest
+# identifies the manifest row: a chunk committed right before a crash (and not yet
+# checkpointed) is found again on resume instead of being imported twice.
+FILE_PREFIX = "bulk_"
+REQUIRED_COLUMNS = ('dni', 'first_name', 'last_name', 'birth_date', 'image')
+
+
+def read_manifest(path):
+    """Rows of a .csv (with header) or .jsonl manifest, with their line number."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line_number, line in enumerate(f, 1):
+                if line.strip():
+                    yield line_number, json.loads(line)
+        else:
+            for line_number, row in enumerate(csv.DictReader(f), 2):
+                yield line_number, row
+
+
+def row_key(row):
+    return (row.get('case_id') or '').strip() or f"{row['dni']}:{row['image']}"
+
+
+def row_digest(key):
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+
+class Checkpoint:
+    """Append-only JSONL log of `{key, study_id, state}`; the last record of a key wins."""
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue # Torn last line from a crash
+                    self.states[record['key']] = record
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def write(self, records, sync=True):
+        for record in records:
+            self.states[record['key']] = record
+            self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class Command(BaseCommand):
+    help = ("Imports archived cases (patients, images and optional audio) from a CSV/JSONL manifest "
+            "and runs the stage-1 AI analysis on them. Resumable: re-run it with the same manifest.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('manifest', help="CSV (with header) or JSONL file with the columns "
+                                             "dni, first_name, last_name, birth_date (YYYY-MM-DD), image, "
+                                             "and optionally audio and case_id.")
+        parser.add_argument('--media-root', help="Base directory for relative file paths (default: the manifest's directory).")
+        parser.add_argument('--chunk-size', type=int, default=200, help="Rows imported per database transaction.")
+        parser.add_argument('--workers', type=int, default=2 * int(os.environ.get("AI_BATCH_MAX_SIZE", 4)),
+                            help="Studies analyzed concurrently. Their model calls are batched together, "
+                                 "so keep it at least AI_BATCH_MAX_SIZE.")
+        parser.add_argument('--checkpoint', help="Progress file (default: <manifest>.checkpoint.jsonl).")
+        parser.add_argument('--no-analysis', action='store_true', help="Only import; analyze on a later run.")
+        parser.add_argument('--retry-failed', action='store_true', help="Retry rows that failed on a previous run.")
+        parser.add_argument('--limit', type=int, help="Process at most this many pending rows.")
+        parser.add_argument('--json', action='store_true', help="Print the final report as JSON.")
+
+    def handle(self, *args, **options):
+        manifest = options['manifest']
+        if not os.path.isfile(manifest):
+            raise CommandError(f"Manifest not found: {manifest}")
+        self.media_root = options['media_root'] or os.path.dirname(os.path.abspath(manifest))
+        self.analyze = not options['no_analysis']
+        chunk_size = max(1, options['chunk_size'])
+        workers = max(1, options['workers'])
+        checkpoint = Checkpoint(options['checkpoint'] or f"{manifest}.checkpoint.jsonl")
+        self.stats = {
+            'rows': 0, 'skipped': 0, 'patients_created': 0, 'studies_created': 0,
+            'studies_recovered': 0, 'analyzed': 0, 'failed': 0,
+        }
+        self.ingest_seconds = 0.0
+        self.errors = []
+
+        # Rows still to do: not seen yet, imported but not analyzed, or failed (--retry-failed)
+        new_rows, to_analyze = [], []
+        for line_number, row in read_manifest(manifest):
+            self.stats['rows'] += 1
+            row = {k.strip(): (v.strip() if isinstance(v, str) else v) for k, v in row.items() if k}
+            key = row_key(row) if row.get('dni') and row.get('image') else f"line:{line_number}"
+            done = checkpoint.states.get(key)
+            state = done['state'] if done else None
+            if state == 'analyzed' or (state == 'created' and not self.analyze) or (state == 'failed' and not options['retry_failed']):
+                self.stats['skipped'] += 1
+            elif state in ('created', 'failed') and done.get('study_id') and self.analyze:
+                to_analyze.append((key, done['study_id']))
+            else:
+                new_rows.append((line_number, key, row))
+            if options['limit'] and len(new_rows) + len(to_analyze) >= options['limit']:
+                break
+
+        self.stdout.write(
+            f"[{time.strftime('%H:%M:%S')}] 📥 {self.stats['rows']} rows read, {self.stats['skipped']} already done; "
+            f"{len(new_rows)} to import, {len(to_analyze)} imported studies to analyze ({workers} analysis workers)."
+        )
+        if self.analyze and (new_rows or to_analyze):
+            self._warmup_models()
+
+        started = time.perf_counter()
+        pending = set()
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bulk-analysis") if self.analyze else None
+        try:
+            for key, study_id in to_analyze:
+                pending.add(executor.submit(self._analyze, key, study_id))
+            for i in range(0, len(new_rows), chunk_size):
+                created = self._ingest_chunk(new_rows[i:i + chunk_size], checkpoint)
+                if executor:
+                    pending.update(executor.submit(self._analyze, key, study_id) for key, study_id in created)
+                    # Keep importing ahead of the analysis, but not unboundedly
+                    pending = self._collect(pending, checkpoint, max_pending=max(2 * chunk_size, workers))
+                self._progress(started, pending)
+            while pending:
+                pending = self._collect(pending, checkpoint, max_pending=len(pending) - 1)
+                if len(pending) % chunk_size == 0:
+                    self._progress(started, pending)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted: finishing the studies being analyzed (re-run to resume)...")
+            for future in pending:
+                future.cancel()
+            pending = self._collect(pending, checkpoint, max_pending=0)
+        finally:
+            if executor:
+                executor.shutdown(wait=True, cancel_futures=True)
+            checkpoint.close()
+
+        self._report(time.perf_counter() - started, options['json'])
+
+    def _warmup_models(self):
+        if os.environ.get('MOCK_AI') != 'True' and not os.environ.get('AI_INFERENCE_SERVER'):
+            from api import ai_processors # Registers the models
+            from api.model_registry import model_registry
+            model_registry.warmup()
+
+    def _resolve(self, path):
+        return path if os.path.isabs(path) else os.path.join(self.media_root, path)
+
+    def _validate(self, row):
+        missing = [c for c in REQUIRED_COLUMNS if not row.get(c)]
+        if missing:
+            raise ValueError(f"missing {', '.join(missing)}")
+        date.fromisoformat(row['birth_date'])
+        for column in ('image', 'audio'):
+            if row.get(column) and not os.path.isfile(self._resolve(row[column])):
+                raise ValueError(f"{column} file not found: {row[column]}")
+
+    def _ingest_chunk(self, rows, checkpoint):
+        """Creates the patients and studies of a chunk in one transaction. Returns [(key, study_id)]."""
+        t0 = time.perf_counter()
+        valid, failed = [], []
+        for line_number, key, row in rows:
+            try:
+                self._validate(row)
+                valid.append((key, row))
+            except ValueError as e:
+                failed.append({'key': key, 'study_id': None, 'state': 'failed', 'error': f"line {line_number}: {e}"})
+                self.errors.append(f"line {line_number}: {e}")
+
+        # Only writes inside the transaction: on SQLite a transaction that reads first
+        # can't take the write lock while the analysis threads are saving studies.
+        dnis = {row['dni'] for _, row in valid}
+        patients = {p.dni: p for p in Patient.objects.filter(dni__in=dnis)}
+        new_patients = {}
+        for _, row in valid:
+            if row['dni'] not in patients and row['dni'] not in new_patients:
+                new_patients[row['dni']] = Patient(
+                    dni=row['dni'], first_name=row['first_name'], last_name=row['last_name'],
+                    birth_date=date.fromisoformat(row['birth_date']),
+                )
+        patients.update(new_patients)
+
+        # Studies imported by a run that crashed before writing its checkpoint
+        recovered = {}
+        for study_id, image_name in Study.objects.filter(
+            patient__dni__in=dnis, image__contains=f"/{FILE_PREFIX}"
+        ).values_list('id', 'image'):
+            recovered[os.path.basename(image_name)[len(FILE_PREFIX):][:12]] = study_id
+
+        created, studies, keys = [], [], []
+        for key, row in valid:
+            digest = row_digest(key)
+            if digest in recovered:
+                created.append((key, recovered[digest]))
+                self.stats['studies_recovered'] += 1
+                continue
+            study = Study(patient=patients[row['dni']], status='PENDING')
+            self._attach(study.image, row['image'], digest)
+            if row.get('audio'):
+                self._attach(study.symptoms_audio, row['audio'], digest)
+            studies.append(study)
+            keys.append(key)
+
+        with transaction.atomic():
+            Patient.objects.bulk_create(new_patients.values())
+            Study.objects.bulk_create(studies) # Takes the patient ids set by the insert above
+        created.extend((key, study.id) for key, study in zip(keys, studies))
+        self.stats['patients_created'] += len(new_patients)
+        self.stats['studies_created'] += len(studies)
+
+        checkpoint.write(failed + [{'key': key, 'study_id': study_id, 'state': 'created'} for key, study_id in created])
+        self.stats['failed'] += len(failed)
+        self.ingest_seconds += time.perf_counter() - t0
+        return created
+
+    def _attach(self, field_file, path, digest):
+        """Copies an archived file into MEDIA_ROOT under the field's upload_to."""
+        with open(self._resolve(path), 'rb') as f:
+            field_file.save(f"{FILE_PREFIX}{digest}_{os.path.basename(path)}", File(f), save=False)
+
+    def _analyze(self, key, study_id):
+        """Runs in the analysis pool. Concurrent studies share the models through the batching scheduler."""
+        close_old_connections()
+        try:
+            with inference_priority('bulk'): # Uploads and triage turns go first
+                return self._analyze_study(key, study_id)
+        finally:
+            close_old_connections()
+
+    def _analyze_study(self, key, study_id):
+        from api.ai_processors import IntegratedAIProcessor
+        from api.media_ingest import MediaValidationError, prepare_study_media
+
+        try:
+            study = Study.objects.get(id=study_id)
+            if study.status == 'COMPLETED' and study.medgemma_result:
+                return {'key': key, 'study_id': study_id, 'state': 'analyzed'} # Finished before a crash
+            study.status = 'PROCESSING'
+            study.save(update_fields=['status', 'updated_at'])
+            try:
+                if not study.image_model_input and not study.symptoms_audio_16k:
+                    prepare_study_media(study)
+                IntegratedAIProcessor().analyze_archived_study(study)
+            except Exception:
+                study.status = 'FAILED'
+                study.save(update_fields=['status', 'updated_at'])
+                raise
+            return {'key': key, 'study_id': study_id, 'state': 'analyzed'}
+        except MediaValidationError as e:
+            return {'key': key, 'study_id': study_id, 'state': 'failed', 'error': f"invalid media: {e}"}
+        except Exception as e:
+            return {'key': key, 'study_id': study_id, 'state': 'failed', 'error': f"{type(e).__name__}: {e}"}
+
+    def _collect(self, pending, checkpoint, max_pending):
+        """Checkpoints finished analyses, waiting until at most `max_pending` are left."""
+        records = []
+        while pending:
+            done, not_done = wait(pending, timeout=0 if len(pending) <= max_pending else None, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.cancelled():
+                    continue
+                record = future.result()
+                records.append(record)
+                if record['state'] == 'analyzed':
+                    self.stats['analyzed'] += 1
+                else:
+                    self.stats['failed'] += 1
+                    self.errors.append(f"study #{record['study_id']} ({record['key']}): {record['error']}")
+            pending = not_done
+        if records:
+            checkpoint.write(records)
+        return pending
+
+    def _progress(self, started, pending):
+        elapsed = time.perf_counter() - started
+        self.stdout.write(
+            f"[{time.strftime('%H:%M:%S')}] ⏳ imported {self.stats['studies_created'] + self.stats['studies_recovered']}, "
+            f"analyzed {self.stats['analyzed']}, failed {self.stats['failed']}, in analysis {len(pending)} "
+            f"({self.stats['analyzed'] / elapsed if elapsed else 0:.2f} studies/s)"
+        )
+
+    def _report(self, elapsed, as_json):
+        report = {
+            **self.stats,
+            'elapsed_seconds': round(elapsed, 1),
+            'ingest_seconds': round(self.ingest_seconds, 1),
+            'studies_per_second': round(self.stats['analyzed'] / elapsed, 3) if elapsed else 0.0,
+            'studies_per_hour': round(3600 * self.stats['analyzed'] / elapsed) if elapsed else 0,
+            'errors': self.errors[:50],
+        }
+        if as_json:
+            self.stdout.write(json.dumps(report, indent=2))
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"[{time.strftime('%H:%M:%S')}] ✅ Bulk ingest finished in {report['elapsed_seconds']}s "
+            f"(import {report['ingest_seconds']}s)."
+        ))
+        self.stdout.write(
+            f"  rows: {report['rows']} (skipped {report['skipped']}), patients created: {report['patients_created']}, "
+            f"studies created: {report['studies_created']} (recovered {report['studies_recovered']})\n"
+            f"  analyzed: {report['analyzed']}, failed: {report['failed']}, "
+            f"throughput: {report['studies_per_second']} studies/s ({report['studies_per_hour']} studies/h)"
+        )
+        for error in report['errors']:
+            self.stdout.write(self.style.WARNING(f"  - {error}"))
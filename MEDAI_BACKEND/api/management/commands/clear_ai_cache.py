@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from api.ai_cache import current_version, invalidate
+from api.models import AIResultCache
+
+
+class Command(BaseCommand):
+    help = "Invalidates cached AI results (e.g. after changing the model or a prompt)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=[k for k, _ in AIResultCache.KIND_CHOICES],
+                            help="Only clear this kind of cached result.")
+        parser.add_argument('--stale', action='store_true',
+                            help="Only clear entries produced by a different model/prompt version than the current one.")
+
+    def handle(self, *args, **options):
+        kinds = [options['kind']] if options['kind'] else [k for k, _ in AIResultCache.KIND_CHOICES]
+        deleted = 0
+        for kind in kinds:
+            keep_version = current_version(kind) if options['stale'] else None
+            deleted += invalidate(kind=kind, keep_version=keep_version)
+        self.stdout.write(f"Deleted {deleted} cached AI result(s).")
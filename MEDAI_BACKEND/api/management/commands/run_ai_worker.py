@@ -0,0 +1,77 @@
+import os
+import time
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+from api.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+MAX_ERROR_BACKOFF = 60 # seconds between retries while the queue keeps failing (e.g. database down)
+
+
+class Command(BaseCommand):
+    help = "Runs the AI worker pool that processes queued consultations."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help="Number of worker threads. They share the loaded AI models.")
+        parser.add_argument('--poll-interval', type=float, default=settings.AI_WORKER_POLL_INTERVAL,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument('--once', action='store_true',
+                            help="Drain the queue and exit instead of polling forever.")
+
+    def handle(self, *args, **options):
+        self.poll_interval = options['poll_interval']
+        self.once = options['once']
+        self.stop_event = threading.Event()
+        n_workers = max(1, options['workers'])
+        host_id = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.stdout.write(f"[{time.strftime('%H:%M:%S')}] 🚀 AI worker pool started ({n_workers} worker(s), {host_id})")
+        requeue_stale_jobs()
+
+        if os.environ.get('MOCK_AI') != 'True' and not os.environ.get('AI_INFERENCE_SERVER'):
+            # Load the models while the first jobs are being claimed
+            from api import ai_processors # Registers the models
+            from api.model_registry import model_registry
+            model_registry.start_idle_reaper()
+            model_registry.warmup()
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(self._worker_loop, f"{host_id}#{i}") for i in range(n_workers)]
+            try:
+                for future in futures:
+                    future.result()
+            except KeyboardInterrupt:
+                self.stdout.write("Stopping workers after their current job...")
+                self.stop_event.set()
+
+        self.stdout.write(f"[{time.strftime('%H:%M:%S')}] AI worker pool stopped.")
+
+    def _worker_loop(self, worker_id):
+        failures = 0
+        while not self.stop_event.is_set():
+            try:
+                close_old_connections()
+                job = claim_next_job(worker_id)
+                if job is None:
+                    if self.once:
+                        break
+                    requeue_stale_jobs()
+                    failures = 0
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+                run_job(job)
+                failures = 0
+            except Exception as e:
+                # Keep the worker alive: a job it was running is requeued once stale
+                failures += 1
+                delay = min(MAX_ERROR_BACKOFF, self.poll_interval * 2 ** (failures - 1))
+                self.stderr.write(f"[{time.strftime('%H:%M:%S')}] ❌ Worker {worker_id}: {e}. Retrying in {delay:g}s.\n"
+                                  f"{traceback.format_exc()}")
+                connections.close_all() # Drop connections left broken by the error
+                self.stop_event.wait(delay)
+        close_old_connections()
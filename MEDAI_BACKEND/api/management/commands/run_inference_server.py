@@ -0,0 +1,38 @@
+import os
+from django.core.management.base import BaseCommand, CommandError
+from api.inference_client import InferenceServerError, inference_authkey, inference_server_address
+from api.inference_server import InferenceServer
+from api.model_registry import model_registry
+
+
+class Command(BaseCommand):
+    help = "Runs the shared inference server that holds MedGemma and MedASR for all web/worker processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--address',
+                            help="'host:port' or 'unix:/path/to/socket'. Defaults to AI_INFERENCE_SERVER.")
+
+    def handle(self, *args, **options):
+        if options['address']:
+            os.environ['AI_INFERENCE_SERVER'] = options['address']
+        address = inference_server_address()
+        if address is None:
+            raise CommandError("Set AI_INFERENCE_SERVER or pass --address.")
+        try:
+            inference_authkey()
+        except InferenceServerError as e:
+            raise CommandError(str(e))
+        if isinstance(address, tuple) and address[0] not in ('127.0.0.1', 'localhost', '::1'):
+            self.stdout.write(self.style.WARNING(
+                f"Listening on {address[0]}: anyone who can reach this port and knows AI_INFERENCE_AUTHKEY "
+                "can run code on this machine. Keep the port on a private network or firewall it."
+            ))
+
+        server = InferenceServer(address)
+        if os.environ.get('MOCK_AI') != 'True':
+            model_registry.start_idle_reaper()
+            model_registry.warmup()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            self.stdout.write("Inference server stopped.")
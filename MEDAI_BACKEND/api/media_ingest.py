@@ -0,0 +1,128 @@
+import io
+import os
+import time
+import numpy as np
+from PIL import Image, ImageOps
+from django.conf import settings
+from django.core.files.base import ContentFile
+try:
+    import librosa
+except ImportError:
+    librosa = None
+
+ASR_SAMPLE_RATE = 16000 # Required by MedASR
+MODEL_IMAGE_SIZE = 896 # MedGemma's vision encoder input resolution
+
+
+class MediaValidationError(Exception):
+    """Raised when an uploaded file cannot be used by the AI pipeline."""
+    def __init__(self, message, field='symptoms_audio'):
+        super().__init__(message)
+        self.field = field
+
+
+def prepare_study_media(study):
+    """Converts uploaded media once, at upload time, into model-ready derivatives."""
+    if study.image:
+        prepare_model_image(study)
+    if study.symptoms_audio:
+        normalize_audio(study)
+
+
+def prepare_model_image(study):
+    """
+    Writes a model-input derivative of the uploaded image next to `image`:
+    EXIF orientation applied, RGB, and downscaled so its shorter side is at most
+    MODEL_IMAGE_SIZE (the processor resizes to that square anyway). MedGemma reads
+    this small PNG instead of decoding the full-resolution upload on every analysis.
+    """
+    t0 = time.perf_counter()
+    try:
+        with Image.open(study.image.path) as img:
+            img = ImageOps.exif_transpose(img)
+            img = img.convert('RGB')
+    except Exception as e:
+        raise MediaValidationError(f"Could not read the image file: {e}", field='image')
+
+    original_size = img.size
+    scale = MODEL_IMAGE_SIZE / min(img.size)
+    if scale < 1:
+        new_size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(new_size, Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    # Saved through the field: the storage picks a free name instead of overwriting
+    # the derivative of another study whose upload had the same name
+    study.image_model_input.save(_model_image_name(study.image.name), ContentFile(buffer.getvalue()), save=False)
+    study.save(update_fields=['image_model_input', 'updated_at'])
+    print(f"[{time.strftime('%H:%M:%S')}] 🖼️ Image prepared for the model {original_size} -> {img.size} in {time.perf_counter() - t0:.2f}s")
+    return study.image_model_input.path
+
+
+def normalize_audio(study):
+    """
+    Decodes and resamples the uploaded audio into a 16 kHz mono float32 .npy file
+    stored next to `symptoms_audio`. MedASR memory-maps it instead of decoding the
+    original container again on every transcription.
+    """
+    if not librosa:
+        # The ASR stage will report the missing dependency
+        return None
+
+    t0 = time.perf_counter()
+    try:
+        audio, _ = librosa.load(study.symptoms_audio.path, sr=ASR_SAMPLE_RATE, mono=True)
+    except Exception as e:
+        raise MediaValidationError(f"Could not decode the audio file: {e}")
+
+    validate_audio(audio)
+
+    buffer = io.BytesIO()
+    np.save(buffer, audio.astype(np.float32, copy=False))
+    study.symptoms_audio_16k.save(_pcm_name(study.symptoms_audio.name), ContentFile(buffer.getvalue()), save=False)
+    study.save(update_fields=['symptoms_audio_16k', 'updated_at'])
+    print(f"[{time.strftime('%H:%M:%S')}] 🎚️ Audio normalized to 16 kHz ({len(audio) / ASR_SAMPLE_RATE:.1f}s) in {time.perf_counter() - t0:.2f}s")
+    return study.symptoms_audio_16k.path
+
+
+def delete_study_media(study):
+    """
+    Deletes the uploaded files of a study and their model-ready derivatives.
+    Only the files recorded on the study are touched: derivatives are saved
+    through their fields (under a name the storage made unique), so a file
+    named like them may belong to another study.
+    """
+    for field in (study.image, study.image_model_input, study.symptoms_audio, study.symptoms_audio_16k):
+        if field:
+            field.delete(save=False)
+
+
+def _model_image_name(image_name):
+    # The field's upload_to supplies the directory
+    return f"{os.path.splitext(os.path.basename(image_name))[0]}_model.png"
+
+
+def _pcm_name(audio_name):
+    return f"{os.path.splitext(os.path.basename(audio_name))[0]}_16k.npy"
+
+
+def validate_audio(audio):
+    """Checks shape and duration of a 16 kHz waveform."""
+    if audio.ndim != 1:
+        raise MediaValidationError("Audio must be mono.")
+    duration = len(audio) / ASR_SAMPLE_RATE
+    if duration < settings.AI_AUDIO_MIN_SECONDS:
+        raise MediaValidationError(f"Audio is too short ({duration:.1f}s).")
+    if duration > settings.AI_AUDIO_MAX_SECONDS:
+        raise MediaValidationError(f"Audio is too long ({duration:.1f}s, max {settings.AI_AUDIO_MAX_SECONDS}s).")
+    return duration
+
+
+def load_pcm(pcm_path):
+    """Memory-maps a normalized 16 kHz waveform written by normalize_audio."""
+    audio = np.load(pcm_path, mmap_mode='r')
+    if audio.dtype != np.float32 or audio.ndim != 1:
+        raise MediaValidationError(f"Unexpected normalized audio format: {audio.dtype}, {audio.ndim}D")
+    validate_audio(audio)
+    return audio, ASR_SAMPLE_RATE
@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import socket
+import atexit
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# In-process Prometheus-style metrics. The web server, the AI worker and the
+# inference server are separate processes, so each one periodically writes a
+# snapshot to AI_METRICS_DIR and /api/metrics/ merges them (counters,
+# gauges and histograms are summed across processes). A process that stops
+# refreshing its snapshot has exited: its file is dropped from the merge and
+# deleted, and its counters leave the totals like a restarted process'.
+
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 40, 80, 160, 320)
+FLUSH_INTERVAL = 2 # seconds
+HEARTBEAT_INTERVAL = 5 * FLUSH_INTERVAL # Snapshot rewritten at least this often, even when idle
+STALE_AFTER = 3 * HEARTBEAT_INTERVAL # Snapshots older than this belong to exited processes
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def snapshot(self):
+        with self._lock:
+            return {json.dumps(k): _copy(v) for k, v in self._values.items()}
+
+    def merged(self):
+        """{label values: value} summed across processes."""
+        return {tuple(json.loads(k)): v for k, v in REGISTRY.merged_snapshot().get(self.name, {}).items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        REGISTRY.mark_dirty()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+        REGISTRY.mark_dirty()
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.setdefault(key, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+        REGISTRY.mark_dirty()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._dirty = False
+        self._written_at = 0
+        self._flusher = None
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+
+    def mark_dirty(self):
+        self._dirty = True
+        if self._flusher is None:
+            with self._lock:
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True)
+                    self._flusher.start()
+                    atexit.register(self._remove_snapshot)
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def flush(self):
+        """Writes this process' snapshot for the other processes to merge."""
+        if not self._dirty and time.time() - self._written_at < HEARTBEAT_INTERVAL:
+            return
+        self._dirty = False
+        directory = metrics_dir()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, f"{_process_id()}.json")
+            written_at = time.time()
+            with open(path + ".tmp", 'w') as f:
+                json.dump({'written_at': written_at, 'metrics': self.snapshot()}, f)
+            os.replace(path + ".tmp", path)
+            self._written_at = written_at
+        except OSError as e:
+            print(f"Warning: could not write metrics snapshot: {e}")
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def _remove_snapshot(self):
+        try:
+            os.remove(os.path.join(metrics_dir(), f"{_process_id()}.json"))
+        except OSError:
+            pass
+
+    def merged_snapshot(self):
+        """This process' live values plus the latest snapshot of every other running process."""
+        merged = self.snapshot()
+        directory = metrics_dir()
+        own_file = f"{_process_id()}.json"
+        if os.path.isdir(directory):
+            for filename in os.listdir(directory):
+                if not filename.endswith(".json") or filename == own_file:
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    with open(path) as f:
+                        other = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if not isinstance(other.get('written_at'), (int, float)) or time.time() - other['written_at'] > STALE_AFTER:
+                    # Left behind by an exited (or killed) process
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                    continue
+                for name, series in other['metrics'].items():
+                    target = merged.setdefault(name, {})
+                    for key, value in series.items():
+                        target[key] = _add(target[key], value) if key in target else value
+        return merged
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)."""
+        merged = self.merged_snapshot()
+        lines = []
+        for name, metric in self._metrics.items():
+            lines.append(f"# HELP {name} {metric.documentation}")
+            lines.append(f"# TYPE {name} {metric.type}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                labels = list(zip(metric.labelnames, json.loads(key)))
+                if metric.type in ('counter', 'gauge'):
+                    lines.append(f"{name}{_labels(labels)} {_number(value)}")
+                    continue
+                for bound, count in zip(metric.buckets, value['buckets']):
+                    lines.append(f"{name}_bucket{_labels(labels + [('le', _number(bound))])} {count}")
+                lines.append(f"{name}_bucket{_labels(labels + [('le', '+Inf')])} {value['count']}")
+                lines.append(f"{name}_sum{_labels(labels)} {_number(value['sum'])}")
+                lines.append(f"{name}_count{_labels(labels)} {value['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def metrics_dir():
+    return os.environ.get("AI_METRICS_DIR") or os.path.join(tempfile.gettempdir(), "medai-metrics")
+
+
+def _process_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _copy(value):
+    if isinstance(value, dict):
+        return {'buckets': list(value['buckets']), 'sum': value['sum'], 'count': value['count']}
+    return value
+
+
+def _add(a, b):
+    if isinstance(a, dict):
+        return {
+            'buckets': [x + y for x, y in zip(a['buckets'], b['buckets'])],
+            'sum': a['sum'] + b['sum'],
+            'count': a['count'] + b['count'],
+        }
+    return a + b
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = Histogram(
+    'medai_stage_duration_seconds', 'Wall-clock duration of each AI pipeline stage.', ['stage'])
+QUEUE_WAIT_SECONDS = Histogram(
+    'medai_queue_wait_seconds', 'Time spent waiting in a queue before processing started.', ['queue'])
+MODEL_LOAD_SECONDS = Histogram(
+    'medai_model_load_seconds', 'Time to load an AI model into memory.', ['model'])
+PROMPT_TOKENS = Histogram(
+    'medai_prompt_tokens', 'Prompt tokens per generation call.', ['operation'], TOKEN_BUCKETS)
+GENERATED_TOKENS = Histogram(
+    'medai_generated_tokens', 'New tokens per generation call.', ['operation'], TOKEN_BUCKETS)
+TOKENS_PER_SECOND = Histogram(
+    'medai_generation_tokens_per_second', 'Decode throughput per generation call.', ['operation'], RATE_BUCKETS)
+GENERATION_QUEUE_DEPTH = Gauge(
+    'medai_generation_queue_depth', 'Generation requests waiting for the model, per priority class.', ['priority'])
+GENERATION_QUEUE_WAIT_SECONDS = Histogram(
+    'medai_generation_queue_wait_seconds', 'Time a generation request waited for the model, per priority class.', ['priority'])
+GENERATION_AGED_TOTAL = Counter(
+    'medai_generation_aged_total', 'Generation requests that ran ahead of higher priority work because of aging.', ['priority'])
+ADMISSION_ACTIVE = Gauge(
+    'medai_admission_active_requests', 'Requests admitted and running, per endpoint.', ['endpoint'])
+ADMISSION_QUEUED = Gauge(
+    'medai_admission_queued_requests', 'Requests waiting for admission, per endpoint.', ['endpoint'])
+ADMISSION_WAIT_SECONDS = Histogram(
+    'medai_admission_wait_seconds', 'Time a request waited for admission, per endpoint.', ['endpoint'])
+ADMISSION_REJECTED = Counter(
+    'medai_admission_rejected_total', 'Requests turned away by admission control (queue_full: 429, timeout and backlog: 503).', ['endpoint', 'reason'])
+IDEMPOTENT_REQUESTS = Counter(
+    'medai_idempotent_requests_total', 'Requests sent with an Idempotency-Key, by outcome (new, replayed, coalesced, mismatch, timeout, in_progress).', ['scope', 'outcome'])
+AI_CACHE_REQUESTS = Counter(
+    'medai_ai_cache_requests_total', 'AI result cache lookups, by kind and result (hit, miss).', ['kind', 'result'])
+KV_CACHE_REQUESTS = Counter(
+    'medai_kv_cache_requests_total', 'Triage attention cache lookups, by result (hit, prefix, miss).', ['result'])
+STAGE_ERRORS = Counter(
+    'medai_stage_errors_total', 'AI pipeline stages that raised an error.', ['stage'])
+
+
+def observe_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timed_stage(stage, timings=None, key=None):
+    """Times a block into medai_stage_duration_seconds (and `timings[key or stage]` if given)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    seconds = time.perf_counter() - t0
+    observe_stage(stage, seconds)
+    if timings is not None:
+        timings[key or stage] = round(seconds, 3)
+
+
+def observe_generation(operation, prompt_tokens, generated_tokens, seconds):
+    """Records token counts of a generation call and returns them for storing on the Study."""
+    stats = {'prompt_tokens': prompt_tokens, 'generated_tokens': generated_tokens, 'seconds': round(seconds, 3)}
+    if prompt_tokens is not None:
+        PROMPT_TOKENS.observe(prompt_tokens, operation=operation)
+    if generated_tokens is not None:
+        GENERATED_TOKENS.observe(generated_tokens, operation=operation)
+        if seconds > 0:
+            stats['tokens_per_second'] = round(generated_tokens / seconds, 2)
+            TOKENS_PER_SECOND.observe(stats['tokens_per_second'], operation=operation)
+    return stats
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 04:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_consultationjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='study',
+            name='stage_timings',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
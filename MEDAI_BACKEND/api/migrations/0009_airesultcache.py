@@ -0,0 +1,30 @@
+# Generated by Django 6.0.2 on 2026-10-17 04:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_study_stage_timings'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AIResultCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('FINDINGS', 'Image findings')], max_length=20)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('version', models.CharField(max_length=200)),
+                ('result', models.TextField()),
+                ('hits', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('kind', 'content_hash', 'version'), name='unique_ai_cache_entry')],
+            },
+        ),
+    ]
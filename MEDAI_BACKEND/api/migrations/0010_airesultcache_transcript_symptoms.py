@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 04:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_airesultcache'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='airesultcache',
+            name='kind',
+            field=models.CharField(choices=[('FINDINGS', 'Image findings'), ('TRANSCRIPT', 'Audio transcript'), ('SYMPTOMS', 'Extracted symptoms')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 04:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_airesultcache_transcript_symptoms'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='study',
+            name='symptoms_audio_16k',
+            field=models.FileField(blank=True, null=True, upload_to='studies/audio/'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 05:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_study_symptoms_audio_16k'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='study',
+            name='image_model_input',
+            field=models.ImageField(blank=True, null=True, upload_to='studies/images/'),
+        ),
+    ]
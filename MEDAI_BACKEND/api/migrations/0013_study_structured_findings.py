@@ -0,0 +1,140 @@
+# Generated by Django 6.0.2 on 2026-10-17 05:20
+
+import re
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Frozen copy of the api.findings parsers as of this migration: later changes to
+# the live parser must not change what this data migration writes.
+_SECTION = re.compile(r"\[(OBSERVATIONS|IRREGULARITIES|PATHOLOGIES)\]")
+_LIST_SPLIT = re.compile(r"[,;\n]")
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[\.\)])\s*")
+_RANKED_BLOCK = re.compile(r"Ranked Pre-diagnosis\s*:?(.*?)(?=\*\s*Clinical summary|\*\s*Suggested urgency|$)", re.IGNORECASE | re.DOTALL)
+_RANKED_ITEM = re.compile(r"(?<!\w)(\d{1,2})[\.\)]\s*")
+_URGENCY = re.compile(r"urgency level\s*:?\s*\**\s*\[?\s*(low|medium|high)", re.IGNORECASE)
+
+
+def parse_findings(text):
+    parts = _SECTION.split(text or "")
+    sections = {name: body.strip() for name, body in zip(parts[1::2], parts[2::2])}
+    if set(sections) != {'OBSERVATIONS', 'IRREGULARITIES', 'PATHOLOGIES'}:
+        return None
+    return {
+        'observations': sections['OBSERVATIONS'],
+        'irregularities': sections['IRREGULARITIES'],
+        'pathologies': parse_pathology_list(sections['PATHOLOGIES']),
+    }
+
+
+def parse_pathology_list(text):
+    text = text.strip().split("\n\n")[0]
+    names = []
+    for item in _LIST_SPLIT.split(text):
+        item = _LIST_MARKER.sub("", item).strip(" .*:")
+        if item and normalize_pathology(item) not in [normalize_pathology(n) for n in names]:
+            names.append(item)
+    return names
+
+
+def normalize_pathology(name):
+    name = re.sub(r"\(.*?\)", "", name)
+    return " ".join(name.lower().split())[:120]
+
+
+def parse_diagnosis(text):
+    text = (text or "").split("[DIAGNOSIS]")[-1].strip()
+    ranked = []
+    block = _RANKED_BLOCK.search(text)
+    parts = _RANKED_ITEM.split(block.group(1)) if block else []
+    for rank, item in zip(parts[1::2], parts[2::2]):
+        if int(rank) != len(ranked) + 1:
+            if ranked:
+                ranked[-1]['reason'] += f" {rank}. {item.strip()}"
+            continue
+        condition, _, reason = item.strip().partition(" - ")
+        ranked.append({'rank': int(rank), 'condition': condition.strip(" *[]"), 'reason': reason.strip(" *[]\n")})
+    urgency = _URGENCY.search(text)
+    return {
+        'text': text,
+        'ranked': ranked,
+        'urgency': urgency.group(1).upper() if urgency else None,
+    }
+
+
+def parse_existing_studies(apps, schema_editor):
+    """Fills the structured fields for studies processed before they existed."""
+    Study = apps.get_model('api', 'Study')
+    StudyPathology = apps.get_model('api', 'StudyPathology')
+    for study in Study.objects.exclude(medgemma_result__isnull=True).iterator():
+        parsed = parse_findings(study.medgemma_result)
+        if parsed:
+            study.findings_observations = parsed['observations']
+            study.findings_irregularities = parsed['irregularities']
+            StudyPathology.objects.bulk_create([
+                StudyPathology(study=study, name=normalize_pathology(label), label=label[:200], rank=rank)
+                for rank, label in enumerate(parsed['pathologies'], start=1)
+            ])
+        for msg in reversed(study.triage_history or []):
+            content = msg.get('content', [])
+            if not isinstance(content, list):
+                content = [{'text': str(content)}]
+            text = "".join(item.get('text', '') for item in content if isinstance(item, dict))
+            if msg.get('role') == 'assistant' and '[DIAGNOSIS]' in text:
+                diagnosis = parse_diagnosis(text)
+                study.final_diagnosis = diagnosis['text']
+                study.ranked_diagnosis = diagnosis['ranked']
+                study.urgency = diagnosis['urgency']
+                break
+        study.save(update_fields=['findings_observations', 'findings_irregularities',
+                                  'final_diagnosis', 'ranked_diagnosis', 'urgency'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_study_image_model_input'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='study',
+            name='final_diagnosis',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='study',
+            name='findings_irregularities',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='study',
+            name='findings_observations',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='study',
+            name='ranked_diagnosis',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='study',
+            name='urgency',
+            field=models.CharField(blank=True, choices=[('LOW', 'Low'), ('MEDIUM', 'Medium'), ('HIGH', 'High')], db_index=True, max_length=10, null=True),
+        ),
+        migrations.CreateModel(
+            name='StudyPathology',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(db_index=True, max_length=120)),
+                ('label', models.CharField(max_length=200)),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('study', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pathologies', to='api.study')),
+            ],
+            options={
+                'ordering': ['study', 'rank'],
+                'constraints': [models.UniqueConstraint(fields=('study', 'name'), name='unique_study_pathology')],
+            },
+        ),
+        migrations.RunPython(parse_existing_studies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0.2 on 2026-10-17 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_study_structured_findings'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='study',
+            name='generation_stats',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from .cpu_backend import inference_backend, cpu_backend_config, load_dtype
+
+# Local, already-converted copies of the Hub models (see `python manage.py
+# build_model_artifacts`). Loading one skips the Hub round trips and, for the
+# GPU, the on-the-fly NF4 quantization: the safetensors shards are memory-mapped
+# and copied straight to the device.
+#
+# - AI_MODEL_ARTIFACT_DIR: where artifacts live (default: model_artifacts/ next to manage.py).
+# - AI_MODEL_ARTIFACTS=False: ignore artifacts and always load from the Hub.
+# - AI_MODEL_ARTIFACT_VERIFY: 'stat' (default: size and modification time, files
+#   whose mtime changed, e.g. after a copy, are checksummed once), 'sha256'
+#   (checksum of every file, as `build_model_artifacts --verify` does), 'size' or 'none'.
+
+MANIFEST_NAME = "medai_artifact.json"
+ARTIFACT_FORMAT = 1
+
+
+class ArtifactError(Exception):
+    pass
+
+
+def artifact_root():
+    default = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "model_artifacts")
+    return os.environ.get("AI_MODEL_ARTIFACT_DIR") or default
+
+
+def artifact_variant(gpu_variant):
+    """Artifacts depend on the backend: 'nf4' (or fp32) weights for the GPU, plain dtype weights for the CPU."""
+    if inference_backend() == 'cpu':
+        # Dynamic int8 quantization can't be serialized: it runs at load time (takes seconds)
+        return f"cpu-{str(load_dtype(cpu_backend_config())).replace('torch.', '')}"
+    return gpu_variant
+
+
+def artifact_path(model_id, variant):
+    return os.path.join(artifact_root(), f"{model_id.replace('/', '--')}-{variant}")
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _artifact_files(directory):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name != MANIFEST_NAME:
+                path = os.path.join(root, name)
+                yield os.path.relpath(path, directory).replace(os.sep, '/'), path
+
+
+def write_manifest(directory, model_id, variant, revision, source_revision, extra=None):
+    """Records what the artifact was built from and the checksum of every file."""
+    manifest = {
+        'format': ARTIFACT_FORMAT,
+        'model_id': model_id,
+        'variant': variant,
+        'revision': revision, # As requested when building (None = default branch)
+        'source_revision': source_revision, # Hub commit the weights came from
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'files': {
+            name: {'size': os.path.getsize(path), 'mtime_ns': os.stat(path).st_mtime_ns, 'sha256': _sha256(path)}
+            for name, path in _artifact_files(directory)
+        },
+        **(extra or {}),
+    }
+    _save_manifest(directory, manifest)
+    return manifest
+
+
+def _save_manifest(directory, manifest):
+    # Written aside and swapped in: processes loading the artifact never read half a manifest
+    path = os.path.join(directory, MANIFEST_NAME)
+    with open(f"{path}.tmp-{os.getpid()}", 'w') as f:
+        json.dump(manifest, f, indent=2, default=str)
+    os.replace(f"{path}.tmp-{os.getpid()}", path)
+
+
+def read_manifest(directory):
+    try:
+        with open(os.path.join(directory, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def verify_artifact(directory, manifest, mode=None):
+    """Raises ArtifactError if a file is missing, changed or unexpected."""
+    mode = mode or os.environ.get("AI_MODEL_ARTIFACT_VERIFY", "stat")
+    if mode == 'none':
+        return
+    present = dict(_artifact_files(directory))
+    if set(present) != set(manifest['files']):
+        missing = sorted(set(manifest['files']) - set(present))
+        extra = sorted(set(present) - set(manifest['files']))
+        raise ArtifactError(f"files differ from the manifest (missing: {missing}, unexpected: {extra})")
+    rehashed = False
+    for name, expected in manifest['files'].items():
+        stat = os.stat(present[name])
+        if stat.st_size != expected['size']:
+            raise ArtifactError(f"{name} has the wrong size")
+        if mode == 'size' or (mode == 'stat' and stat.st_mtime_ns == expected.get('mtime_ns')):
+            continue
+        if _sha256(present[name]) != expected['sha256']:
+            raise ArtifactError(f"{name} does not match its checksum")
+        if expected.get('mtime_ns') != stat.st_mtime_ns:
+            expected['mtime_ns'] = stat.st_mtime_ns
+            rehashed = True
+    if rehashed:
+        # The checksums still match (e.g. the artifact was copied): later loads only compare the mtimes
+        try:
+            _save_manifest(directory, manifest)
+        except OSError:
+            pass # Read-only artifact directory
+
+
+def find_artifact(model_id, variant, revision=None):
+    """
+    Path of a valid local artifact for this model/variant, or None to load from the Hub.
+    With a pinned `revision` (branch, tag or commit) the artifact must have been built from it.
+    """
+    if os.environ.get("AI_MODEL_ARTIFACTS") == "False":
+        return None
+    directory = artifact_path(model_id, variant)
+    manifest = read_manifest(directory)
+    if manifest is None:
+        return None
+
+    problem = None
+    if manifest.get('format') != ARTIFACT_FORMAT or manifest.get('model_id') != model_id or manifest.get('variant') != variant:
+        problem = "built for another model, variant or format"
+    elif revision and revision != manifest.get('revision') and not manifest.get('source_revision', '').startswith(revision):
+        problem = f"built from revision {manifest.get('source_revision')}, expected {revision}"
+    else:
+        try:
+            t0 = time.perf_counter()
+            verify_artifact(directory, manifest)
+            print(f"[{time.strftime('%H:%M:%S')}] 📦 Artifact {directory} verified in {time.perf_counter() - t0:.1f}s "
+                  f"(revision {manifest['source_revision'][:12]}).")
+        except ArtifactError as e:
+            problem = str(e)
+    if problem:
+        print(f"Warning: ignoring model artifact {directory}: {problem}. Loading from the Hub instead.")
+        return None
+    return directory
+
+
+def save_artifact(pipe, model_id, variant, revision, source_revision, force=False):
+    """Serializes a loaded pipeline (weights + processor/tokenizer) as a verified artifact."""
+    directory = artifact_path(model_id, variant)
+    if os.path.exists(directory) and not force:
+        raise ArtifactError(f"{directory} already exists (use --force to rebuild it)")
+    # Build next to the final location, then swap it in: a half-written artifact is never picked up
+    staging = f"{directory}.tmp-{os.getpid()}"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    try:
+        pipe.model.save_pretrained(staging)
+        for component in ('processor', 'tokenizer', 'feature_extractor', 'image_processor'):
+            if getattr(pipe, component, None) is not None:
+                getattr(pipe, component).save_pretrained(staging)
+        extra = {'versions': _library_versions()}
+        quantization = getattr(pipe.model.config, 'quantization_config', None)
+        if quantization is not None:
+            extra['quantization_config'] = quantization if isinstance(quantization, dict) else quantization.to_dict()
+        manifest = write_manifest(staging, model_id, variant, revision, source_revision, extra)
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(staging, directory)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return directory, manifest
+
+
+def resolve_revision(model_id, revision=None, token=None):
+    """Commit hash on the Hub for a branch/tag/commit (default branch if None)."""
+    from huggingface_hub import HfApi
+    return HfApi(token=token).model_info(model_id, revision=revision).sha
+
+
+def _library_versions():
+    versions = {}
+    for name in ('torch', 'transformers', 'bitsandbytes', 'safetensors'):
+        try:
+            versions[name] = __import__(name).__version__
+        except Exception:
+            pass
+    return versions
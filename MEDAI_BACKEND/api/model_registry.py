@@ -0,0 +1,193 @@
+import os
+import gc
+import time
+import threading
+from contextlib import contextmanager
+from .metrics import MODEL_LOAD_SECONDS
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class ManagedModel:
+    """A model owned by the registry, with its load state and usage bookkeeping."""
+    def __init__(self, name, loader, estimate_mb, on_unload=None):
+        self.name = name
+        self.loader = loader
+        self.estimate_bytes = estimate_mb * 1024 * 1024
+        self.on_unload = on_unload
+
+        self.state = 'UNLOADED' # UNLOADED -> LOADING -> READY (or FAILED)
+        self.instance = None
+        self.error = None
+        self.load_seconds = None
+        self.memory_bytes = 0
+        self.last_used = None
+        self.in_use = 0
+        self.lock = threading.Lock()
+
+    def status(self):
+        return {
+            'state': self.state,
+            'load_seconds': self.load_seconds,
+            'memory_mb': round(self.memory_bytes / (1024 * 1024), 1),
+            'idle_seconds': round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+            'in_use': self.in_use,
+            'error': self.error,
+        }
+
+
+class ModelRegistry:
+    """
+    Owns the AI models: loading, background warmup, idle unloading and a
+    memory budget deciding which models stay resident.
+
+    - AI_MODEL_MEMORY_BUDGET_MB: total RAM/VRAM the models may use (0 = unlimited).
+      Loading a model that does not fit unloads the least recently used idle ones.
+    - AI_MODEL_IDLE_UNLOAD_SECONDS: unload models unused for that long (0 = never).
+    """
+    def __init__(self, budget_mb=None, idle_unload_seconds=None):
+        budget_mb = budget_mb if budget_mb is not None else int(os.environ.get("AI_MODEL_MEMORY_BUDGET_MB", 0))
+        self.budget_bytes = budget_mb * 1024 * 1024
+        self.idle_unload_seconds = (idle_unload_seconds if idle_unload_seconds is not None
+                                    else int(os.environ.get("AI_MODEL_IDLE_UNLOAD_SECONDS", 0)))
+        self._models = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def register(self, name, loader, estimate_mb, on_unload=None):
+        self._models[name] = ManagedModel(name, loader, estimate_mb, on_unload)
+
+    def get(self, name):
+        """Returns the loaded model, loading it (blocking) if needed."""
+        model = self._models[name]
+        with model.lock:
+            if model.instance is None:
+                self._load(model)
+            model.last_used = time.monotonic()
+            return model.instance
+
+    @contextmanager
+    def use(self, name):
+        """Like get(), but the model cannot be unloaded while the block runs."""
+        model = self._models[name]
+        with self._lock:
+            model.in_use += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._lock:
+                model.in_use -= 1
+            model.last_used = time.monotonic()
+
+    def warmup(self, names=None, background=True):
+        """Loads models ahead of the first request, by default on a background thread."""
+        names = names or list(self._models)
+
+        def _warm():
+            for name in names:
+                try:
+                    self.get(name)
+                except Exception as e:
+                    print(f"Warning: AI model warmup failed for {name}: {e}")
+
+        if not background:
+            _warm()
+            return None
+        thread = threading.Thread(target=_warm, name="model-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def unload(self, name):
+        model = self._models[name]
+        with model.lock:
+            self._unload(model)
+
+    def status(self):
+        return {name: model.status() for name, model in self._models.items()}
+
+    def is_ready(self, names=None):
+        names = names or list(self._models)
+        return all(self._models[n].state == 'READY' for n in names)
+
+    def start_idle_reaper(self, interval=60):
+        """Starts the thread that unloads idle models (no-op if idle unloading is disabled)."""
+        if not self.idle_unload_seconds or self._reaper is not None:
+            return
+        self._reaper = threading.Thread(target=self._reap_loop, args=(interval,), name="model-reaper", daemon=True)
+        self._reaper.start()
+
+    def _reap_loop(self, interval):
+        while True:
+            time.sleep(interval)
+            now = time.monotonic()
+            for model in list(self._models.values()):
+                idle = model.last_used is not None and now - model.last_used > self.idle_unload_seconds
+                if model.state == 'READY' and model.in_use == 0 and idle:
+                    print(f"[{time.strftime('%H:%M:%S')}] 💤 Unloading idle model {model.name}.")
+                    self.unload(model.name)
+
+    def _load(self, model):
+        self._make_room_for(model)
+        model.state = 'LOADING'
+        model.error = None
+        t0 = time.perf_counter()
+        try:
+            model.instance = model.loader()
+        except Exception as e:
+            model.state = 'FAILED'
+            model.error = str(e)
+            raise
+        model.load_seconds = round(time.perf_counter() - t0, 2)
+        MODEL_LOAD_SECONDS.observe(model.load_seconds, model=model.name)
+        model.memory_bytes = _memory_footprint(model.instance) or model.estimate_bytes
+        model.state = 'READY'
+        print(f"[{time.strftime('%H:%M:%S')}] Model {model.name} ready in {model.load_seconds}s ({model.memory_bytes // (1024 * 1024)} MB).")
+
+    def _unload(self, model):
+        if model.instance is None:
+            return
+        model.instance = None
+        model.memory_bytes = 0
+        model.state = 'UNLOADED'
+        if model.on_unload:
+            model.on_unload()
+        gc.collect()
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def _make_room_for(self, incoming):
+        """Unloads least recently used idle models until `incoming` fits the budget."""
+        if not self.budget_bytes:
+            return
+        resident = [m for m in self._models.values() if m is not incoming and m.instance is not None]
+        used = sum(m.memory_bytes for m in resident)
+        for model in sorted(resident, key=lambda m: m.last_used or 0):
+            if used + incoming.estimate_bytes <= self.budget_bytes:
+                return
+            # Skip models in use or being loaded/unloaded by another thread
+            if model.in_use or not model.lock.acquire(blocking=False):
+                continue
+            try:
+                print(f"[{time.strftime('%H:%M:%S')}] Unloading {model.name} to fit {incoming.name} in the memory budget.")
+                used -= model.memory_bytes
+                self._unload(model)
+            finally:
+                model.lock.release()
+        if used + incoming.estimate_bytes > self.budget_bytes:
+            print(f"Warning: {incoming.name} exceeds the AI model memory budget, loading anyway.")
+
+
+def _memory_footprint(pipe):
+    model = getattr(pipe, 'model', None)
+    if model is not None and hasattr(model, 'get_memory_footprint'):
+        try:
+            return model.get_memory_footprint()
+        except Exception:
+            return 0
+    return 0
+
+
+model_registry = ModelRegistry()
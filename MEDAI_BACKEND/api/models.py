@@ -1,5 +1,7 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
+from .findings import URGENCY_CHOICES
 
 class Patient(models.Model):
     first_name = models.CharField(max_length=100)
@@ -37,7 +39,9 @@ class Study(models.Model):
 
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='studies')
     image = models.ImageField(upload_to='studies/images/')
+    image_model_input = models.ImageField(upload_to='studies/images/', null=True, blank=True) # Oriented, RGB, downscaled at upload
     symptoms_audio = models.FileField(upload_to='studies/audio/', null=True, blank=True)
+    symptoms_audio_16k = models.FileField(upload_to='studies/audio/', null=True, blank=True) # Decoded at upload for MedASR
     
     # AI Results
     medgemma_result = models.TextField(null=True, blank=True)
@@ -48,6 +52,18 @@ class Study(models.Model):
     triage_history = models.JSONField(null=True, blank=True)
     triage_completed = models.BooleanField(default=False)
     
+    # Per-stage wall-clock seconds of the AI pipeline (image_analysis, asr, ...)
+    stage_timings = models.JSONField(null=True, blank=True)
+    # Prompt/generated tokens and tokens/s per generation call (findings, symptoms, triage)
+    generation_stats = models.JSONField(null=True, blank=True)
+
+    # Parsed once from the model output (see findings.py)
+    findings_observations = models.TextField(null=True, blank=True)
+    findings_irregularities = models.TextField(null=True, blank=True)
+    final_diagnosis = models.TextField(null=True, blank=True) # [DIAGNOSIS] block of the triage
+    ranked_diagnosis = models.JSONField(null=True, blank=True) # [{"rank", "condition", "reason"}, ...]
+    urgency = models.CharField(max_length=10, choices=URGENCY_CHOICES, null=True, blank=True, db_index=True)
+    
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='PENDING')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -55,6 +71,22 @@ class Study(models.Model):
     def __str__(self):
         return f"Study {self.id} - {self.patient}"
 
+class StudyPathology(models.Model):
+    """A pathology suggested by the image findings, normalized for lookups (e.g. all 'pneumonia' studies)."""
+    study = models.ForeignKey(Study, on_delete=models.CASCADE, related_name='pathologies')
+    name = models.CharField(max_length=120, db_index=True) # Normalized: lowercase, single-spaced
+    label = models.CharField(max_length=200) # As written by the model
+    rank = models.PositiveSmallIntegerField() # 1 = most likely
+
+    class Meta:
+        ordering = ['study', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['study', 'name'], name='unique_study_pathology'),
+        ]
+
+    def __str__(self):
+        return f"{self.label} - Study {self.study_id}"
+
 class ClinicalReport(models.Model):
     study = models.OneToOneField(Study, on_delete=models.CASCADE, related_name='report')
     doctor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
@@ -79,3 +111,80 @@ class MedicalHistory(models.Model):
 
     def __str__(self):
         return f"{self.title} - {self.patient}"
+
+class ConsultationJob(models.Model):
+    """DB-backed queue entry that runs the AI consultation pipeline for a Study."""
+    STATUS_CHOICES = [
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('FAILED', 'Failed'),
+    ]
+
+    study = models.ForeignKey(Study, on_delete=models.CASCADE, related_name='jobs')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='QUEUED')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    last_error = models.TextField(null=True, blank=True)
+    worker = models.CharField(max_length=100, null=True, blank=True)
+
+    available_at = models.DateTimeField(default=timezone.now) # Retry backoff
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['available_at', 'id']
+        indexes = [models.Index(fields=['status', 'available_at'])]
+
+    def __str__(self):
+        return f"Job {self.id} ({self.status}) - Study {self.study_id}"
+
+class AIResultCache(models.Model):
+    """Persistent cache of deterministic AI outputs, keyed by a hash of the input content."""
+    KIND_CHOICES = [
+        ('FINDINGS', 'Image findings'),
+        ('TRANSCRIPT', 'Audio transcript'),
+        ('SYMPTOMS', 'Extracted symptoms'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    content_hash = models.CharField(max_length=64) # sha256 of the input
+    version = models.CharField(max_length=200) # model id + prompt version
+    result = models.TextField()
+    hits = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['kind', 'content_hash', 'version'], name='unique_ai_cache_entry'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} {self.content_hash[:12]} ({self.version})"
+
+class IdempotencyKey(models.Model):
+    """Outcome of a request sent with an Idempotency-Key header, replayed to its retries."""
+    STATUS_CHOICES = [
+        ('IN_PROGRESS', 'In progress'),
+        ('COMPLETED', 'Completed'),
+    ]
+
+    scope = models.CharField(max_length=100) # Endpoint (and study) the key belongs to
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64) # sha256 of the request fields and files
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='IN_PROGRESS')
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_body = models.JSONField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} ({self.status})"
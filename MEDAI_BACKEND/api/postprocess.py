@@ -0,0 +1,145 @@
+import re
+
+# Post-processing of model output. Runs on every generation, so all patterns are
+# compiled once at import and each helper makes a single pass over the text.
+
+ACTION_TAGS = ("[DIAGNOSIS]", "[ASK]")
+
+# Keywords that indicate the model is just echoing the prompt instructions
+NOISE_KEYWORDS = [
+    "Summarize the relationship", "State the medical conclusion", "List the recommended next steps",
+    "(Escribe aquí", "Target Format:", "Plan:", "I will", "I need", "**Plan", "translate"
+]
+# One alternation instead of one re.sub per keyword: strips any run of echoes and
+# "(...)" placeholders (and the ":", "**", "-" around them) from the beginning of a section
+_LEADING_NOISE = re.compile(
+    r"^[*:\s-]*(?:(?:\([^)\n]*\)|" + "|".join(re.escape(k) for k in NOISE_KEYWORDS) + r")[*:\s-]*)+",
+    re.IGNORECASE
+)
+_SECTION = re.compile(r"(##\s+[A-ZÁÉÍÓÚÑ -]+)(.*?)(?=##|\Z)", re.DOTALL | re.IGNORECASE)
+
+_RULE_ECHO = re.compile(r"^\d+[\.\)]\s*(?:Formal|Integrate|Start|Follow|No internal|Only|Summary|Explain)", re.IGNORECASE)
+_ECHO_MARKERS = re.compile("FORBIDDEN|OBLIGATORIO|REGLAS CRÍTICAS|EJEMPLO")
+_LEADING_THOUGHT = re.compile(r"^(?:thought|reasoning|plan).*?\n", re.IGNORECASE)
+
+_BULLET_PREFIX = re.compile(r"^[ \-*·•]+", re.MULTILINE)
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?]) +|[\n\r\*\|]+")
+_REPEATED_LABEL = re.compile(r"^(?:FINDINGS|IMPRESSION|DIAGNOSIS|RESULTADOS|HALLAZGOS):", re.IGNORECASE)
+_NON_ALNUM = re.compile(r"[^a-z0-9]")
+MAX_FINDINGS = 15
+
+_ASR_SPECIAL_TOKENS = re.compile(r"</s>|<epsilon>")
+# Allow Spanish characters: a-z, 0-9, spaces, apostrophes, and accents/ñ
+_ASR_DISALLOWED = re.compile(r"[^ a-z0-9'áéíóúñ]+")
+
+
+def clean_ai_output(raw_text):
+    """Keeps the last [ASK]/[DIAGNOSIS] block (the notebook's rfind logic)."""
+    pos = max(raw_text.rfind(tag) for tag in ACTION_TAGS)
+    return raw_text[pos:].strip() if pos >= 0 else raw_text.strip()
+
+
+class StreamingOutputCleaner:
+    """
+    Incremental clean_ai_output for streamed generations: feed() the chunks as
+    they arrive and result() returns the same text clean_ai_output would on the
+    whole output. Each chunk is scanned once, line by line (tags never span lines),
+    so the work per token does not grow with the length of the output.
+    """
+    def __init__(self):
+        self._lines = []
+        self._length = 0 # Characters in complete lines
+        self._partial = [] # Chunks of the line still being generated
+        self._block_start = -1
+
+    def feed(self, chunk):
+        last_break = chunk.rfind("\n")
+        if last_break < 0:
+            self._partial.append(chunk)
+            return
+        self._partial.append(chunk[:last_break + 1])
+        self._scan("".join(self._partial))
+        self._partial = [chunk[last_break + 1:]]
+
+    def result(self):
+        if self._partial:
+            self._scan("".join(self._partial))
+            self._partial = []
+        text = "".join(self._lines)
+        return text[self._block_start:].strip() if self._block_start >= 0 else text.strip()
+
+    def _scan(self, lines):
+        pos = max(lines.rfind(tag) for tag in ACTION_TAGS)
+        if pos >= 0:
+            self._block_start = self._length + pos
+        self._lines.append(lines)
+        self._length += len(lines)
+
+
+def clean_integrated_report(raw_text):
+    """Surgically cleans only the integrated report, removing AI plans/thought blocks."""
+    # 1. Recovery: Mandatory start at first header
+    start = raw_text.find("##")
+    if start >= 0:
+        raw_text = raw_text[start:].strip()
+
+    # 2. Rule-Stripper: drop lines that echo the prompt rules
+    cleaned_text = "\n".join(
+        line for line in raw_text.split("\n")
+        if not _RULE_ECHO.match(line) and not _ECHO_MARKERS.search(line)
+    ).strip()
+
+    # 3. Final polish
+    return _LEADING_THOUGHT.sub("", cleaned_text, count=1)
+
+
+def extract_medical_sections(text):
+    """Surgically extracts ## headers and their content, discarding everything else."""
+    valid_sections = []
+    for match in _SECTION.finditer(text):
+        header = match.group(1).strip()
+        content = _LEADING_NOISE.sub("", match.group(2).strip())
+        if len(content) > 5:
+            valid_sections.append(f"{header}\n{content.strip()}")
+
+    if valid_sections:
+        return "\n\n".join(valid_sections)
+    return text
+
+
+def deduplicate_sentences(text):
+    """Removes redundant sentences or keywords that are semantically very similar."""
+    if not text:
+        return ""
+
+    # Clean up any existing bullet prefixes to avoid "- - -"
+    text = _BULLET_PREFIX.sub("", text)
+
+    unique_parts = []
+    seen_normalized = set()
+    # Split by typical sentence enders OR common delimiters used by this model (*, -, \n, |)
+    for p in _SENTENCE_SPLIT.split(text):
+        p = p.strip()
+        if not p:
+            continue
+        # Remove "FINDINGS:" or "IMPRESSION:" prefix if model repeats it inside the section
+        p = _REPEATED_LABEL.sub("", p).strip()
+        norm = _NON_ALNUM.sub("", p.lower())
+        # Avoid too short junk but allow common medical short terms (e.g. "CHF")
+        if len(norm) < 3 or norm in seen_normalized:
+            continue
+        seen_normalized.add(norm)
+        unique_parts.append(p)
+        # Limit to the top findings to prevent runaway loops
+        if len(unique_parts) == MAX_FINDINGS:
+            break
+
+    return "\n".join(" - " + s for s in unique_parts).strip()
+
+
+def normalize_transcript(text):
+    """Standard MedASR normalization from the user notebook."""
+    if not text:
+        return ""
+    text = _ASR_SPECIAL_TOKENS.sub("", text.lower())
+    return " ".join(_ASR_DISALLOWED.sub(" ", text).split())
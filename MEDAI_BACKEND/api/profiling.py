@@ -0,0 +1,190 @@
+import os
+import time
+import uuid
+import random
+import pstats
+import cProfile
+import threading
+from functools import wraps
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+# Opt-in profiling of the inference path (see AI_PROFILING_* in settings).
+# A profiled section writes <id>-<label>.pstats (cProfile, open with `python -m pstats`
+# or snakeviz) to AI_PROFILING_DIR; sections that run the model also write
+# <id>-<label>.trace.json (torch profiler, open in chrome://tracing or Perfetto).
+
+PROFILE_HEADER = 'HTTP_X_MEDAI_PROFILE' # X-MedAI-Profile: 1
+PROFILE_ID_HEADER = 'X-MedAI-Profile-Id'
+
+_state = threading.local()
+# Profile id of the section whose torch trace is being recorded, or None
+_torch_session = None
+_torch_lock = threading.Lock()
+# Profile id of the section cProfile is recording, or None. Since Python 3.12 cProfile
+# runs on sys.monitoring: one profiler per process, and it sees every thread.
+_cprofile_session = None
+_cprofile_lock = threading.Lock()
+
+
+def current_profile_id():
+    """Id of the profiling session running on this thread, or None."""
+    return getattr(_state, 'profile_id', None)
+
+
+def should_profile(request=None):
+    if request is not None and settings.AI_PROFILING_ALLOW_HEADER:
+        if request.META.get(PROFILE_HEADER, '').lower() in ('1', 'true', 'yes'):
+            return True
+    return settings.AI_PROFILING_ENABLED and random.random() < settings.AI_PROFILING_SAMPLE_RATE
+
+
+@contextmanager
+def profile_section(label, request=None, profile_id=None, trace_torch=False):
+    """
+    Profiles the block with cProfile when this request is selected: by header, by
+    the process-wide sample rate, or because `profile_id` continues a session
+    started on another thread. Nested sections on the same thread are part of the
+    outer one. Yields the session id (None when not profiling).
+
+    One section is recorded by cProfile at a time per process and the profile
+    covers every thread meanwhile: a section of the same session (e.g. the
+    generation of a profiled request) is part of it, a section of another session
+    is skipped with a log line.
+
+    With `trace_torch` (sections that run the model on their own thread) a torch
+    profiler trace is recorded too. torch allows one profiler per process and only
+    sees ops of the thread that started it, so traces are taken one at a time.
+    """
+    if current_profile_id() is not None:
+        yield current_profile_id()
+        return
+    if profile_id is None:
+        if not should_profile(request):
+            yield None
+            return
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+
+    profiler = _start_cprofile(profile_id, label)
+    _state.profile_id = profile_id
+    started = time.perf_counter()
+    torch_prof = None
+    try:
+        if trace_torch:
+            torch_prof = _start_torch_profiler(profile_id)
+        with _torch_range(label, torch_prof):
+            yield profile_id
+    finally:
+        _state.profile_id = None
+        if profiler is not None:
+            _stop_cprofile(profiler)
+        if torch_prof is not None:
+            _stop_torch_profiler(torch_prof)
+        _write(profile_id, label, profiler, torch_prof, time.perf_counter() - started)
+
+
+def profiled_view(label):
+    """Decorator for APIView methods: profiles the request and returns the session id in a header."""
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, request, *args, **kwargs):
+            with profile_section(label, request=request) as profile_id:
+                response = method(self, request, *args, **kwargs)
+            if profile_id:
+                response[PROFILE_ID_HEADER] = profile_id
+            return response
+        return wrapper
+    return decorator
+
+
+def _start_cprofile(profile_id, label):
+    """Starts cProfile for a section, unless another section is being recorded."""
+    global _cprofile_session
+    with _cprofile_lock:
+        if _cprofile_session is not None:
+            if _cprofile_session != profile_id:
+                print(f"Profile {profile_id}: cProfile of {label} skipped, profile {_cprofile_session} is being recorded.")
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiling tool is active (e.g. a debugger)
+            print(f"Profile {profile_id}: cProfile of {label} skipped ({e}).")
+            return None
+        _cprofile_session = profile_id
+        return profiler
+
+
+def _stop_cprofile(profiler):
+    global _cprofile_session
+    try:
+        profiler.disable()
+    finally:
+        with _cprofile_lock:
+            _cprofile_session = None
+
+
+def _start_torch_profiler(profile_id):
+    """Starts a torch trace on this thread, unless another section is already being traced."""
+    global _torch_session
+    if torch is None or not settings.AI_PROFILING_TORCH:
+        return None
+    with _torch_lock:
+        if _torch_session is not None:
+            print(f"Profile {profile_id}: torch trace skipped, profile {_torch_session} is being traced.")
+            return None
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        torch_prof = torch.profiler.profile(activities=activities, record_shapes=True)
+        try:
+            torch_prof.__enter__()
+        except Exception as e:
+            print(f"Warning: could not start the torch profiler: {e}")
+            return None
+        _torch_session = profile_id
+        return torch_prof
+
+
+def _stop_torch_profiler(torch_prof):
+    global _torch_session
+    try:
+        torch_prof.__exit__(None, None, None)
+    finally:
+        with _torch_lock:
+            _torch_session = None
+
+
+def _torch_range(label, torch_prof):
+    """Names the section in its trace."""
+    if torch_prof is None:
+        return nullcontext()
+    return torch.profiler.record_function(label)
+
+
+def _write(profile_id, label, profiler, torch_prof, seconds):
+    if profiler is None and torch_prof is None:
+        return
+    directory = settings.AI_PROFILING_DIR
+    base = os.path.join(directory, f"{profile_id}-{label}")
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # A session can run the same section several times (e.g. one generation per model call)
+        n = 2
+        while os.path.exists(base + ".pstats"):
+            base = os.path.join(directory, f"{profile_id}-{label}-{n}")
+            n += 1
+        if profiler is not None:
+            pstats.Stats(profiler).dump_stats(base + ".pstats")
+        if torch_prof is not None:
+            torch_prof.export_chrome_trace(base + ".trace.json")
+    except Exception as e:
+        print(f"Warning: could not write profile {base}: {e}")
+        return
+    print(f"[{time.strftime('%H:%M:%S')}] 🔬 Profiled {label} ({seconds:.2f}s) -> {base}.*")
@@ -21,10 +21,14 @@ class StudySerializer(serializers.ModelSerializer):
     patient = serializers.PrimaryKeyRelatedField(queryset=Patient.objects.all(), required=False)
     patient_id = serializers.IntegerField(write_only=True, required=False)
     audio = serializers.FileField(write_only=True, required=False)
+    pathologies = serializers.SlugRelatedField(many=True, read_only=True, slug_field='label')
     
     class Meta:
         model = Study
         fields = '__all__'
+        read_only_fields = ['image_model_input', 'symptoms_audio_16k', 'stage_timings', 'generation_stats',
+                            'findings_observations', 'findings_irregularities', 'final_diagnosis',
+                            'ranked_diagnosis', 'urgency']
 
     def validate(self, data):
         # Resolve patient from patient_id if necessary
@@ -0,0 +1,236 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from .triage_history import questions_asked
+
+# AI_BACKEND=simulated: stand-ins for the MedGemma and MedASR pipelines that
+# play scripted, well-formed outputs (findings, [ASK] questions, [DIAGNOSIS])
+# with the timing of a real device. They are loaded through the model registry
+# and MedGemma calls go through the same BatchingScheduler as the real model,
+# so queueing, batching and worker counts behave as on a GPU.
+#
+# Timing comes from AI_SIM_PROFILE (see PROFILES); any value can be overridden:
+# AI_SIM_LOAD_SECONDS, AI_SIM_TTFT_MS, AI_SIM_PREFILL_MS_PER_1K_TOKENS,
+# AI_SIM_TOKENS_PER_SECOND, AI_SIM_BATCH_OVERHEAD, AI_SIM_ASR_REALTIME_FACTOR
+# and AI_SIM_JITTER. AI_SIM_ASK_TURNS is the number of questions before the
+# diagnosis (default 3).
+
+PROFILES = {
+    # 4-bit MedGemma 1.5 4B on a 16 GB T4-class GPU
+    'gpu': {'load_seconds': 40, 'ttft_ms': 300, 'prefill_ms_per_1k_tokens': 120, 'tokens_per_second': 20,
+            'batch_overhead': 0.15, 'asr_realtime_factor': 0.05, 'jitter': 0.1},
+    # Large datacenter GPU
+    'gpu-large': {'load_seconds': 20, 'ttft_ms': 120, 'prefill_ms_per_1k_tokens': 30, 'tokens_per_second': 45,
+                  'batch_overhead': 0.05, 'asr_realtime_factor': 0.02, 'jitter': 0.1},
+    # int8 on an 8-core CPU (see benchmark_cpu_backend)
+    'cpu': {'load_seconds': 90, 'ttft_ms': 2500, 'prefill_ms_per_1k_tokens': 2000, 'tokens_per_second': 4,
+            'batch_overhead': 0.8, 'asr_realtime_factor': 0.5, 'jitter': 0.1},
+    # Well-formed outputs without delays (functional tests)
+    'instant': {'load_seconds': 0, 'ttft_ms': 0, 'prefill_ms_per_1k_tokens': 0, 'tokens_per_second': 0,
+                'batch_overhead': 0, 'asr_realtime_factor': 0, 'jitter': 0},
+}
+
+SCENARIOS = [
+    {
+        'transcript': "I have had a cough with yellow phlegm for five days, fever at night and pain on the right side when I breathe.",
+        'symptoms': "Productive cough with yellow sputum for 5 days, nocturnal fever, right-sided pleuritic chest pain.",
+        'observations': "Frontal chest radiograph. The heart size is within normal limits. The trachea is midline.",
+        'irregularities': "Patchy airspace opacity in the right lower lobe with air bronchograms. No pleural effusion.",
+        'pathologies': ["Pneumonia", "Bronchitis", "Lung Mass"],
+        'questions': [
+            ("How high has the fever been?", ["Below 38 °C", "Between 38 and 39 °C", "Above 39 °C", "I have not measured it"]),
+            ("Do you feel short of breath?", ["Only when climbing stairs", "When walking on flat ground", "At rest", "No"]),
+            ("Have you coughed up blood?", ["Streaks of blood in the phlegm", "Clots of blood", "Only once", "Never"]),
+        ],
+        'diagnosis': [("Community-acquired pneumonia", "right lower lobe consolidation with fever and productive cough"),
+                      ("Acute bronchitis", "productive cough, but it does not explain the focal opacity"),
+                      ("Lung mass", "a focal opacity is present, but the acute febrile course makes it unlikely")],
+        'urgency': "High",
+    },
+    {
+        'transcript': "My legs are swollen, I get tired when I walk and I need two pillows to sleep.",
+        'symptoms': "Bilateral leg swelling, exertional fatigue, orthopnea (two pillows).",
+        'observations': "Frontal chest radiograph. The cardiac silhouette is enlarged. The costophrenic angles are blunted.",
+        'irregularities': "Cardiomegaly with cephalization of the pulmonary vessels and small bilateral pleural effusions.",
+        'pathologies': ["Congestive Heart Failure", "Pleural Effusion", "Pneumonia"],
+        'questions': [
+            ("How long have your legs been swollen?", ["A few days", "About two weeks", "More than a month", "It comes and goes"]),
+            ("Do you wake up at night short of breath?", ["Every night", "A few times a week", "Rarely", "No"]),
+            ("Have you gained weight recently?", ["More than 2 kg in a week", "Some weight over a month", "No change", "I lost weight"]),
+        ],
+        'diagnosis': [("Congestive heart failure", "cardiomegaly, vascular congestion, orthopnea and leg edema"),
+                      ("Pleural effusion", "present on the image, most likely secondary to heart failure"),
+                      ("Pneumonia", "no fever or productive cough reported")],
+        'urgency': "Medium",
+    },
+    {
+        'transcript': "I have a dry cough for three weeks and I feel a bit tired, no fever.",
+        'symptoms': "Dry cough for 3 weeks, mild fatigue, no fever.",
+        'observations': "Frontal chest radiograph. Normal heart size. Clear lung fields bilaterally.",
+        'irregularities': "No focal consolidation, effusion or pneumothorax. Mild peribronchial thickening.",
+        'pathologies': ["Bronchitis", "Asthma", "Tuberculosis"],
+        'questions': [
+            ("Does the cough get worse at a particular time?", ["At night", "With exercise or cold air", "After meals", "It is the same all day"]),
+            ("Have you had night sweats or weight loss?", ["Night sweats", "Weight loss", "Both", "Neither"]),
+            ("Do you hear a whistling sound when you breathe?", ["Often", "Only with exercise", "Rarely", "Never"]),
+        ],
+        'diagnosis': [("Post-viral bronchitis", "subacute dry cough with peribronchial thickening and no fever"),
+                      ("Asthma", "cough could be a variant of asthma if it worsens with exercise or at night"),
+                      ("Tuberculosis", "no night sweats, weight loss or upper lobe findings")],
+        'urgency': "Low",
+    },
+]
+
+
+def simulation_config():
+    config = dict(PROFILES.get(os.environ.get("AI_SIM_PROFILE", "gpu"), PROFILES['gpu']))
+    for key in config:
+        value = os.environ.get(f"AI_SIM_{key.upper()}")
+        if value is not None:
+            config[key] = float(value)
+    config['ask_turns'] = int(os.environ.get("AI_SIM_ASK_TURNS", 3))
+    return config
+
+
+def approximate_token_ids(text):
+    # About 4 characters per token, like triage_history.approximate_tokens
+    return list(range(len(text) // 4 + 1))
+
+
+class SimulatedTokenizer:
+    def __call__(self, text, add_special_tokens=False):
+        return {"input_ids": approximate_token_ids(text)}
+
+
+class _Namespace:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _message_text(message):
+    content = message.get('content', [])
+    if isinstance(content, list):
+        return "".join(item.get('text', '') for item in content if isinstance(item, dict) and item.get('type') == 'text')
+    return str(content)
+
+
+def _pick(key, choices):
+    """Deterministic choice: the same input always plays the same scenario."""
+    digest = hashlib.sha256(key.encode('utf-8', 'ignore')).digest()
+    return choices[int.from_bytes(digest[:4], 'big') % len(choices)]
+
+
+def _scenario_for(messages):
+    text = "\n".join(_message_text(m) for m in messages)
+    # Later stages quote earlier outputs: keep playing the same scenario
+    # (the image findings decide the triage scenario, the transcript the symptoms)
+    for key in ('irregularities', 'symptoms', 'transcript'):
+        for scenario in SCENARIOS:
+            if scenario[key] in text:
+                return scenario
+    images = [item['image'] for m in messages for item in m.get('content', [])
+              if isinstance(item, dict) and item.get('type') == 'image']
+    if images:
+        # A tiny thumbnail is enough to tell uploads apart
+        text = images[0].convert('L').resize((8, 8)).tobytes().hex()
+    return _pick(text, SCENARIOS)
+
+
+def _findings(scenario):
+    return (f"[OBSERVATIONS] {scenario['observations']}\n"
+            f"[IRREGULARITIES] {scenario['irregularities']}\n"
+            f"[PATHOLOGIES] {', '.join(scenario['pathologies'])}\n")
+
+
+def _triage_step(scenario, messages, ask_turns):
+    asked = questions_asked(messages)
+    limit_reached = 'question limit' in _message_text(messages[-1]) if messages else False
+    if asked < min(ask_turns, len(scenario['questions'])) and not limit_reached:
+        question, options = scenario['questions'][asked]
+        lines = [f"[ASK] {question}"] + [f"{letter}) {option}" for letter, option in zip("ABCD", options)]
+        return "\n".join(lines + ["E) None of the above", ""])
+    ranked = "\n".join(f"  {i}. {name} - {reason}" for i, (name, reason) in enumerate(scenario['diagnosis'], start=1))
+    return (f"[DIAGNOSIS]\n* Ranked Pre-diagnosis: \n{ranked}\n"
+            f"* Clinical summary (Symptoms + Imaging): {scenario['symptoms']} {scenario['irregularities']}\n"
+            f"* Suggested urgency level: {scenario['urgency']}\n"
+            f"* Note: This is an AI-generated pre-diagnosis that requires mandatory validation by a human doctor.")
+
+
+class SimulatedMedGemma:
+    """Plays scripted MedGemma outputs for a micro-batch with the configured prefill/decode timing."""
+    simulated = True
+
+    def __init__(self, config):
+        self.config = config
+        self.processor = _Namespace(tokenizer=SimulatedTokenizer())
+        self._random = random.Random(os.environ.get("AI_SIM_SEED"))
+
+    def script(self, request):
+        scenario = _scenario_for(request.messages)
+        if request.stop_format == 'findings':
+            return _findings(scenario)
+        if request.stop_format == 'triage':
+            return _triage_step(scenario, request.messages, self.config['ask_turns'])
+        if request.operation == 'symptoms':
+            return scenario['symptoms']
+        return f"Summary: {scenario['symptoms']}"
+
+    def generate(self, requests):
+        """Returns one text per request, streaming tokens to the request's streamer if it has one."""
+        texts, token_ids = [], []
+        for request in requests:
+            text = self.script(request)
+            ids = approximate_token_ids(text)[:request.max_tokens]
+            chars_per_token = len(text) / max(1, len(approximate_token_ids(text)))
+            texts.append(text[:round(len(ids) * chars_per_token)])
+            token_ids.append(ids)
+            request.prompt_tokens = sum(len(approximate_token_ids(_message_text(m))) for m in request.messages)
+            request.generated_tokens = len(ids)
+
+        # Prefill the whole batch, then decode step by step: a step is slower the larger the batch
+        prefill = self.config['ttft_ms'] + self.config['prefill_ms_per_1k_tokens'] * sum(r.prompt_tokens for r in requests) / 1000
+        self._sleep(prefill / 1000)
+        rate = self.config['tokens_per_second']
+        step = (1 + self.config['batch_overhead'] * (len(requests) - 1)) / rate if rate else 0
+        streamer = requests[0].streamer if len(requests) == 1 else None
+        steps = max(len(ids) for ids in token_ids)
+        chunk = len(texts[0]) / max(1, len(token_ids[0]))
+        for i in range(steps):
+            self._sleep(step)
+            if streamer is not None:
+                streamer.on_finalized_text(texts[0][round(i * chunk):round((i + 1) * chunk)])
+        if streamer is not None:
+            streamer.end()
+        return texts
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * (1 + self._random.uniform(-1, 1) * self.config['jitter']))
+
+
+class SimulatedMedASR:
+    """Plays a scripted transcript, taking `asr_realtime_factor` seconds per second of audio."""
+    simulated = True
+
+    def __init__(self, config):
+        self.config = config
+        # One device: transcriptions from concurrent workers run one after the other
+        self._lock = threading.Lock()
+
+    def __call__(self, inputs, **kwargs):
+        audio, sample_rate = inputs["raw"], inputs["sampling_rate"]
+        with self._lock:
+            time.sleep(len(audio) / sample_rate * self.config['asr_realtime_factor'])
+        scenario = _pick(audio[::max(1, len(audio) // 256)].tobytes().hex(), SCENARIOS)
+        return {"text": scenario['transcript']}
+
+
+def load_simulated(model):
+    """Loader for the model registry: waits the profile's load time, then returns the stand-in."""
+    config = simulation_config()
+    profile = os.environ.get("AI_SIM_PROFILE", "gpu")
+    print(f"Loading simulated {model} (profile {profile}, {config['load_seconds']}s load)...")
+    time.sleep(config['load_seconds'] * (0.5 if model == 'medasr' else 1))
+    return SimulatedMedGemma(config) if model == 'medgemma' else SimulatedMedASR(config)
@@ -0,0 +1,70 @@
+import re
+import torch
+from transformers import StoppingCriteria, StoppingCriteriaList
+
+# A structured block is complete once its last mandatory line has been written.
+# Template placeholders ("[Write your clinical question here]") mean the model is
+# still echoing the prompt, so they never count as a finished block.
+_ASK_DONE = re.compile(r"\[ASK\](?![^\n]*\[Write your)[\s\S]*?^\s*E\)\s*None of the above[^\n]*\n", re.MULTILINE)
+_DIAGNOSIS_DONE = re.compile(r"\[DIAGNOSIS\][\s\S]*?requires mandatory validation by a human doctor\.?")
+_PATHOLOGIES_DONE = re.compile(r"\[PATHOLOGIES\][ \t:]*\S[^\n]*\n")
+
+STOP_PATTERNS = {
+    'triage': (_ASK_DONE, _DIAGNOSIS_DONE),
+    'findings': (_PATHOLOGIES_DONE,),
+}
+
+
+def structured_output_complete(text, stop_format):
+    """True once `text` contains a finished block of the given format ('triage' or 'findings')."""
+    return any(pattern.search(text) for pattern in STOP_PATTERNS.get(stop_format, ()))
+
+
+class StructuredOutputStop(StoppingCriteria):
+    """
+    Ends generation as soon as the structured answer is complete, instead of
+    decoding up to max_new_tokens of text that _clean_ai_output throws away:
+    - triage: after the "E) None of the above" line of an [ASK] block, or after
+      the mandatory validation disclaimer of a [DIAGNOSIS] block.
+    - findings: after the [PATHOLOGIES] list line.
+
+    Works per sequence, so finished rows of a batch stop while the others continue.
+    """
+    def __init__(self, tokenizer, stop_format):
+        self.tokenizer = tokenizer
+        self.stop_format = stop_format
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_length is None:
+            # First call happens right after the first new token
+            self.prompt_length = input_ids.shape[1] - 1
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for row in range(input_ids.shape[0]):
+            # Blocks end at a line break or a full stop: skip the full decode on every other token
+            last = self.tokenizer.decode(input_ids[row, -1:], skip_special_tokens=True)
+            if "\n" not in last and "." not in last:
+                continue
+            text = self.tokenizer.decode(input_ids[row, self.prompt_length:], skip_special_tokens=True)
+            done[row] = structured_output_complete(text, self.stop_format)
+        return done
+
+
+def stopping_criteria_for(tokenizer, stop_format, *extra):
+    criteria = [c for c in extra if c is not None]
+    if stop_format:
+        criteria.append(StructuredOutputStop(tokenizer, stop_format))
+    return StoppingCriteriaList(criteria) if criteria else None
+
+
+class PromptLengthProbe(StoppingCriteria):
+    """Never stops generation: records the prompt length of each row (padding excluded) for metrics."""
+    def __init__(self, pad_token_id):
+        self.pad_token_id = pad_token_id
+        self.prompt_lengths = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        if self.prompt_lengths is None:
+            prompt = input_ids[:, :input_ids.shape[1] - 1]
+            self.prompt_lengths = (prompt != self.pad_token_id).sum(dim=1).tolist()
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
@@ -0,0 +1,331 @@
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import date
+from types import SimpleNamespace
+from unittest import mock
+import torch
+from PIL import Image
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory
+from transformers import Gemma3ForCausalLM, Gemma3TextConfig, TextIteratorStreamer
+from .admission import AdmittedStream
+from .ai_processors import MedGemma15Processor
+from .inference_server import InferenceServer
+from .jobs import claim_next_job, enqueue_consultation, requeue_stale_jobs, run_job
+from .idempotency import KEY_HEADER, REPLAYED_HEADER, _run_once, claim_stream, finish_stream
+from .inference_scheduler import BatchingScheduler, GenerationRequest
+from .kv_cache import TriageKVCache
+from .media_ingest import delete_study_media, prepare_model_image
+from .metrics import KV_CACHE_REQUESTS, REGISTRY, STALE_AFTER, Gauge
+from .models import ConsultationJob, IdempotencyKey, Patient, Study
+
+
+def triage_messages(study_id):
+    return [{"role": "user", "content": [{"type": "text", "text": f"Study {study_id}: new answer"}]}]
+
+
+def triage_turn(study_id):
+    return GenerationRequest(triage_messages(study_id), 1500, cache_key=study_id, stop_format="triage", operation="triage")
+
+
+class TriageBatchingTests(SimpleTestCase):
+    def test_turns_of_two_studies_share_a_batch(self):
+        batches = []
+
+        def run_batch(requests):
+            batches.append(requests)
+            return [f"reply {r.cache_key}" for r in requests]
+
+        scheduler = BatchingScheduler(run_batch, max_batch_size=4, batch_window_ms=500)
+        first = scheduler.submit(triage_messages(1), 1500, cache_key=1, stop_format="triage", operation="triage")
+        second = scheduler.submit(triage_messages(2), 1500, cache_key=2, stop_format="triage", operation="triage")
+
+        self.assertEqual(first.result(timeout=5), "reply 1")
+        self.assertEqual(second.result(timeout=5), "reply 2")
+        self.assertEqual([[r.cache_key for r in batch] for batch in batches], [[1, 2]])
+
+    def test_cached_turn_runs_alone(self):
+        batches = []
+
+        def run_batch(requests):
+            batches.append(requests)
+            return [f"reply {r.cache_key}" for r in requests]
+
+        scheduler = BatchingScheduler(run_batch, max_batch_size=4, batch_window_ms=200)
+        futures = [
+            scheduler.submit(triage_messages(1), 1500, cache_key=1, stop_format="triage", operation="triage", kv_cached=True),
+            scheduler.submit(triage_messages(2), 1500, cache_key=2, stop_format="triage", operation="triage"),
+            scheduler.submit(triage_messages(3), 1500, cache_key=3, stop_format="triage", operation="triage"),
+        ]
+        for future in futures:
+            future.result(timeout=5)
+
+        self.assertCountEqual([[r.cache_key for r in batch] for batch in batches], [[1], [2, 3]])
+
+
+    def test_failed_stream_is_not_replayed(self):
+        processor = MedGemma15Processor()
+        request = triage_turn(1)
+        request.streamer = TextIteratorStreamer(CharProcessor(), skip_prompt=True)
+
+        def fail_midway(request):
+            request.streamer.put(torch.tensor([[70, 80]])) # Prompt
+            request.streamer.put(torch.tensor([90]))
+            raise RuntimeError("device lost")
+
+        with mock.patch.object(processor, '_get_pipeline', return_value=object()), \
+             mock.patch.object(processor, '_generate_with_cache', side_effect=fail_midway), \
+             mock.patch.object(processor, '_run_pipeline') as pipeline:
+            with self.assertRaises(RuntimeError):
+                processor._run_batch_on_model([request])
+        pipeline.assert_not_called()
+
+
+class CharProcessor:
+    """Character level stand-in for the MedGemma processor and its chat template."""
+    def __init__(self):
+        self.tokenizer = self
+
+    def apply_chat_template(self, messages, add_generation_prompt=False, tokenize=False, return_dict=False, return_tensors=None):
+        text = "".join(f"<{'model' if m['role'] == 'assistant' else 'user'}>{m['content'][0]['text']}|" for m in messages)
+        if add_generation_prompt:
+            text += "<model>"
+        return self(text, return_tensors=return_tensors) if tokenize else text
+
+    def __call__(self, text, add_special_tokens=False, return_tensors=None):
+        ids = [3 + ord(c) % 253 for c in text]
+        return {"input_ids": torch.tensor([ids]) if return_tensors == "pt" else ids}
+
+    def decode(self, ids, skip_special_tokens=False):
+        return "".join(chr(int(i) - 3) for i in ids if int(i) > 2)
+
+
+class TriageKVCacheTests(SimpleTestCase):
+    """Runs a tiny random Gemma 3 (sliding window of 1024 tokens) past its window."""
+    def setUp(self):
+        torch.manual_seed(0)
+        config = Gemma3TextConfig(
+            vocab_size=256, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=2, num_key_value_heads=1, head_dim=16, sliding_window=1024,
+            layer_types=["sliding_attention", "full_attention"], max_position_embeddings=4096,
+            pad_token_id=0, eos_token_id=1, bos_token_id=2)
+        self.model = Gemma3ForCausalLM(config).eval()
+        self.processor = MedGemma15Processor()
+        pipe = SimpleNamespace(model=self.model, processor=CharProcessor())
+        for patch in (mock.patch.object(MedGemma15Processor, 'kv_cache', TriageKVCache()),
+                      mock.patch.object(MedGemma15Processor, '_get_pipeline', return_value=pipe)):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def turn(self, study_id, messages):
+        return GenerationRequest(messages, 8, cache_key=study_id, operation="triage")
+
+    def next_turn(self, request, answer):
+        messages = request.messages + [
+            {"role": "assistant", "content": [{"type": "text", "text": answer}]},
+            {"role": "user", "content": [{"type": "text", "text": f"Patient answer {len(request.messages)}"}]},
+        ]
+        return self.turn(request.cache_key, messages)
+
+    def assertMatchesFullEncoding(self, request):
+        sequence = self.processor.kv_cache.peek(request.cache_key).token_ids
+        prompt = sequence[:request.prompt_tokens]
+        with torch.inference_mode():
+            expected = self.model.generate(prompt[None], max_new_tokens=8, do_sample=False, pad_token_id=1, repetition_penalty=1.15)
+        self.assertEqual(sequence.tolist(), expected[0].tolist())
+
+    def cache_hits(self):
+        return KV_CACHE_REQUESTS._values.get(("hit",), 0)
+
+    def test_turns_past_the_sliding_window_extend_the_cache(self):
+        first = self.turn(1, [
+            {"role": "user", "content": [{"type": "text", "text": "Triage instructions. " * 55}]},
+            {"role": "assistant", "content": [{"type": "text", "text": "Understood."}]},
+            {"role": "user", "content": [{"type": "text", "text": "Patient answer 2"}]},
+        ])
+        self.processor._generate_with_cache(first)
+        self.assertGreater(first.prompt_tokens, 1024)
+
+        hits = self.cache_hits()
+        second = self.next_turn(first, "Cleaned answer")
+        self.processor._generate_with_cache(second)
+
+        self.assertEqual(self.cache_hits(), hits + 1)
+        self.assertMatchesFullEncoding(second)
+
+    def test_batched_turns_keep_a_cache_per_row(self):
+        long_turn = self.turn(1, [{"role": "user", "content": [{"type": "text", "text": "Long history. " * 80}]}])
+        short_turn = self.turn(2, [{"role": "user", "content": [{"type": "text", "text": "Short history."}]}])
+        self.processor._run_batch_on_model([long_turn, short_turn])
+
+        hits = self.cache_hits()
+        for request in (long_turn, short_turn):
+            following = self.next_turn(request, "Cleaned answer")
+            self.processor._generate_with_cache(following)
+            self.assertMatchesFullEncoding(following)
+        self.assertEqual(self.cache_hits(), hits + 2)
+
+
+class MediaIngestTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.patient = Patient.objects.create(first_name="Ana", last_name="Test", dni="X1", birth_date=date(1980, 1, 1))
+
+    def upload(self, color):
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 32), color).save(buffer, format="PNG")
+        study = Study(patient=self.patient)
+        study.image.save("scan.png", ContentFile(buffer.getvalue()))
+        return study
+
+    def test_derivatives_of_same_named_uploads_do_not_overwrite_each_other(self):
+        first, second = self.upload("red"), self.upload("blue")
+        prepare_model_image(first)
+        prepare_model_image(second)
+
+        self.assertNotEqual(first.image_model_input.name, second.image_model_input.name)
+        with Image.open(first.image_model_input.path) as img:
+            self.assertEqual(img.getpixel((0, 0)), (255, 0, 0))
+
+    def test_deleting_a_study_keeps_the_files_of_others(self):
+        first, second = self.upload("red"), self.upload("blue")
+        prepare_model_image(first)
+        prepare_model_image(second)
+        storage, second_files = second.image.storage, [second.image.name, second.image_model_input.name]
+        delete_study_media(second)
+
+        self.assertTrue(storage.exists(first.image.name))
+        self.assertTrue(storage.exists(first.image_model_input.name))
+        self.assertFalse(any(storage.exists(name) for name in second_files))
+
+
+class MetricsSnapshotTests(SimpleTestCase):
+    def test_snapshots_of_exited_processes_are_dropped(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        gauge = Gauge('medai_test_snapshot_gauge', 'Test gauge.', ['worker'])
+        key = json.dumps(["w"])
+        for name, age in (("alive", 0), ("exited", STALE_AFTER + 1)):
+            with open(os.path.join(directory, f"{name}-1.json"), 'w') as f:
+                json.dump({'written_at': time.time() - age, 'metrics': {gauge.name: {key: 1}}}, f)
+
+        with mock.patch.dict(os.environ, {"AI_METRICS_DIR": directory}):
+            merged = REGISTRY.merged_snapshot()
+
+        self.assertEqual(merged[gauge.name], {key: 1})
+        self.assertEqual(os.listdir(directory), ["alive-1.json"])
+
+
+class IdempotencyTests(TransactionTestCase):
+    scope = "triage:1"
+
+    def test_retry_replays_the_stored_response(self):
+        run = mock.Mock(return_value=Response({"step": 1}))
+        _run_once(run, self.scope, "key", "hash")
+        retry = _run_once(run, self.scope, "key", "hash")
+
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(retry.data, {"step": 1})
+        self.assertEqual(retry[REPLAYED_HEADER], "true")
+
+    def test_key_reused_for_another_request_is_rejected(self):
+        _run_once(lambda: Response({"step": 1}), self.scope, "key", "hash")
+        other = _run_once(mock.Mock(), self.scope, "key", "other hash")
+
+        self.assertEqual(other.status_code, 422)
+
+    def test_retry_joins_the_running_request(self):
+        started, release = threading.Event(), threading.Event()
+        responses = []
+
+        def slow_run():
+            started.set()
+            release.wait(5)
+            return Response({"step": 1})
+
+        def original():
+            responses.append(_run_once(slow_run, self.scope, "key", "hash"))
+            connection.close()
+
+        thread = threading.Thread(target=original)
+        thread.start()
+        started.wait(5)
+        threading.Timer(0.2, release.set).start()
+        retry_run = mock.Mock()
+        retry = _run_once(retry_run, self.scope, "key", "hash")
+        thread.join(5)
+
+        retry_run.assert_not_called()
+        self.assertEqual(retry.data, responses[0].data)
+
+    def test_stream_closed_before_it_started_releases_the_key(self):
+        def stream_request():
+            request = APIRequestFactory().post("/", {"answer": "A"}, format="json", **{KEY_HEADER: "key"})
+            return Request(request, parsers=[JSONParser()])
+
+        record, duplicate = claim_stream(stream_request(), self.scope, replay=mock.Mock())
+        self.assertIsNone(duplicate)
+        body = AdmittedStream("triage", iter([]), on_abandon=lambda: finish_stream(record))
+        body.close() # Client went away before the first chunk
+
+        self.assertFalse(IdempotencyKey.objects.exists())
+        record, duplicate = claim_stream(stream_request(), self.scope, replay=mock.Mock())
+        self.assertIsNone(duplicate)
+        self.assertIsNotNone(record)
+
+
+class InferenceServerTests(SimpleTestCase):
+    def test_stalled_client_does_not_block_others(self):
+        from multiprocessing.connection import Client
+        address = os.path.join(tempfile.mkdtemp(), "inference.sock") # Unlinked by the Listener at exit
+        with mock.patch.dict(os.environ, {"AI_INFERENCE_AUTHKEY": "k" * 32, "MOCK_AI": "True"}):
+            threading.Thread(target=InferenceServer(address).serve_forever, daemon=True).start()
+            for _ in range(50):
+                if os.path.exists(address):
+                    break
+                time.sleep(0.05)
+
+            stalled = socket.socket(socket.AF_UNIX)
+            stalled.connect(address) # Never answers the challenge
+            self.addCleanup(stalled.close)
+            with Client(address, authkey=b"k" * 32) as conn:
+                conn.send({'op': 'status'})
+                self.assertTrue(conn.poll(5))
+                self.assertTrue(conn.recv()['result']['ready'])
+
+
+@override_settings(AI_JOB_STALE_TIMEOUT=2)
+class ConsultationJobTests(TransactionTestCase):
+    def test_slow_running_job_is_not_requeued(self):
+        patient = Patient.objects.create(first_name="Ana", last_name="Test", dni="X2", birth_date=date(1980, 1, 1))
+        study = Study.objects.create(patient=patient, image="studies/images/scan.png")
+        enqueue_consultation(study)
+        job = claim_next_job("worker-1")
+        requeued = []
+
+        def slow_consultation(study):
+            time.sleep(3) # Longer than the stale timeout
+            requeued.append(requeue_stale_jobs())
+            return study
+
+        with mock.patch("api.ai_processors.IntegratedAIProcessor") as processor:
+            processor.return_value.process_consultation.side_effect = slow_consultation
+            run_job(job)
+
+        self.assertEqual(requeued, [0])
+        self.assertEqual(ConsultationJob.objects.get(id=job.id).status, "DONE")
@@ -0,0 +1,131 @@
+import os
+import re
+from functools import lru_cache
+
+# System prompt, acknowledgement and initial patient data
+PINNED_MESSAGES = 3
+
+_CHOSEN = re.compile(r"The patient chose option:\s*(.+)")
+
+SUMMARY_HEADER = "--- ANSWERS SO FAR (earlier triage questions) ---"
+SUMMARY_INTRO = "The earlier triage questions and the patient's answers are summarized below."
+_SUMMARY_LINE = re.compile(r"^\d+\. ", re.MULTILINE)
+
+
+def message_text(message):
+    content = message.get('content', [])
+    if isinstance(content, list):
+        return "".join(item.get('text', '') for item in content if isinstance(item, dict))
+    return str(content)
+
+
+def _with_text(message, text):
+    return {"role": message['role'], "content": [{"type": "text", "text": text}]}
+
+
+def questions_asked(messages):
+    """[ASK] questions in the conversation, including those collapsed into the answers summary."""
+    asked = 0
+    for message in messages:
+        text = message_text(message)
+        if message.get('role') == 'assistant' and '[ASK]' in text:
+            asked += 1
+        elif message.get('role') == 'user' and text.startswith(SUMMARY_HEADER):
+            asked += len(_SUMMARY_LINE.findall(text))
+    return asked
+
+
+def parse_question(text):
+    """
+    Splits an [ASK] step into its question and {letter: option}. Options are
+    found in order (A, B, ...) so it also works when line breaks were lost.
+    """
+    body = text.split("[ASK]")[-1]
+    positions = []
+    start = 0
+    for letter in "ABCDE":
+        pos = body.find(f"{letter})", start)
+        if pos < 0:
+            break
+        positions.append((letter, pos))
+        start = pos + 2
+    question = body[:positions[0][1]] if positions else body.strip().split("\n")[0]
+    options = {}
+    for i, (letter, pos) in enumerate(positions):
+        end = positions[i + 1][1] if i + 1 < len(positions) else len(body)
+        options[letter] = body[pos + 2:end].strip().split("\n")[0]
+    return question.strip(), options
+
+
+def summarize_answer(question_text, answer_text):
+    """One line of the summary: '<question> -> <chosen option text>'."""
+    question, options = parse_question(question_text)
+    chosen = _CHOSEN.search(answer_text)
+    answer = chosen.group(1).strip() if chosen else answer_text.strip()
+    # "B" -> "B) Productive cough with yellow phlegm"
+    letter = answer.rstrip(").").upper()
+    if letter in options:
+        answer = f"{letter}) {options[letter]}"
+    return f"{question} -> {answer}"
+
+
+class TriageHistoryManager:
+    """
+    Builds the model-facing view of a triage conversation under a token budget.
+
+    The system prompt and the initial patient data are always kept, as are the
+    most recent question/answer pairs. When the conversation exceeds the budget,
+    the oldest pairs are collapsed into a compact "answers so far" exchange right
+    after the pinned messages, which stay byte-identical so the shared attention
+    cache of that prefix is still reused (triage messages are text only: the image
+    reaches the conversation as its written findings). The raw history on the
+    Study is never modified.
+
+    - AI_TRIAGE_HISTORY_BUDGET_TOKENS: token budget of the view (default 2048).
+    - AI_TRIAGE_KEEP_RECENT_TURNS: pairs always kept verbatim (default 2).
+    """
+    def __init__(self, count_tokens, budget_tokens=None, keep_recent=None):
+        self.count_tokens = lru_cache(maxsize=2048)(count_tokens)
+        self.budget_tokens = budget_tokens or int(os.environ.get("AI_TRIAGE_HISTORY_BUDGET_TOKENS", 2048))
+        self.keep_recent = keep_recent if keep_recent is not None else int(os.environ.get("AI_TRIAGE_KEEP_RECENT_TURNS", 2))
+
+    def view(self, history):
+        """Returns the messages to send to the model for `history`."""
+        pinned, turns = history[:PINNED_MESSAGES], history[PINNED_MESSAGES:]
+        pairs = [turns[i:i + 2] for i in range(0, len(turns), 2)]
+        if len(pinned) < PINNED_MESSAGES or len(pairs) <= self.keep_recent:
+            return history
+        if not all(p[0]['role'] == 'assistant' and (len(p) == 1 or p[1]['role'] == 'user') for p in pairs):
+            return history # Unexpected shape: never risk breaking role alternation
+
+        if self.history_tokens(history) <= self.budget_tokens:
+            return history
+
+        # Collapse the oldest pairs until the view fits (the recent ones always stay)
+        for n_collapsed in range(1, len(pairs) - self.keep_recent + 1):
+            view = self._compact(pinned, pairs, n_collapsed)
+            if self.history_tokens(view) <= self.budget_tokens:
+                break
+        return view
+
+    def history_tokens(self, messages):
+        return sum(self.count_tokens(message_text(m)) for m in messages)
+
+    def _compact(self, pinned, pairs, n_collapsed):
+        summary = "\n".join(
+            f"{i}. {summarize_answer(message_text(q), message_text(a[0]) if a else '')}"
+            for i, (q, *a) in enumerate(pairs[:n_collapsed], start=1)
+        )
+        # An assistant/user exchange keeps the roles alternating after the pinned patient data
+        view = list(pinned) + [
+            _with_text({'role': 'assistant'}, SUMMARY_INTRO),
+            _with_text({'role': 'user'}, f"{SUMMARY_HEADER}\n{summary}\n"),
+        ]
+        for pair in pairs[n_collapsed:]:
+            view.extend(pair)
+        return view
+
+
+def approximate_tokens(text):
+    """Fallback counter when no tokenizer is loaded (about 4 characters per token)."""
+    return len(text) // 4 + 1
@@ -7,10 +7,15 @@ from .views import (
     MedicalHistoryListView,
     MedicalHistoryListView,
     DashboardStatsAPIView,
-    StudyTriageView
+    StudyTriageView,
+    StudyTriageStreamView,
+    HealthView,
+    MetricsView
 )
 
 urlpatterns = [
+    path('health/', HealthView.as_view(), name='health'),
+    path('metrics/', MetricsView.as_view(), name='metrics'),
     path('dashboard/stats/', DashboardStatsAPIView.as_view(), name='dashboard-stats'),
     path('patients/', PatientListCreateView.as_view(), name='patient-list'),
     path('patients/<int:pk>/history/', MedicalHistoryListView.as_view(), name='patient-history'),
@@ -18,4 +23,5 @@ urlpatterns = [
     path('studies/<int:pk>/', StudyDetailView.as_view(), name='study-detail'),
     path('reports/', ReportCreateView.as_view(), name='report-create'),
     path('studies/<int:pk>/triage/', StudyTriageView.as_view(), name='study-triage'),
+    path('studies/<int:pk>/triage/stream/', StudyTriageStreamView.as_view(), name='study-triage-stream'),
 ]
@@ -1,14 +1,17 @@
 import os
 import re
+import time
 from django.conf import settings
 from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image as RLImage
 from reportlab.lib.units import inch
+from .metrics import observe_stage
 
 def generate_clinical_report_pdf(clinical_report):
     """Generates a professional medical report in PDF format."""
+    started = time.perf_counter()
     study = clinical_report.study
     patient = study.patient
     
@@ -131,6 +134,11 @@ def generate_clinical_report_pdf(clinical_report):
     # Save path to report model
     clinical_report.report_pdf = relative_path
     clinical_report.save()
+
+    seconds = time.perf_counter() - started
+    observe_stage('pdf_render', seconds)
+    study.stage_timings = {**(study.stage_timings or {}), 'pdf_render': round(seconds, 3)}
+    study.save(update_fields=['stage_timings', 'updated_at'])
     
     return full_path
     
@@ -1,12 +1,25 @@
+import os
+import json
 import time
+from contextlib import nullcontext
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.utils.encoders import JSONEncoder
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from .models import Patient, Study, ClinicalReport, MedicalHistory
 from .serializers import PatientSerializer, StudySerializer, ClinicalReportSerializer, MedicalHistorySerializer
 from .utils import generate_clinical_report_pdf
 from .ai_processors import IntegratedAIProcessor
+from .model_registry import model_registry
+from .inference_client import inference_server_address, RemoteInferenceClient, InferenceServerError
+from .jobs import enqueue_consultation
+from .metrics import REGISTRY
+from .profiling import profiled_view, profile_section, current_profile_id
+from .idempotency import idempotent, claim_stream, finish_stream
+from .admission import admitted, admission_status, rejection_response, AdmittedStream, AdmissionRejected
+from .media_ingest import prepare_study_media, delete_study_media, MediaValidationError
 from rest_framework.permissions import AllowAny
 
 class MedicalHistoryListView(APIView):
@@ -46,6 +59,9 @@ class PatientListCreateView(APIView):
 class StudyUploadView(APIView):
     permission_classes = [AllowAny]
     authentication_classes = []
+    @profiled_view("upload")
+    @idempotent("consultations")
+    @admitted("upload")
     def post(self, request):
         print(f"[{time.strftime('%H:%M:%S')}] 📥 Incoming POST request to /api/consultations/")
         # We handle 'patient_id' mapping inside the StudySerializer.create method now
@@ -53,26 +69,23 @@ class StudyUploadView(APIView):
         serializer = StudySerializer(data=request.data)
         if serializer.is_valid():
             study = serializer.save()
+
+            # Decode/resample media once here, off the GPU-bound worker path
+            try:
+                prepare_study_media(study)
+            except MediaValidationError as e:
+                # Don't leave the rejected upload (or its derivatives) behind in MEDIA_ROOT
+                delete_study_media(study)
+                study.delete()
+                return Response({e.field: str(e)}, status=status.HTTP_400_BAD_REQUEST)
             
             # --- START MULTI-STAGE AI LOGIC (Multi-Modal 2-Stage) ---
-            processor = IntegratedAIProcessor()
-            study = processor.process_consultation(study)
-            
-            # Note: We don't create ClinicalReport or PDF here anymore
-            # because the triage is just starting. 
-            # We only create the History entry for the initiation.
-            
-            MedicalHistory.objects.create(
-                patient=study.patient,
-                title=f"Triaje Iniciado - Estudio #{study.id}",
-                description=(
-                    f"Iniciando triaje inteligente.\n"
-                    f"Hallazgos iniciales: {study.medgemma_result[:200]}..."
-                )
-            )
+            # The pipeline takes minutes, so it runs in the AI worker pool
+            # (`python manage.py run_ai_worker`). The client polls studies/<pk>/.
+            enqueue_consultation(study)
             # --- END MULTI-STAGE AI LOGIC ---
 
-            return Response(StudySerializer(study).data, status=status.HTTP_201_CREATED)
+            return Response(StudySerializer(study).data, status=status.HTTP_202_ACCEPTED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 class StudyDetailView(APIView):
@@ -108,42 +121,117 @@ class ReportCreateView(APIView):
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+def _triage_request_error(study, request):
+    """Validates a triage answer submission. Returns an error Response or None."""
+    if study.triage_completed:
+        return Response({"error": "Triage already completed."}, status=status.HTTP_400_BAD_REQUEST)
+    if not study.triage_history:
+        return Response({"error": "Triage not started yet. The study is still being analyzed."}, status=status.HTTP_409_CONFLICT)
+    if not request.data.get('answer'):
+        return Response({"error": "Answer is required."}, status=status.HTTP_400_BAD_REQUEST)
+    return None
+
+def _finalize_triage(study):
+    """Auto-create ClinicalReport and PDF once triage is done."""
+    report, created = ClinicalReport.objects.get_or_create(
+        study=study,
+        defaults={
+            "final_diagnosis": "Pendiente de revisión médica.",
+            "recommendations": "Se recomienda correlación clínica con el reporte de triaje."
+        }
+    )
+    generate_clinical_report_pdf(report)
+    
+    MedicalHistory.objects.create(
+        patient=study.patient,
+        title=f"Triaje Completado - Estudio #{study.id}",
+        description=f"Conclusión de IA: {study.combined_ai_analysis[:200]}...",
+        attachments_url=report.report_pdf.url if report.report_pdf else None
+    )
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=JSONEncoder)}\n\n"
+
+def _sse_response(events):
+    response = StreamingHttpResponse(events, content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Disable proxy buffering (nginx)
+    return response
+
 class StudyTriageView(APIView):
     permission_classes = [AllowAny]
     authentication_classes = []
+    @profiled_view("triage")
+    @idempotent("triage:{pk}")
+    @admitted("triage")
     def post(self, request, pk):
         print(f"[{time.strftime('%H:%M:%S')}] 📥 Incoming POST request to /api/studies/{pk}/triage/")
         study = get_object_or_404(Study, pk=pk)
-        if study.triage_completed:
-            return Response({"error": "Triage already completed."}, status=status.HTTP_400_BAD_REQUEST)
-            
-        user_answer = request.data.get('answer')
-        if not user_answer:
-            return Response({"error": "Answer is required."}, status=status.HTTP_400_BAD_REQUEST)
+        error = _triage_request_error(study, request)
+        if error:
+            return error
             
         processor = IntegratedAIProcessor()
-        study = processor.continue_triage(study, user_answer)
+        study = processor.continue_triage(study, request.data.get('answer'))
         
         if study.triage_completed:
-            # Auto-create ClinicalReport and PDF once triage is done
-            report, created = ClinicalReport.objects.get_or_create(
-                study=study,
-                defaults={
-                    "final_diagnosis": "Pendiente de revisión médica.",
-                    "recommendations": "Se recomienda correlación clínica con el reporte de triaje."
-                }
-            )
-            generate_clinical_report_pdf(report)
-            
-            MedicalHistory.objects.create(
-                patient=study.patient,
-                title=f"Triaje Completado - Estudio #{study.id}",
-                description=f"Conclusión de IA: {study.combined_ai_analysis[:200]}...",
-                attachments_url=report.report_pdf.url if report.report_pdf else None
-            )
+            _finalize_triage(study)
             
         return Response(StudySerializer(study).data)
 
+class StudyTriageStreamView(APIView):
+    """
+    Same as StudyTriageView, but streams the next step as Server-Sent Events:
+    `token` events ({"text": ...}) while generating, then a `done` event with the
+    updated study (same payload as the non-streaming endpoint), or `error`.
+    A retry with the same Idempotency-Key gets 409 while the original streams, and
+    only the `done` event once it has completed.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    @profiled_view("triage_stream")
+    def post(self, request, pk):
+        print(f"[{time.strftime('%H:%M:%S')}] 📥 Incoming POST request to /api/studies/{pk}/triage/stream/")
+        study = get_object_or_404(Study, pk=pk)
+        # Shares the keys of the non-streaming endpoint: an answer is sent only once either way
+        record, duplicate = claim_stream(request, f"triage:{pk}",
+                                         replay=lambda data: _sse_response(iter([_sse_event("done", data)])))
+        if duplicate is not None:
+            return duplicate
+        error = _triage_request_error(study, request)
+        if error:
+            finish_stream(record)
+            return error
+        user_answer = request.data.get('answer')
+        # The triage step runs while the response is consumed, after post() returned
+        profile_id = current_profile_id()
+
+        def event_stream():
+            processor = IntegratedAIProcessor()
+            result = None
+            try:
+                with profile_section("triage_stream_body", profile_id=profile_id) if profile_id else nullcontext():
+                    for chunk in processor.stream_triage(study, user_answer):
+                        yield _sse_event("token", {"text": chunk})
+                    if study.triage_completed:
+                        _finalize_triage(study)
+                result = StudySerializer(study).data
+                yield _sse_event("done", result)
+            except Exception as e:
+                print(f"[{time.strftime('%H:%M:%S')}] ❌ Triage stream failed: {e}")
+                yield _sse_event("error", {"error": str(e)})
+            finally:
+                # Failed or cut off streams release the key so the answer can be sent again
+                finish_stream(record, result)
+
+        try:
+            # Same limit as the non-streaming endpoint; the slot is held until the stream ends
+            stream = AdmittedStream("triage", event_stream(), on_abandon=lambda: finish_stream(record))
+        except AdmissionRejected as e:
+            finish_stream(record)
+            return rejection_response(e)
+        return _sse_response(stream)
+
 class DashboardStatsAPIView(APIView):
     def get(self, request):
         from django.utils import timezone
@@ -170,3 +258,39 @@ class DashboardStatsAPIView(APIView):
             "stats": stats,
             "active_cases": active_cases
         })
+
+class HealthView(APIView):
+    """Readiness probe: 200 once every AI model is loaded, 503 while loading or after a failure."""
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    def get(self, request):
+        if os.environ.get("MOCK_AI") == "True":
+            return Response({"status": "ok", "ready": True, "mock_ai": True, "models": {}, "admission": admission_status()})
+
+        if inference_server_address():
+            try:
+                server_status = RemoteInferenceClient().status()
+            except InferenceServerError as e:
+                return Response({"status": "unreachable", "ready": False, "mock_ai": False, "error": str(e)},
+                                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            models, ready = server_status['models'], server_status['ready']
+        else:
+            models = model_registry.status()
+            ready = model_registry.is_ready()
+        if ready:
+            overall = "ok"
+        elif any(m['state'] == 'FAILED' for m in models.values()):
+            overall = "degraded"
+        else:
+            overall = "loading"
+        return Response(
+            {"status": overall, "ready": ready, "mock_ai": False, "models": models, "admission": admission_status()},
+            status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE
+        )
+
+class MetricsView(APIView):
+    """Prometheus scrape endpoint: stage latencies, token counts, queue waits and model load times."""
+    permission_classes = [AllowAny]
+    authentication_classes = []
+    def get(self, request):
+        return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
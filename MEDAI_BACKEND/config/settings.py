@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/6.0/ref/settings/
 import os
 from pathlib import Path
 from dotenv import load_dotenv
+from corsheaders.defaults import default_headers
 
 # Load environment variables from .env file
 load_dotenv()
@@ -85,6 +86,13 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # AI worker threads and bulk_ingest write concurrently: wait for the lock
+        # instead of failing, and take it when the transaction starts so two
+        # readers can't deadlock upgrading to writers.
+        'OPTIONS': {
+            'timeout': 30,
+            'transaction_mode': 'IMMEDIATE',
+        },
     }
 }
 
@@ -127,6 +135,8 @@ STATIC_URL = 'static/'
 
 # CORS configuration
 CORS_ALLOW_ALL_ORIGINS = True
+CORS_ALLOW_HEADERS = (*default_headers, 'idempotency-key')
+CORS_EXPOSE_HEADERS = ['Idempotent-Replayed']
 
 # Django REST Framework configuration
 REST_FRAMEWORK = {
@@ -134,3 +144,50 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.AllowAny',
     ],
 }
+
+# AI consultation job queue (see `python manage.py run_ai_worker`)
+AI_JOB_MAX_ATTEMPTS = int(os.environ.get('AI_JOB_MAX_ATTEMPTS', 3))
+AI_JOB_RETRY_DELAY = int(os.environ.get('AI_JOB_RETRY_DELAY', 30)) # seconds, multiplied by attempt number
+AI_JOB_STALE_TIMEOUT = int(os.environ.get('AI_JOB_STALE_TIMEOUT', 1800)) # RUNNING jobs without a heartbeat for this long are considered crashed
+AI_WORKER_POLL_INTERVAL = float(os.environ.get('AI_WORKER_POLL_INTERVAL', 2))
+
+# Persistent cache of deterministic AI outputs (see `python manage.py clear_ai_cache`)
+AI_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('AI_RESULT_CACHE_MAX_ENTRIES', 5000)) # per kind
+
+# Uploaded audio limits, checked when it is normalized to 16 kHz at upload
+AI_AUDIO_MIN_SECONDS = float(os.environ.get('AI_AUDIO_MIN_SECONDS', 0.5))
+AI_AUDIO_MAX_SECONDS = float(os.environ.get('AI_AUDIO_MAX_SECONDS', 600))
+
+# Opt-in profiling of uploads, triage steps and model calls (cProfile + torch profiler traces).
+# A request is profiled when it sends "X-MedAI-Profile: 1" (if allowed) or, with
+# AI_PROFILING_ENABLED, with probability AI_PROFILING_SAMPLE_RATE.
+AI_PROFILING_ENABLED = os.environ.get('AI_PROFILING_ENABLED', 'False') == 'True'
+AI_PROFILING_SAMPLE_RATE = float(os.environ.get('AI_PROFILING_SAMPLE_RATE', 0.01))
+AI_PROFILING_ALLOW_HEADER = os.environ.get('AI_PROFILING_ALLOW_HEADER', str(DEBUG)) == 'True'
+AI_PROFILING_TORCH = os.environ.get('AI_PROFILING_TORCH', 'True') == 'True'
+AI_PROFILING_DIR = os.environ.get('AI_PROFILING_DIR', str(BASE_DIR / 'profiles'))
+
+# Idempotency-Key support on consultations/ and studies/<pk>/triage/ (see api/idempotency.py)
+AI_IDEMPOTENCY_TTL_HOURS = float(os.environ.get('AI_IDEMPOTENCY_TTL_HOURS', 24)) # How long responses are replayed
+AI_IDEMPOTENCY_WAIT_SECONDS = float(os.environ.get('AI_IDEMPOTENCY_WAIT_SECONDS', 120)) # A retry waits this long for the original
+AI_IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('AI_IDEMPOTENCY_LOCK_SECONDS', 900)) # IN_PROGRESS keys older than this are considered crashed
+
+# Admission control for consultations/ and the triage endpoints (see api/admission.py), per web process.
+# Requests beyond *_CONCURRENCY wait in a queue of *_QUEUE places for up to AI_ADMISSION_QUEUE_TIMEOUT
+# seconds; when the queue is full they get 429, when the wait times out 503 (both with Retry-After).
+AI_ADMISSION_ENABLED = os.environ.get('AI_ADMISSION_ENABLED', 'True') == 'True'
+AI_ADMISSION_UPLOAD_CONCURRENCY = int(os.environ.get('AI_ADMISSION_UPLOAD_CONCURRENCY', 4))
+AI_ADMISSION_UPLOAD_QUEUE = int(os.environ.get('AI_ADMISSION_UPLOAD_QUEUE', 16))
+AI_ADMISSION_TRIAGE_CONCURRENCY = int(os.environ.get('AI_ADMISSION_TRIAGE_CONCURRENCY', 2 * int(os.environ.get('AI_BATCH_MAX_SIZE', 4))))
+AI_ADMISSION_TRIAGE_QUEUE = int(os.environ.get('AI_ADMISSION_TRIAGE_QUEUE', 32))
+AI_ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('AI_ADMISSION_QUEUE_TIMEOUT', 30))
+# Uploads get 503 while the queued ConsultationJobs would take the AI workers longer than this to run
+AI_ADMISSION_MAX_JOB_BACKLOG_SECONDS = float(os.environ.get('AI_ADMISSION_MAX_JOB_BACKLOG_SECONDS', 900))
+AI_ADMISSION_JOB_SECONDS = float(os.environ.get('AI_ADMISSION_JOB_SECONDS', 60)) # Assumed job duration until some jobs have finished
+
+# Shared inference server (`python manage.py run_inference_server`), read from the environment
+# by api/inference_client.py. AI_INFERENCE_SERVER is "host:port" or "unix:/path/to/socket".
+# SECURITY: requests are pickled Python objects, so a client that passes the handshake can run
+# arbitrary code in the server process. AI_INFERENCE_AUTHKEY (a secret of 16+ characters, the same
+# in every process) is therefore mandatory; prefer a Unix socket or 127.0.0.1, and never expose a
+# TCP port outside a trusted private network.